@@ -1 +1,2 @@
-from .main import app, setup_docker_environment, wait_for_database
+from .main import app
+from .docker_env import setup_docker_environment, wait_for_database
@@ -0,0 +1,356 @@
+"""
+asgi.py - 非同期（ASGI）サーバーモード
+SERVER_MODE=asgi のとき server.py / desktop_app.py から uvicorn で起動する
+
+Waitress（WSGI）では1リクエストが1スレッドを占有するため、数秒かかるAI相談が
+スレッド数だけ重なると /exchange や / まで待たされる。このモードでは
+待ち時間の長いルートだけを asyncio で処理し、残りは従来どおり Flask に任せる
+
+- /api/ai-consult, /api/ai-consult/stream: 生成APIは generate_async / stream_async、
+  ベクトル探索は asyncpg（待ち時間中はスレッドを持たない）
+- /exchange: 交換SQLを asyncpg で実行
+- /api/metrics: Flask側のカウンタ + asyncpg プールの統計
+- その他のルート: Flask アプリ（a2wsgi でスレッドプール上で実行）
+
+セッションは Flask と同じ署名付きCookieを読み書きするため、両方のルートで同じユーザーになる。
+埋め込みキャッシュ・応答キャッシュのDB参照も asyncpg で行い（psycopg2 のプールは Flask 側だけが使う）、
+専用スレッドプールでは埋め込みAPIの呼び出し（同期SDK）だけを実行する。
+AI相談の同時実行数は、DB待ちは ASGI_DB_POOL_MAX、埋め込みAPIは ASGI_SYNC_THREADS で頭打ちになる。
+"""
+import asyncio
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from flask import render_template
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from . import async_models
+from .config import ASGI_CONFIG, EMBEDDING_WORKER_CONFIG, WAITRESS_THREADS
+from .embedding_worker import enqueue_embedding
+from .embedding_cache import get_embedding_cache, normalize_text, content_key
+from .embeddings import get_embedding_provider
+from .generative_client import get_generative_client, CircuitOpenError, IncompleteGeneration
+from .main import (
+    app as flask_app, collect_metrics, build_consult_prompt, remember_response,
+    record_stream_timings, sse_event, FALLBACK_TANKA, FALLBACK_RESPONSE
+)
+from .response_cache import get_response_cache
+
+_sync_executor = ThreadPoolExecutor(max_workers=ASGI_CONFIG['sync_threads'], thread_name_prefix='asgi-sync')
+
+
+async def run_sync(func, *args, **kwargs):
+    """同期関数をスレッドプールで実行して待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_sync_executor, partial(func, *args, **kwargs))
+
+
+async def embed_text(text, task_type):
+    """
+    embeddings.embed_text の asyncio 版（キャッシュは同じもの）
+    キャッシュのDB段は asyncpg で引き、埋め込みAPIの呼び出しだけをスレッドプールで実行する
+    """
+    provider = get_embedding_provider()
+    text = normalize_text(text)
+    cache = get_embedding_cache()
+    key = content_key(text, provider.model_name, task_type)
+
+    embedding = cache.get_memory(key)
+    if embedding is not None:
+        return embedding
+    if cache.use_db:
+        try:
+            embedding = await async_models.load_cached_embedding(key)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+            cache.record_db_error(e)
+        if embedding is not None:
+            cache.remember_db_hit(key, embedding)
+            return embedding
+    cache.record_miss()
+
+    started = time.perf_counter()
+    embedding = (await run_sync(provider.embed, [text], task_type))[0]
+    cache.remember(key, embedding, latency=time.perf_counter() - started)
+    if cache.use_db:
+        try:
+            await async_models.store_cached_embedding(key, provider.model_name, task_type, embedding)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+            cache.record_db_error(e)
+    return embedding
+
+
+# ==================== セッション（Flaskと共有） ====================
+
+def load_session(request):
+    """
+    Flask の署名付きセッションCookieを読む
+    Returns: (session dict, 変更フラグ)（無い・改ざんされている場合は新しいセッション）
+    """
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if cookie:
+        try:
+            max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+            session = dict(serializer.loads(cookie, max_age=max_age))
+        except BadSignature:
+            pass
+        else:
+            # 正しく署名されていても session_id が無い（Flask 側で他のキーだけ保存された）場合は
+            # main.ensure_session と同じく新しく発行し、書き戻す
+            if 'session_id' in session:
+                return session, False
+            session['session_id'] = str(uuid.uuid4())
+            session.pop('user_id', None)
+            session.pop('user_db', None)
+            return session, True
+    return {'session_id': str(uuid.uuid4())}, True
+
+
+def save_session(response, session):
+    """セッションを Flask と同じ形式でCookieに書く"""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    response.set_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        serializer.dumps(session),
+        path=flask_app.config['SESSION_COOKIE_PATH'] or '/',
+        httponly=flask_app.config['SESSION_COOKIE_HTTPONLY'],
+        secure=flask_app.config['SESSION_COOKIE_SECURE'],
+        samesite=flask_app.config['SESSION_COOKIE_SAMESITE'] or 'lax',
+    )
+
+
+async def resolve_user(session):
+    """
+    main.get_current_user_id の asyncio 版
+    Returns: (user_id, セッションを書き戻す必要があるか)
+    """
+    identity = await async_models.get_database_identity()
+    user_id = session.get('user_id')
+    if user_id is not None and session.get('user_db') == identity:
+        return user_id, False
+    user_id = await async_models.get_or_create_user(session['session_id'])
+    session['user_id'] = user_id
+    session['user_db'] = identity
+    return user_id, True
+
+
+async def resolve_stale_user(session):
+    """main.resolve_stale_user の asyncio 版（外部キー違反のとき識別子を取り直して解決し直す）"""
+    session.pop('user_id', None)
+    await async_models.get_database_identity(refresh=True)
+    user_id, _ = await resolve_user(session)
+    return user_id
+
+
+def render(template, **context):
+    """Flask のテンプレートを描画（url_for が使えるようにリクエストコンテキストを用意）"""
+    with flask_app.test_request_context('/'):
+        return render_template(template, **context)
+
+
+# ==================== ルート ====================
+
+async def exchange(request):
+    """短歌交換処理（main.exchange の asyncio 版）"""
+    session, modified = load_session(request)
+    user_id, user_resolved = await resolve_user(session)
+
+    form = await request.form()
+    lines = [form.get(f'line{i}', '').strip() for i in range(1, 6)]
+    user_tanka = '\n'.join(lines)
+
+    if not any(lines):
+        response = HTMLResponse(render('submit.html', error='短歌を入力してください'))
+    else:
+        user_embedding = None
+        if not EMBEDDING_WORKER_CONFIG['enabled']:
+            try:
+                user_embedding = await embed_text(user_tanka, task_type="retrieval_document")
+            except Exception as e:
+                print(f"Embedding Generation Error: {e}")
+
+        try:
+            result = await async_models.perform_exchange(user_id, user_tanka, embedding=user_embedding)
+        except async_models.ForeignKeyViolation:
+            # セッションの user_id が存在しない（DBの作り直し後）→ 解決し直して1回だけ再試行
+            user_id = await resolve_stale_user(session)
+            user_resolved = True
+            result = await async_models.perform_exchange(user_id, user_tanka, embedding=user_embedding)
+        if result is None:
+            response = HTMLResponse(render('submit.html', error='交換できる短歌がありません'))
+        else:
+            if user_embedding is None:
+                enqueue_embedding(result[2])
+            response = HTMLResponse(render('result.html', received_tanka=result[1]))
+
+    if modified or user_resolved:
+        save_session(response, session)
+    return response
+
+
+async def find_reference(user_embedding, user_id):
+    """main.find_reference_tanka の asyncio 版"""
+    ref_tanka_data = await async_models.search_tanka_semantically(user_embedding, exclude_user_id=user_id)
+    return ref_tanka_data or (None, FALLBACK_TANKA)
+
+
+async def lookup_cached_response(user_embedding, user_id):
+    """response_cache.lookup の asyncio 版（参考短歌の存在確認を asyncpg で行う）"""
+    cache = get_response_cache()
+    if cache is None:
+        return None
+    candidate = cache.match(user_embedding)
+    if candidate is None:
+        return None
+    tanka = await async_models.get_pool_tanka(candidate[1]['tanka_id'])
+    return cache.confirm(candidate, tanka, exclude_user_id=user_id)
+
+
+async def ai_consult(request):
+    """AI相談API（main.ai_consult の asyncio 版）"""
+    data = await request.json()
+    user_message = data.get('message', '')
+    session, modified = load_session(request)
+    user_id, user_resolved = await resolve_user(session)
+    client = get_generative_client()
+
+    body = {'response': FALLBACK_RESPONSE}
+    if not client.breaker.is_open():
+        try:
+            user_embedding = await embed_text(user_message, task_type="retrieval_query")
+            cached = await lookup_cached_response(user_embedding, user_id)
+            if cached:
+                body = {'response': cached['response'], 'cached': True}
+            else:
+                tanka_id, tanka_content = await find_reference(user_embedding, user_id)
+                ai_text = await client.generate_async(build_consult_prompt(user_message, tanka_content))
+                remember_response(user_embedding, tanka_id, tanka_content, ai_text)
+                body = {'response': ai_text}
+        except CircuitOpenError:
+            pass
+        except Exception as e:
+            import traceback
+            print(f"AI Error: {e}")
+            traceback.print_exc()
+
+    response = JSONResponse(body)
+    if modified or user_resolved:
+        save_session(response, session)
+    return response
+
+
+async def ai_consult_stream(request):
+    """AI相談API（ストリーミング版, main.ai_consult_stream の asyncio 版。イベントも同じ）"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    data = await request.json()
+    user_message = data.get('message', '')
+    session, modified = load_session(request)
+    user_id, user_resolved = await resolve_user(session)
+
+    def elapsed_ms():
+        return (loop.time() - started) * 1000
+
+    async def generate():
+        timings = {}
+        client = get_generative_client()
+        if client.breaker.is_open():
+            yield sse_event('error', {'response': FALLBACK_RESPONSE})
+            return
+        try:
+            user_embedding = await embed_text(user_message, task_type="retrieval_query")
+            cached = await lookup_cached_response(user_embedding, user_id)
+            if cached:
+                timings['ttfb_ms'] = timings['first_token_ms'] = elapsed_ms()
+                yield sse_event('reference', {'tanka': cached['tanka_content'], 'elapsed_ms': timings['ttfb_ms']})
+                yield sse_event('chunk', {'text': cached['response']})
+                timings['total_ms'] = elapsed_ms()
+                yield sse_event('done', dict(timings, cached=True))
+                record_stream_timings(timings)
+                return
+
+            tanka_id, tanka_content = await find_reference(user_embedding, user_id)
+            timings['ttfb_ms'] = elapsed_ms()
+            yield sse_event('reference', {'tanka': tanka_content, 'elapsed_ms': timings['ttfb_ms']})
+
+            pieces = []
+            completed = True
+            try:
+                async for text in client.stream_async(build_consult_prompt(user_message, tanka_content)):
+                    if not text:
+                        continue
+                    if 'first_token_ms' not in timings:
+                        timings['first_token_ms'] = elapsed_ms()
+                    pieces.append(text)
+                    yield sse_event('chunk', {'text': text})
+            except IncompleteGeneration as e:
+                # 出力上限・安全性フィルタで途中までになった応答は、表示はするがキャッシュしない
+                print(f"[!] 応答が途中で終わりました: {e}")
+                completed = False
+
+            timings['total_ms'] = elapsed_ms()
+            if completed:
+                remember_response(user_embedding, tanka_id, tanka_content, ''.join(pieces))
+            yield sse_event('done', timings)
+            record_stream_timings(timings)
+        except Exception as e:
+            import traceback
+            print(f"AI Error: {e}")
+            traceback.print_exc()
+            yield sse_event('error', {'response': FALLBACK_RESPONSE})
+
+    response = StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    if modified or user_resolved:
+        save_session(response, session)
+    return response
+
+
+async def api_metrics(request):
+    """性能カウンタを返すAPI（Flask側のカウンタ + asyncpg プール）"""
+    metrics = collect_metrics()
+    metrics['async_db'] = async_models.get_async_pool_stats()
+    return JSONResponse(metrics)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    try:
+        await async_models.init_async_pool()
+    except (OSError, asyncpg.PostgresError) as e:
+        # DB起動前でもサーバーは起動する（デスクトップ版は /healthz で準備完了を待つ）
+        print(f"[!] DB接続プールを作成できませんでした（最初の接続時に再試行します）: {e}")
+    try:
+        yield
+    finally:
+        await async_models.close_async_pool()
+
+
+asgi_app = Starlette(
+    routes=[
+        Route('/exchange', exchange, methods=['POST']),
+        Route('/api/ai-consult', ai_consult, methods=['POST']),
+        Route('/api/ai-consult/stream', ai_consult_stream, methods=['POST']),
+        Route('/api/metrics', api_metrics),
+        # それ以外は Flask アプリへ（Waitress と同じスレッド数で実行）
+        Mount('/', app=WSGIMiddleware(flask_app, workers=WAITRESS_THREADS)),
+    ],
+    lifespan=lifespan,
+)
+
+
+def serve_asgi(host='127.0.0.1', port=5000):
+    """uvicorn で ASGI アプリを起動（終了までブロック）"""
+    import uvicorn
+    uvicorn.run(asgi_app, host=host, port=port, access_log=False, log_level='warning')
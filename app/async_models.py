@@ -0,0 +1,262 @@
+"""
+async_models.py - 非同期DB操作（asyncpg）
+ASGIモード（app/asgi.py）のルートから使う、models.py の一部の asyncio 版
+
+- 接続プールは asyncpg のプール（イベントループ1つにつき1つ。起動時に init_async_pool()。
+  DB起動前で作成できなかった場合は、最初に接続を借りるときに作成する）
+- SQL は storage/postgres.py の同名関数と同じ（ベクトル探索はSQL・候補数の決め方も共有）。交換・削除後のキャッシュ無効化などのフックも同じものを呼ぶ
+- 埋め込みは pgvector のテキスト表現（'[0.1,0.2,...]'）で渡し、SQL側で $n::text::vector に変換する
+  （asyncpg は vector 型のエンコーダを持たないため）
+"""
+import asyncio
+import json
+import random
+import time
+
+import asyncpg
+
+from .config import DB_CONFIG, POOL_CONFIG, ASGI_CONFIG
+from .models import invalidate_pool_count
+from .vector_index import get_vector_index, on_tanka_saved, on_tanka_deleted
+from .storage import postgres
+from .storage.postgres import format_database_identity
+from .response_cache import on_tanka_removed
+
+_pool = None
+_pool_lock = None  # プール作成の排他（最初に使うイベントループ上で作る）
+_database_identity = None
+
+# 存在しない user_id での書き込み（DBを作り直した後に古いセッションが残っていた場合など）
+ForeignKeyViolation = asyncpg.ForeignKeyViolationError
+
+_stats = {
+    'queries': 0,
+    'acquire_wait_total': 0.0,  # 接続の空き待ち時間の合計（秒）
+    'acquire_wait_max': 0.0,
+}
+
+
+async def init_async_pool():
+    """asyncpg の接続プールを作成"""
+    global _pool, _pool_lock
+    if _pool is not None:
+        return _pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    # 作成の await 中に来た他のコルーチンが別のプールを作らないように、1つずつ作成する
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                host=DB_CONFIG['host'],
+                port=int(DB_CONFIG['port']),
+                database=DB_CONFIG['database'],
+                user=DB_CONFIG['user'],
+                password=DB_CONFIG['password'],
+                min_size=POOL_CONFIG['min_size'],
+                max_size=ASGI_CONFIG['db_pool_max'],
+            )
+    return _pool
+
+
+async def close_async_pool():
+    global _pool, _pool_lock
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+    _pool_lock = None
+
+
+class _Acquire:
+    """プールから接続を借りる（空き待ち時間を計測する）"""
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        self._pool = _pool or await init_async_pool()
+        self._conn = await self._pool.acquire(timeout=POOL_CONFIG['timeout'])
+        waited = time.perf_counter() - started
+        _stats['queries'] += 1
+        _stats['acquire_wait_total'] += waited
+        _stats['acquire_wait_max'] = max(_stats['acquire_wait_max'], waited)
+        return self._conn
+
+    async def __aexit__(self, *exc_info):
+        await self._pool.release(self._conn)
+
+
+def acquire():
+    return _Acquire()
+
+
+def to_vector_literal(embedding):
+    return '[' + ','.join(repr(float(x)) for x in embedding) + ']'
+
+
+def get_async_pool_stats():
+    """asyncpg プールの統計。未初期化なら None"""
+    if _pool is None:
+        return None
+    stats = dict(_stats)
+    stats['size'] = _pool.get_size()
+    stats['idle'] = _pool.get_idle_size()
+    stats['max_size'] = _pool.get_max_size()
+    stats['acquire_wait_avg'] = stats['acquire_wait_total'] / stats['queries'] if stats['queries'] else 0.0
+    return stats
+
+
+# ==================== ユーザー管理 ====================
+
+async def get_database_identity(refresh=False):
+    """models.get_database_identity の asyncio 版（同じ形式の識別子。プロセスで1回だけ問い合わせる）"""
+    global _database_identity
+    if _database_identity is None or refresh:
+        async with acquire() as conn:
+            row = await conn.fetchrow("SELECT current_database(), 'users'::regclass::oid")
+        _database_identity = format_database_identity(row[0], row[1])
+    return _database_identity
+
+async def get_or_create_user(session_id):
+    """models.get_or_create_user の asyncio 版"""
+    async with acquire() as conn:
+        return await conn.fetchval("""
+            INSERT INTO users(session_id) VALUES ($1)
+            ON CONFLICT (session_id) DO UPDATE SET session_id = EXCLUDED.session_id
+            RETURNING user_id
+        """, session_id)
+
+
+# ==================== ベクトル探索 ====================
+
+def numbered_placeholders():
+    """
+    storage.postgres.build_similarity_query 用の asyncpg のパラメータ（$1, $2, ...）
+    Returns: (placeholder 関数, 使われた順のパラメータ名のリスト)
+    """
+    names = []
+
+    def placeholder(name, cast=None):
+        if name not in names:
+            names.append(name)
+        number = names.index(name) + 1
+        if cast == 'vector':
+            return f"${number}::text::vector"
+        return f"${number}::{cast}" if cast else f"${number}"
+
+    return placeholder, names
+
+
+async def search_similar_tankas(embedding, limit=1, exclude_user_id=None, exact=False):
+    """
+    storage.postgres.search_similar_tankas の asyncio 版
+    SQL・候補数・厳密探索へのフォールバックは同期版と共通（同じ入力なら同じ結果）
+    Returns: [(id, content, distance), ...]
+    """
+    candidates = postgres.similarity_candidates(limit, exclude_user_id)
+    placeholder, names = numbered_placeholders()
+    sql = postgres.build_similarity_query(placeholder, exact)
+    params = {
+        'embedding': to_vector_literal(embedding),
+        'candidates': candidates,
+        'exclude_user_id': exclude_user_id or None,
+        'limit': limit,
+    }
+    async with acquire() as conn:
+        async with conn.transaction():
+            if exact:
+                await conn.execute("SELECT set_config('enable_indexscan', 'off', true)")
+            else:
+                await conn.execute(
+                    "SELECT set_config('hnsw.ef_search', $1, true), set_config('ivfflat.probes', $2, true)",
+                    *postgres.similarity_search_params(candidates)
+                )
+            rows = await conn.fetch(sql, *[params[name] for name in names])
+    results = [tuple(row) for row in rows]
+
+    if postgres.needs_exact_fallback(results, limit, exclude_user_id, exact):
+        exact_results = await search_similar_tankas(embedding, limit, exclude_user_id, exact=True)
+        if len(exact_results) > len(results):
+            return exact_results
+    return results
+
+
+async def search_tanka_semantically(embedding, exclude_user_id=None):
+    """
+    models.search_tanka_semantically の asyncio 版（最も近い1件）
+    Returns: (id, content) or None
+    """
+    index = get_vector_index()
+    if index is not None:
+        # プロセス内索引（行列積1回）はイベントループ上でそのまま計算する
+        results = index.search(embedding, 1, exclude_user_id)
+    else:
+        results = await search_similar_tankas(embedding, 1, exclude_user_id)
+    return results[0][:2] if results else None
+
+
+# ==================== 埋め込みキャッシュ・応答キャッシュ ====================
+
+async def load_cached_embedding(key):
+    """storage.postgres.load_cached_embedding の asyncio 版（無ければ None）"""
+    async with acquire() as conn:
+        text = await conn.fetchval(
+            "SELECT embedding::text FROM embedding_cache WHERE content_hash = $1", key
+        )
+    return json.loads(text) if text else None
+
+async def store_cached_embedding(key, model, task_type, embedding):
+    """storage.postgres.store_cached_embedding の asyncio 版"""
+    async with acquire() as conn:
+        await conn.execute("""
+            INSERT INTO embedding_cache(content_hash, model, task_type, embedding)
+            VALUES ($1, $2, $3, $4::text::vector)
+            ON CONFLICT (content_hash) DO NOTHING
+        """, key, model, task_type, to_vector_literal(embedding))
+
+async def get_pool_tanka(tanka_id):
+    """models.get_pool_tanka の asyncio 版（応答キャッシュのヒット確認用）"""
+    async with acquire() as conn:
+        row = await conn.fetchrow("SELECT id, content, user_id FROM tanka_pool WHERE id = $1", tanka_id)
+    return tuple(row) if row else None
+
+
+# ==================== 短歌交換 ====================
+
+def _build_exchange_query():
+    placeholder, names = numbered_placeholders()
+    return postgres.build_exchange_query(placeholder), names
+
+EXCHANGE_SQL, EXCHANGE_PARAMS = _build_exchange_query()
+
+
+async def perform_exchange(user_id, content, embedding=None):
+    """
+    models.perform_exchange の asyncio 版（同じ1ステートメントの交換。SQLは storage.postgres.build_exchange_query）
+    デッドロックで中断された場合の再試行も同期版と同じ
+    Returns: (received_tanka_id, received_content, given_tanka_id, exchange_id) or None
+    """
+    params = {
+        'user_id': user_id,
+        'content': content,
+        'embedding': to_vector_literal(embedding) if embedding is not None else None,
+    }
+    for attempt in range(postgres.EXCHANGE_DEADLOCK_RETRIES + 1):
+        try:
+            async with acquire() as conn:
+                async with conn.transaction():
+                    for start_key in (random.random(), 0.0):
+                        params['start_key'] = start_key
+                        row = await conn.fetchrow(EXCHANGE_SQL, *[params[name] for name in EXCHANGE_PARAMS])
+                        if row:
+                            break
+            break
+        except asyncpg.DeadlockDetectedError:
+            if attempt == postgres.EXCHANGE_DEADLOCK_RETRIES:
+                raise
+            await asyncio.sleep(random.uniform(0.005, 0.02) * (attempt + 1))
+    if not row:
+        return None
+
+    invalidate_pool_count()
+    on_tanka_deleted(row[0])
+    on_tanka_removed(row[0])
+    on_tanka_saved(row[2], user_id, content, embedding)
+    return tuple(row)
@@ -18,7 +18,137 @@ DB_CONFIG = {
     'password': os.getenv('DB_PASSWORD', 'password')
 }
 
+# 保存先: postgres（PostgreSQL + pgvector）/ sqlite（組み込みDB, app/storage/sqlite.py）
+# desktop_app.py は未指定で PostgreSQL の設定・接続が無ければ sqlite を使う（Docker不要）
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'postgres').lower()
+
+# SQLite の設定（STORAGE_BACKEND=sqlite の場合）
+SQLITE_CONFIG = {
+    'path': os.path.expanduser(os.getenv('SQLITE_PATH', '~/.tanka_exchange/tanka.db')),
+    # 他の接続が書き込み中のとき待つ最大秒数
+    'busy_timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', '10')),
+}
+
+# 起動時にDBへ接続できない場合、Docker（docker compose up -d）でDBを起動する（オプトイン）
+DOCKER_AUTOSTART = os.getenv('DOCKER_AUTOSTART', '0') == '1'
+
+# Waitressのワーカースレッド数（waitressのデフォルトは4）
+WAITRESS_THREADS = int(os.getenv('WAITRESS_THREADS', '4'))
+
+# server.py の起動設定
+SERVER_CONFIG = {
+    'host': os.getenv('SERVER_HOST', '127.0.0.1'),
+    'port': int(os.getenv('SERVER_PORT', '5000')),
+    # ワーカープロセス数（1 なら従来どおり単一プロセス、0 ならCPUコア数。fork の無い Windows では常に1）
+    'workers': int(os.getenv('SERVER_WORKERS', '1')),
+    # 停止・再起動時に処理中のリクエストを待つ最大秒数
+    'graceful_timeout': float(os.getenv('SERVER_GRACEFUL_TIMEOUT', '30')),
+    'backlog': int(os.getenv('SERVER_BACKLOG', '2048')),
+}
+
+# コネクションプール設定
+# 最大接続数はWaitressのスレッド数に合わせる（1リクエスト = 1スレッド = 最大1接続）
+POOL_CONFIG = {
+    'min_size': int(os.getenv('DB_POOL_MIN', '1')),
+    'max_size': int(os.getenv('DB_POOL_MAX', str(WAITRESS_THREADS))),
+    # 空き接続を待つ最大秒数（超えたらエラー）
+    'timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+    # この秒数以上アイドルだった接続は貸し出し前に SELECT 1 で生存確認
+    'health_check_interval': float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', '30')),
+}
+
+# get_pool_count() の結果をプロセス内にキャッシュする秒数
+# （同一プロセス内の交換では即座に無効化される。他プロセスの変更はこの秒数以内に反映）
+POOL_COUNT_CACHE_TTL = float(os.getenv('POOL_COUNT_CACHE_TTL', '5'))
+
+# /stats の全短歌一覧で1回に表示する件数（続きはスクロールで /api/tankas から読み込む）
+STATS_PAGE_SIZE = int(os.getenv('STATS_PAGE_SIZE', '50'))
+
+# 人気ランキング（tanka_popularity）を再集計する間隔（秒）
+# /stats の表示時に前回からこの秒数が経っていれば、バックグラウンドで再集計する（0 で毎回）
+POPULARITY_REFRESH_INTERVAL = float(os.getenv('POPULARITY_REFRESH_INTERVAL', '60'))
+
+# ベクトル索引設定（tanka_pool.embedding）
+# type: hnsw / ivfflat / none（none の場合は常に全件スキャン）
+VECTOR_INDEX_CONFIG = {
+    'type': os.getenv('VECTOR_INDEX_TYPE', 'hnsw').lower(),
+    'hnsw_m': int(os.getenv('HNSW_M', '16')),
+    'hnsw_ef_construction': int(os.getenv('HNSW_EF_CONSTRUCTION', '64')),
+    'ivfflat_lists': int(os.getenv('IVFFLAT_LISTS', '100')),
+}
+
+# ベクトル探索のクエリ単位の精度パラメータ（大きいほど高精度・低速）
+VECTOR_SEARCH_CONFIG = {
+    'ef_search': int(os.getenv('HNSW_EF_SEARCH', '40')),
+    'probes': int(os.getenv('IVFFLAT_PROBES', '10')),
+}
+
+# ベクトル探索の実行場所: pgvector（DB内）/ memory（プロセス内NumPy索引, app/vector_index.py）
+# STORAGE_BACKEND=sqlite の場合は常に memory
+VECTOR_SEARCH_BACKEND = 'memory' if STORAGE_BACKEND == 'sqlite' else os.getenv('VECTOR_SEARCH_BACKEND', 'pgvector').lower()
+
+# 埋め込みの生成元: gemini（Google API）/ local（オフラインの文字n-gram埋め込み, app/embeddings.py）
+EMBEDDING_PROVIDER = os.getenv('EMBEDDING_PROVIDER', 'gemini').lower()
+
+# 埋め込みキャッシュ設定（app/embedding_cache.py）
+EMBEDDING_CACHE_CONFIG = {
+    'max_size': int(os.getenv('EMBEDDING_CACHE_SIZE', '1024')),     # メモリ上のLRU件数
+    'use_db': os.getenv('EMBEDDING_CACHE_DB', '1') == '1',            # embedding_cache テーブルも使う
+}
+
+# 埋め込み生成のバックグラウンドワーカー設定（app/embedding_worker.py）
+EMBEDDING_WORKER_CONFIG = {
+    # 0 にすると /exchange の中で同期的に埋め込みを生成する（従来の動作）
+    'enabled': os.getenv('EMBEDDING_WORKER', '1') == '1',
+    'batch_size': int(os.getenv('EMBEDDING_BATCH_SIZE', '16')),
+    'max_retries': int(os.getenv('EMBEDDING_MAX_RETRIES', '5')),
+    # 埋め込み未生成の行を探して再投入する間隔（秒）
+    'sweep_interval': float(os.getenv('EMBEDDING_SWEEP_INTERVAL', '300')),
+}
+
+# AI歌人の文章生成クライアント設定（app/generative_client.py）
+GENERATIVE_CONFIG = {
+    'model': os.getenv('GENAI_MODEL', 'gemini-flash-latest'),
+    # 1回の生成を待つ最大秒数（超えたらフォールバック応答）
+    'timeout': float(os.getenv('GENAI_TIMEOUT', '15')),
+    # 応答がこのパーセンタイルのレイテンシを超えたら2本目を送る（0 でヘッジしない）
+    'hedge_percentile': float(os.getenv('GENAI_HEDGE_PERCENTILE', '95')),
+    # ヘッジを始めるのに必要なレイテンシのサンプル数
+    'hedge_min_samples': int(os.getenv('GENAI_HEDGE_MIN_SAMPLES', '20')),
+    # 連続でこの回数失敗したら reset_timeout 秒間は呼び出さずに即フォールバック
+    'failure_threshold': int(os.getenv('GENAI_BREAKER_THRESHOLD', '5')),
+    'reset_timeout': float(os.getenv('GENAI_BREAKER_RESET', '30')),
+    # 上流への呼び出しを実行するスレッド数（ヘッジで1リクエストが最大2本使うため、既定はワーカースレッド数 × 2）
+    'max_workers': int(os.getenv('GENAI_MAX_WORKERS', str(WAITRESS_THREADS * 2))),
+    # 0 より大きいとAPIを呼ばず、この秒数待って定型文を返す（サーバー方式のベンチマーク用）
+    'fake_latency': float(os.getenv('GENAI_FAKE_LATENCY', '0')),
+}
+
+# AI歌人の応答の意味的キャッシュ設定（app/response_cache.py）
+RESPONSE_CACHE_CONFIG = {
+    'enabled': os.getenv('RESPONSE_CACHE', '1') == '1',
+    # 相談文の埋め込みのコサイン類似度がこの値以上なら同じ相談とみなす
+    'threshold': float(os.getenv('RESPONSE_CACHE_THRESHOLD', '0.92')),
+    'ttl': float(os.getenv('RESPONSE_CACHE_TTL', '3600')),        # 有効秒数
+    'max_size': int(os.getenv('RESPONSE_CACHE_SIZE', '512')),     # 保持する件数
+}
+
+# サーバー方式: waitress（WSGI, スレッド）/ asgi（uvicorn + asyncio, app/asgi.py）
+SERVER_MODE = os.getenv('SERVER_MODE', 'waitress').lower()
+
+# ASGIモードは asyncpg（PostgreSQL）を使うため、SQLite の場合は Waitress で起動する
+if STORAGE_BACKEND == 'sqlite':
+    SERVER_MODE = 'waitress'
+
+# ASGIモードの設定
+ASGI_CONFIG = {
+    # asyncpg の最大接続数（スレッド数に縛られないため Waitress より多めに取る）
+    'db_pool_max': int(os.getenv('ASGI_DB_POOL_MAX', '20')),
+    # 埋め込みAPI（同期SDK）の呼び出しを逃がすスレッド数（DBには触れないので psycopg2 のプールとは無関係）
+    'sync_threads': int(os.getenv('ASGI_SYNC_THREADS', '32')),
+}
+
 def get_db_connection():
-    """PostgreSQL接続を取得"""
+    """PostgreSQL接続を取得（プールを介さない単発接続。スクリプト用）"""
     conn = psycopg2.connect(**DB_CONFIG)
     return conn
@@ -0,0 +1,271 @@
+"""
+db_pool.py - PostgreSQLコネクションプール
+リクエストごとに psycopg2.connect() すると TCP接続 + 認証のコストが毎回かかるため、
+接続を使い回すスレッドセーフなプールを提供する
+
+- 最大接続数は Waitress のスレッド数に合わせる（config.POOL_CONFIG）
+- 貸し出し時に生存確認（一定時間アイドルだった接続は SELECT 1）
+- 切断された接続は破棄し、次回の貸し出しで再接続
+- 待ち時間・飽和回数などのカウンタを get_pool_stats() で取得可能
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from .config import DB_CONFIG, POOL_CONFIG
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """プールの空き待ちがタイムアウトした"""
+
+
+class ConnectionPool:
+    """
+    スレッドセーフなコネクションプール
+
+    psycopg2.pool.ThreadedConnectionPool は上限に達すると即座に例外を投げるため、
+    空きが出るまで待機する（timeout付き）独自実装としている
+    """
+
+    def __init__(self, min_size=1, max_size=4, timeout=10.0, health_check_interval=30.0):
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, 最終返却時刻), ...]
+        self._size = 0           # 開いている接続数（アイドル + 貸し出し中）
+        self._in_use = 0
+        self.pid = os.getpid()
+
+        self._stats = {
+            'checkouts': 0,          # 貸し出し回数
+            'waits': 0,              # 空きが無く待たされた回数（飽和）
+            'wait_time_total': 0.0,  # 貸し出しまでの待ち時間合計（秒）
+            'wait_time_max': 0.0,
+            'timeouts': 0,           # 待ちタイムアウト回数
+            'connections_opened': 0,
+            'reconnects': 0,         # 生存確認に失敗して張り直した回数
+            'discarded': 0,          # 壊れていたため破棄した接続数
+            'peak_in_use': 0,
+        }
+
+        for _ in range(min(min_size, self.max_size)):
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                # DB未起動でもプール生成自体は成功させる（接続は遅延生成）
+                break
+            self._size += 1
+            self._idle.append((conn, time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**DB_CONFIG)
+        with self._cond:
+            self._stats['connections_opened'] += 1
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        """貸し出し前の生存確認"""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            finally:
+                cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """接続を借りる（空きが無ければ timeout 秒まで待機）"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # 新規接続枠を確保（接続自体はロック外で行う）
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                if not waited:
+                    waited = True
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        f"コネクションプールの空き待ちがタイムアウトしました（{self.timeout}秒, 最大{self.max_size}接続）"
+                    )
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+            self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._in_use)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif not self._is_healthy(conn, last_used):
+                self._close_quietly(conn)
+                conn = self._connect()
+                with self._cond:
+                    self._stats['reconnects'] += 1
+        except Exception:
+            # 接続に失敗した場合は確保していた枠を返す
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        wait_time = time.monotonic() - started
+        with self._cond:
+            self._stats['wait_time_total'] += wait_time
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """接続を返却（壊れている接続、discard=True の接続は破棄）"""
+        if not discard and not conn.closed:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # コミットされなかったトランザクションは巻き戻してから返す
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        if conn.closed:
+            discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+                self._stats['discarded'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+        if discard:
+            self._close_quietly(conn)
+
+    def closeall(self):
+        """アイドル接続をすべて閉じる"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def stats(self):
+        """プールの統計情報"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'max_size': self.max_size,
+            })
+        checkouts = stats['checkouts']
+        stats['wait_time_avg'] = stats['wait_time_total'] / checkouts if checkouts else 0.0
+        # 飽和率: 貸し出し要求のうち空き待ちになった割合
+        stats['saturation_ratio'] = stats['waits'] / checkouts if checkouts else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """プロセス共通のプールを取得（初回呼び出し時に生成）"""
+    global _pool
+    pool = _pool
+    # fork後の子プロセスでは親の接続を使い回さず、新しいプールを作る
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(**POOL_CONFIG)
+        return _pool
+
+
+def close_pool():
+    """
+    このプロセスのプールの接続をすべて閉じる
+    （マルチプロセス起動時、fork前に親の接続を閉じておき、子が同じ接続を共有しないようにする）
+    """
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and pool.pid == os.getpid():
+        pool.closeall()
+
+
+def get_pool_stats():
+    """プールの統計情報を取得（未生成なら None）"""
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        return None
+    return pool.stats()
+
+
+@contextmanager
+def db_connection():
+    """
+    プールから接続を借りるコンテキストマネージャ
+    with を抜けると自動で返却（未コミットのトランザクションはロールバック）
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # ソケット切断などの接続エラー: この接続は破棄し、次回は張り直す
+        discard = True
+        raise
+    finally:
+        pool.putconn(conn, discard=discard)
+
+
+@contextmanager
+def db_cursor(commit=False):
+    """
+    プールの接続からカーソルを取得するコンテキストマネージャ
+    commit=True の場合、正常終了時にコミットする
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            if commit:
+                conn.commit()
+        finally:
+            cursor.close()
@@ -0,0 +1,142 @@
+"""
+embedding_cache.py - 埋め込みベクトルのキャッシュ
+同じ文章（再投稿された短歌、繰り返される相談文）の埋め込みAPI呼び出しを省略する
+
+キー: 正規化した本文 + モデル名 + task_type の SHA-256
+- 1段目: プロセス内LRU（件数上限つき）
+- 2段目: DB の embedding_cache テーブル（再起動・他プロセスとも共有。保存先は app/storage）
+"""
+import array
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from .config import EMBEDDING_CACHE_CONFIG
+from .storage import backend
+
+
+def normalize_text(text):
+    """キャッシュキー用の正規化（全角/半角の統一、各行の前後空白・空行の除去）"""
+    text = unicodedata.normalize('NFKC', text)
+    lines = [line.strip() for line in text.splitlines()]
+    return '\n'.join(line for line in lines if line)
+
+
+def content_key(text, model, task_type):
+    """正規化済み本文・モデル名・task_type からキャッシュキーを作る"""
+    payload = f"{model}\0{task_type}\0{text}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """LRU（メモリ）+ DB の2段キャッシュ"""
+
+    def __init__(self, max_size=1024, use_db=True):
+        self.max_size = max_size
+        self.use_db = use_db
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> array('f')（listより省メモリ）
+        self._stats = {
+            'memory_hits': 0,
+            'db_hits': 0,
+            'misses': 0,
+            'db_errors': 0,
+            'miss_latency_total': 0.0,  # キャッシュミス時のAPI呼び出し時間の合計（秒）
+        }
+
+    def _remember(self, key, embedding):
+        with self._lock:
+            self._entries[key] = array.array('f', embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_memory(self, key):
+        """1段目（メモリ）だけを引く（無ければ None。ミスとしては数えない）"""
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                return None
+            self._entries.move_to_end(key)
+            self._stats['memory_hits'] += 1
+            return list(cached)
+
+    def remember_db_hit(self, key, embedding):
+        """2段目（DB）で見つかったものをメモリに載せる"""
+        self._remember(key, embedding)
+        with self._lock:
+            self._stats['db_hits'] += 1
+
+    def record_miss(self):
+        with self._lock:
+            self._stats['misses'] += 1
+
+    def record_db_error(self, error):
+        # キャッシュ層の障害で埋め込み自体を失敗させない
+        print(f"Embedding Cache Error: {error}")
+        with self._lock:
+            self._stats['db_errors'] += 1
+
+    def remember(self, key, embedding, latency=0.0):
+        """生成した埋め込みをメモリに保存（DBへの保存は呼び出し側。ASGIモードは asyncpg で保存する）"""
+        self._remember(key, embedding)
+        with self._lock:
+            self._stats['miss_latency_total'] += latency
+
+    def get(self, key):
+        """キャッシュから取得（無ければ None）"""
+        embedding = self.get_memory(key)
+        if embedding is not None:
+            return embedding
+
+        if self.use_db:
+            try:
+                embedding = backend.load_cached_embedding(key)
+            except backend.DatabaseError as e:
+                self.record_db_error(e)
+                embedding = None
+            if embedding is not None:
+                self.remember_db_hit(key, embedding)
+                return embedding
+
+        self.record_miss()
+        return None
+
+    def put(self, key, model, task_type, embedding, latency=0.0):
+        """キャッシュに保存（latency はAPI呼び出しにかかった秒数。節約時間の推定に使う）"""
+        self.remember(key, embedding, latency=latency)
+        if not self.use_db:
+            return
+        try:
+            backend.store_cached_embedding(key, model, task_type, embedding)
+        except backend.DatabaseError as e:
+            self.record_db_error(e)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        stats['max_size'] = self.max_size
+        hits = stats['memory_hits'] + stats['db_hits']
+        lookups = hits + stats['misses']
+        stats['hit_ratio'] = hits / lookups if lookups else 0.0
+        # 節約できた時間 ≒ ヒット数 × ミス時の平均API時間
+        average_miss = stats['miss_latency_total'] / stats['misses'] if stats['misses'] else 0.0
+        stats['miss_latency_avg'] = average_miss
+        stats['saved_seconds_estimate'] = hits * average_miss
+        return stats
+
+
+_cache = EmbeddingCache(
+    max_size=EMBEDDING_CACHE_CONFIG['max_size'],
+    use_db=EMBEDDING_CACHE_CONFIG['use_db'],
+)
+
+
+def get_embedding_cache():
+    return _cache
+
+
+def get_embedding_cache_stats():
+    return _cache.stats()
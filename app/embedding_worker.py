@@ -0,0 +1,167 @@
+"""
+embedding_worker.py - 埋め込み生成のバックグラウンドワーカー
+/exchange のレスポンスを埋め込みAPIの応答待ちから切り離すため、
+交換をコミットした後に新しい tanka_pool.id をキューに積み、別スレッドでまとめて埋め込む
+
+- キューに溜まったIDを最大 batch_size 件ずつバッチでAPIに送る
+- APIエラー時は指数バックオフ（ジッター付き）で再試行
+- 一定間隔で embedding IS NULL の行を探して再投入（失敗分・他プロセス分・初期データの取りこぼし対策）
+  キューが空かどうかに関係なく sweep_interval ごとに行い、ワーカーはアプリの起動時に開始する
+  （交換が無くても、前回の異常終了・失敗したバッチで残った行を拾う）
+"""
+import os
+import queue
+import random
+import threading
+import time
+
+from .config import EMBEDDING_WORKER_CONFIG
+
+
+class EmbeddingWorker:
+    """埋め込み生成ワーカー（デーモンスレッド1本）"""
+
+    def __init__(self, batch_size=16, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 sweep_interval=300.0, sweep_limit=1000):
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sweep_interval = sweep_interval
+        self.sweep_limit = sweep_limit
+
+        self._queue = queue.Queue()
+        self._pending = set()  # キュー内のID（重複投入を防ぐ）
+        self._lock = threading.Lock()
+        self._thread = None
+        self.pid = None
+        self._stats = {
+            'enqueued': 0,
+            'embedded': 0,
+            'batches': 0,
+            'retries': 0,
+            'gave_up': 0,       # 再試行しても失敗したID数（次回の掃除で再投入される）
+            'last_error': None,
+        }
+
+    def start(self):
+        """ワーカースレッドを起動（起動済みなら何もしない。fork後の子プロセスでは起動し直す）"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='embedding-worker', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, tanka_id):
+        """埋め込みが必要な短歌IDを登録"""
+        with self._lock:
+            if tanka_id in self._pending:
+                return
+            self._pending.add(tanka_id)
+            self._stats['enqueued'] += 1
+        self._queue.put(tanka_id)
+
+    def _run(self):
+        self._sweep()
+        last_sweep = time.monotonic()
+        while True:
+            # キューに投入が続いていても掃除が止まらないよう、前回の掃除からの経過時間で判定する
+            if time.monotonic() - last_sweep >= self.sweep_interval:
+                self._sweep()
+                last_sweep = time.monotonic()
+            try:
+                first = self._queue.get(timeout=max(0.0, last_sweep + self.sweep_interval - time.monotonic()))
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._process(batch)
+            except Exception as e:
+                # ワーカースレッドは止めない（未処理分は次回の掃除で拾う）
+                print(f"Embedding Worker Error: {e}")
+                with self._lock:
+                    self._stats['last_error'] = str(e)
+            finally:
+                with self._lock:
+                    self._pending.difference_update(batch)
+
+    def _sweep(self):
+        """埋め込み未生成の行をキューに積む"""
+        from .models import get_tankas_without_embeddings
+        try:
+            rows = get_tankas_without_embeddings(limit=self.sweep_limit)
+        except Exception as e:
+            print(f"Embedding Worker Error: {e}")
+            return
+        for tanka_id, _ in rows:
+            self.enqueue(tanka_id)
+
+    def _process(self, tanka_ids):
+        from .embeddings import embed_texts
+        from .models import get_tankas_without_embeddings, update_tanka_embedding
+
+        # 処理待ちの間に削除（交換）された行・生成済みの行は除く
+        rows = get_tankas_without_embeddings(tanka_ids=tanka_ids)
+        if not rows:
+            return
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                embeddings = embed_texts([content for _, content in rows], task_type="retrieval_document")
+                break
+            except Exception as e:
+                with self._lock:
+                    self._stats['last_error'] = str(e)
+                if attempt == self.max_retries:
+                    print(f"Embedding Worker Error: {len(rows)}件の埋め込みを断念しました: {e}")
+                    with self._lock:
+                        self._stats['gave_up'] += len(rows)
+                    return
+                delay = min(self.base_delay * (2 ** attempt), self.max_delay)
+                with self._lock:
+                    self._stats['retries'] += 1
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+        for (tanka_id, _), embedding in zip(rows, embeddings):
+            update_tanka_embedding(tanka_id, embedding)
+        with self._lock:
+            self._stats['embedded'] += len(rows)
+            self._stats['batches'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._pending)
+            stats['running'] = self._thread is not None and self._thread.is_alive() and self.pid == os.getpid()
+        return stats
+
+
+_worker = EmbeddingWorker(
+    batch_size=EMBEDDING_WORKER_CONFIG['batch_size'],
+    max_retries=EMBEDDING_WORKER_CONFIG['max_retries'],
+    sweep_interval=EMBEDDING_WORKER_CONFIG['sweep_interval'],
+)
+
+
+def start_embedding_worker():
+    """ワーカーを起動（EMBEDDING_WORKER=0 なら何もしない。起動処理から呼ぶ）"""
+    if EMBEDDING_WORKER_CONFIG['enabled']:
+        _worker.start()
+
+
+def enqueue_embedding(tanka_id):
+    """短歌IDを埋め込み待ちに登録（ワーカーが未起動なら起動）"""
+    _worker.start()
+    _worker.enqueue(tanka_id)
+
+
+def get_embedding_worker_stats():
+    return _worker.stats()
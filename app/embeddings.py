@@ -0,0 +1,154 @@
+"""
+embeddings.py - 埋め込みベクトル生成
+埋め込みの生成元（プロバイダ）を差し替え可能にし、キャッシュ（embedding_cache.py）を経由させる
+
+プロバイダ（EMBEDDING_PROVIDER で選択）:
+- gemini: Google Gemini の text-embedding-004（ネットワーク必須）
+- local:  文字n-gramのハッシュを768次元に射影する決定的な埋め込み（オフライン・高速。
+          テスト・ベンチマーク・ネットワークの無い環境向け。意味の近さは文字の重なりで近似）
+"""
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # numpy が無い場合、local プロバイダは純Pythonで計算する
+    np = None
+
+from .config import EMBEDDING_PROVIDER
+from .embedding_cache import get_embedding_cache, normalize_text, content_key
+from .genai_loader import get_genai
+
+DIMENSIONS = 768
+
+
+class EmbeddingProvider:
+    """埋め込みプロバイダの基底クラス"""
+
+    # キャッシュキーに含めるモデル名（プロバイダを切り替えても混ざらない）
+    model_name = None
+    dimensions = DIMENSIONS
+
+    def embed(self, texts, task_type):
+        """
+        texts: 文章のリスト / task_type: "retrieval_document" or "retrieval_query"
+        Returns: [[float, ...], ...]（texts と同じ順序）
+        """
+        raise NotImplementedError
+
+
+class GeminiEmbeddingProvider(EmbeddingProvider):
+    """Google Gemini の埋め込みAPI"""
+
+    # text-embedding-004 を使用 (768次元)
+    model_name = "models/text-embedding-004"
+
+    def __init__(self, api_key=None):
+        self._genai = get_genai()
+        if api_key:
+            self._genai.configure(api_key=api_key)
+
+    def embed(self, texts, task_type):
+        # content にリストを渡すとバッチで処理される
+        result = self._genai.embed_content(
+            model=self.model_name,
+            content=list(texts),
+            task_type=task_type
+        )
+        return result['embedding']
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    文字n-gram（1〜3文字）の特徴ハッシングによるローカル埋め込み
+    各n-gramを CRC32 で768次元のどこか1つに割り当て、ハッシュの上位ビットで ±1 を決めて加算し、
+    最後にL2正規化する。同じ文章からは常に同じベクトルが得られる。
+    """
+
+    model_name = "local/char-ngram-768"
+
+    def __init__(self, ngram_range=(1, 3)):
+        self.ngram_range = ngram_range
+
+    def _features(self, text):
+        """n-gram のハッシュ値の一覧"""
+        hashes = []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(len(text) - n + 1):
+                hashes.append(zlib.crc32(text[i:i + n].encode('utf-8')))
+        return hashes
+
+    def embed(self, texts, task_type):
+        # task_type によらず同じ空間に埋め込む（文書とクエリで共通）
+        embeddings = []
+        for text in texts:
+            hashes = self._features(text)
+            if np is not None:
+                hashes = np.asarray(hashes, dtype=np.uint32)
+                signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+                vector = np.bincount(hashes % self.dimensions, weights=signs, minlength=self.dimensions)
+                norm = np.linalg.norm(vector)
+                embeddings.append((vector / norm if norm > 0 else vector).tolist())
+            else:
+                vector = [0.0] * self.dimensions
+                for h in hashes:
+                    vector[h % self.dimensions] += -1.0 if h & 0x80000000 else 1.0
+                norm = sum(x * x for x in vector) ** 0.5 or 1.0
+                embeddings.append([x / norm for x in vector])
+        return embeddings
+
+
+PROVIDERS = {
+    'gemini': GeminiEmbeddingProvider,
+    'local': LocalEmbeddingProvider,
+}
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_embedding_provider():
+    """設定（EMBEDDING_PROVIDER）で選ばれたプロバイダを取得（初回に生成）"""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                if EMBEDDING_PROVIDER not in PROVIDERS:
+                    raise ValueError(f"未知の EMBEDDING_PROVIDER です: {EMBEDDING_PROVIDER}")
+                _provider = PROVIDERS[EMBEDDING_PROVIDER]()
+    return _provider
+
+
+def embed_text(text, task_type):
+    """
+    文章を埋め込みベクトルに変換（キャッシュ済みならAPIを呼ばない）
+    task_type: "retrieval_document"（短歌の登録）/ "retrieval_query"（相談文の検索）
+    Returns: [float, ...]（768次元）
+    """
+    return embed_texts([text], task_type)[0]
+
+
+def embed_texts(texts, task_type):
+    """
+    複数の文章をまとめて埋め込みベクトルに変換
+    キャッシュに無いものだけを1回のバッチ呼び出しで生成する
+    Returns: [[float, ...], ...]（texts と同じ順序）
+    """
+    provider = get_embedding_provider()
+    texts = [normalize_text(text) for text in texts]
+    cache = get_embedding_cache()
+    keys = [content_key(text, provider.model_name, task_type) for text in texts]
+
+    embeddings = [cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+
+    started = time.perf_counter()
+    generated = provider.embed([texts[i] for i in missing], task_type)
+    latency = (time.perf_counter() - started) / len(missing)
+    for i, embedding in zip(missing, generated):
+        embeddings[i] = embedding
+        cache.put(keys[i], provider.model_name, task_type, embedding, latency=latency)
+    return embeddings
@@ -0,0 +1,29 @@
+"""
+genai_loader.py - google.generativeai の遅延読み込み
+google.generativeai は grpc / protobuf を読み込むため、import だけで起動時間とメモリを使う。
+AIを使うリクエストが来るまで読み込まないよう、利用箇所はすべて get_genai() を経由する
+"""
+import os
+import threading
+
+_genai = None
+_lock = threading.Lock()
+
+
+def get_genai():
+    """google.generativeai を読み込み、APIキーを設定して返す（初回のみ読み込み）"""
+    global _genai
+    if _genai is None:
+        with _lock:
+            if _genai is None:
+                import google.generativeai as genai
+                api_key = os.getenv("GENAI_API_KEY")
+                if api_key:
+                    genai.configure(api_key=api_key)
+                _genai = genai
+    return _genai
+
+
+def is_genai_loaded():
+    """読み込み済みか（起動時間の計測・デバッグ用）"""
+    return _genai is not None
@@ -0,0 +1,531 @@
+"""
+generative_client.py - 文章生成モデル（Gemini）の呼び出しクライアント
+AI歌人の応答生成を、リクエストごとのモデル生成・無期限待ちから切り離す
+
+- モデルはプロセスで1つだけ生成して使い回す
+- 1回の呼び出しに期限（deadline）を設け、超えたら待つのをやめてエラーにする
+  （期限は上流の呼び出しを始めた時点から数える。実行スレッドの空き待ちは上流の遅延に数えない）
+  （Waitressのワーカースレッドが上流の遅延に巻き込まれて塞がらない）
+- サーキットブレーカー: 連続して失敗したら一定時間は呼び出さずに即失敗させ、
+  呼び出し側は待たずにフォールバック応答を返せる。時間が経ったら1件だけ試して復帰を判断
+- ヘッジ: 応答がレイテンシの上位パーセンタイル（既定 p95）を超えたら2本目を送り、早い方を使う
+- 同期版（generate / stream）と asyncio 版（generate_async / stream_async, app/asgi.py 用）で
+  ブレーカー・統計を共有する
+"""
+import asyncio
+import inspect
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .config import GENERATIVE_CONFIG
+from .genai_loader import get_genai
+
+# レイテンシ分布のバケット境界（ミリ秒）
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class GenerationError(Exception):
+    """文章生成の失敗（呼び出し側はフォールバック応答に切り替える）"""
+
+
+class GenerationTimeout(GenerationError):
+    """期限までに応答が返らなかった"""
+
+
+class CircuitOpenError(GenerationError):
+    """サーキットブレーカーが開いているため呼び出さなかった"""
+
+
+# stream() の読み込みスレッドが最後にキューへ入れる終端の印
+_STREAM_END = object()
+
+
+class IncompleteGeneration(GenerationError):
+    """ストリームが STOP 以外の理由（出力上限・安全性フィルタなど）で終わった（断片は送信済み）"""
+
+
+def _finish_reason(chunk):
+    """ストリームの断片の終了理由の名前（最後の断片以外・取得できない場合は None）"""
+    try:
+        reason = chunk.candidates[0].finish_reason
+    except (AttributeError, IndexError):
+        return None
+    name = getattr(reason, 'name', None) or str(reason)
+    return None if name in ('FINISH_REASON_UNSPECIFIED', '0') else name
+
+
+class CircuitBreaker:
+    """
+    連続失敗数で開閉するサーキットブレーカー
+    closed: 通常 / open: 即失敗（reset_timeout 秒間）/ half_open: 1件だけ試行
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._stats = {'opened': 0, 'rejected': 0}
+
+    def allow(self):
+        """呼び出してよいか（open 中は False）"""
+        with self._lock:
+            if self._state == 'open':
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self._stats['rejected'] += 1
+                    return False
+                self._state = 'half_open'
+                self._trial_in_flight = False
+            if self._state == 'half_open':
+                if self._trial_in_flight:
+                    self._stats['rejected'] += 1
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def is_open(self):
+        """open 中（reset_timeout 経過前）か。呼び出し前に重い準備処理を省くために使う"""
+        with self._lock:
+            return self._state == 'open' and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self._state = 'closed'
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """half_open の試行が成否不明のまま打ち切られたとき、次の試行を許す"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == 'half_open' or self._failures >= self.failure_threshold:
+                if self._state != 'open':
+                    self._stats['opened'] += 1
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['state'] = self._state
+            stats['consecutive_failures'] = self._failures
+            if self._state == 'open':
+                stats['retry_in'] = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+        return stats
+
+
+class LatencyRecorder:
+    """成功した呼び出しのレイテンシを記録（バケット別の件数 + 直近のサンプルからパーセンタイル）"""
+
+    def __init__(self, window=200):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=window)
+        self._buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            self._recent.append(seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS_MS):
+                if ms <= bound:
+                    self._buckets[i] += 1
+                    break
+            else:
+                self._buckets[-1] += 1
+
+    def percentile(self, p, min_samples=1):
+        """直近のサンプルの p パーセンタイル（秒）。サンプル不足なら None"""
+        with self._lock:
+            samples = sorted(self._recent)
+        if len(samples) < max(min_samples, 1):
+            return None
+        return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+    def stats(self):
+        with self._lock:
+            buckets = list(self._buckets)
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            'histogram': dict(zip(labels, buckets)),
+            'p50_ms': self._percentile_ms(50),
+            'p95_ms': self._percentile_ms(95),
+            'p99_ms': self._percentile_ms(99),
+        }
+
+    def _percentile_ms(self, p):
+        value = self.percentile(p)
+        return value * 1000 if value is not None else None
+
+
+FAKE_RESPONSE = "（ベンチマーク用の応答です）<div class='ref-tanka'>春過ぎて<br>夏来にけらし</div>"
+
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class _FakeAsyncStream:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeModel:
+    """APIを呼ばず、latency 秒待って定型文を返すモデル（GENAI_FAKE_LATENCY, ベンチマーク用）"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        time.sleep(self.latency)
+        response = _FakeResponse(FAKE_RESPONSE)
+        return [response] if stream else response
+
+    async def generate_content_async(self, prompt, stream=False, request_options=None):
+        await asyncio.sleep(self.latency)
+        response = _FakeResponse(FAKE_RESPONSE)
+        return _FakeAsyncStream([response]) if stream else response
+
+
+class _UpstreamCall:
+    """実行スレッドで上流の呼び出しを始めた時刻（空き待ちの間は未設定）"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.started_at = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.started.set()
+
+
+class GenerativeClient:
+    """期限・ヘッジ・サーキットブレーカーつきの文章生成クライアント（同期 / asyncio の両方から使える）"""
+
+    def __init__(self, model_name, timeout=15.0, hedge_percentile=95, hedge_min_samples=20,
+                 failure_threshold=5, reset_timeout=30.0, max_workers=8, fake_latency=0.0):
+        """max_workers: 上流を呼び出すスレッド数（同時リクエスト数 × 2 が目安。ヘッジで2本使うため）"""
+        self.model_name = model_name
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.fake_latency = fake_latency
+        self.max_workers = max_workers
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency = LatencyRecorder()
+        # 上流への呼び出しを実行するスレッド（期限切れで見捨てた呼び出しもここで完了まで走る）
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='genai')
+        self._model = None
+        self._model_kwargs = None
+        self._model_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stats = {
+            'calls': 0,
+            'successes': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'queue_timeouts': 0,  # 実行スレッドの空きを待つうちに期限が過ぎた回数（上流の失敗には数えない）
+            'hedged': 0,      # 2本目を送った回数
+            'hedge_wins': 0,  # 2本目の方が先に返った回数
+        }
+
+    def _get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    if self.fake_latency:
+                        self._model = FakeModel(self.fake_latency)
+                    else:
+                        self._model = get_genai().GenerativeModel(self.model_name)
+        return self._model
+
+    def _request_kwargs(self):
+        """
+        上流の待ち時間の上限（request_options の timeout）
+        google-generativeai 0.3 系の generate_content は request_options を受け付けず
+        （未知の引数としてリクエスト生成で失敗する）、その場合は渡さない（期限は呼び出し側の待機で守る）
+        """
+        if self._model_kwargs is None:
+            parameters = inspect.signature(self._get_model().generate_content).parameters
+            self._model_kwargs = (
+                {'request_options': {'timeout': self.timeout}} if 'request_options' in parameters else {}
+            )
+        return self._model_kwargs
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _begin(self):
+        if not self.breaker.allow():
+            raise CircuitOpenError("生成APIのサーキットブレーカーが開いています")
+        self._count('calls')
+
+    def _hedge_delay(self):
+        """2本目を送るまでの秒数（ヘッジしない場合は None）"""
+        if not self.hedge_percentile:
+            return None
+        hedge_after = self.latency.percentile(self.hedge_percentile, self.hedge_min_samples)
+        if hedge_after is None or hedge_after >= self.timeout:
+            return None
+        return hedge_after
+
+    def _succeeded(self, seconds, hedge_won=False):
+        self.latency.record(seconds)
+        self.breaker.record_success()
+        self._count('successes')
+        if hedge_won:
+            self._count('hedge_wins')
+
+    def _failed(self, error):
+        """失敗を記録し、呼び出し側に投げる例外を返す（error が None なら期限切れ）"""
+        self.breaker.record_failure()
+        if error is None:
+            self._count('timeouts')
+            return GenerationTimeout(f"{self.timeout}秒以内に応答がありませんでした")
+        self._count('failures')
+        return GenerationError(str(error))
+
+    def _submit(self, prompt):
+        upstream = _UpstreamCall()
+        return self._executor.submit(self._call, prompt, upstream), upstream
+
+    def _call(self, prompt, upstream=None):
+        if upstream is not None:
+            upstream.start()
+        started = time.perf_counter()
+        response = self._get_model().generate_content(prompt, **self._request_kwargs())
+        text = response.text
+        return text, time.perf_counter() - started
+
+    async def _call_async(self, prompt):
+        started = time.perf_counter()
+        response = await self._get_model().generate_content_async(prompt, **self._request_kwargs())
+        return response.text, time.perf_counter() - started
+
+    def generate(self, prompt):
+        """
+        プロンプトから文章を生成
+        Returns: 生成されたテキスト
+        Raises: CircuitOpenError / GenerationTimeout / GenerationError
+        """
+        self._begin()
+        primary, upstream = self._submit(prompt)
+
+        # 実行スレッドが空くのを待つ（混雑で始められなければ、上流の失敗とはせずに打ち切る）
+        if not upstream.started.wait(self.timeout) and primary.cancel():
+            self.breaker.release_trial()
+            self._count('queue_timeouts')
+            raise GenerationTimeout(f"{self.timeout}秒以内に生成APIを呼び出せませんでした（混雑）")
+        upstream.started.wait()
+        deadline = upstream.started_at + self.timeout
+        futures = [primary]
+
+        # ヘッジ: 通常の応答時間（pXX）を過ぎても返らなければ2本目を送る
+        hedge_after = self._hedge_delay()
+        if hedge_after is not None:
+            done, _ = wait(futures, timeout=max(0.0, upstream.started_at + hedge_after - time.monotonic()))
+            if not done:
+                self._count('hedged')
+                futures.append(self._submit(prompt)[0])
+
+        error = None
+        while futures:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.remove(future)
+                try:
+                    text, seconds = future.result()
+                except Exception as e:
+                    # もう一方がまだ走っていれば、そちらの結果を待つ
+                    error = e
+                    continue
+                self._succeeded(seconds, hedge_won=future is not primary)
+                return text
+
+        # 期限切れの呼び出しは待たずに手放す（request_options に対応した版では上流側でも打ち切られる）
+        for future in futures:
+            future.cancel()
+        raise self._failed(None if futures else error) from error
+
+    async def generate_async(self, prompt):
+        """
+        generate() の asyncio 版（スレッドを使わず、待ち時間中はイベントループを塞がない）
+        """
+        self._begin()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        primary = asyncio.ensure_future(self._call_async(prompt))
+        tasks = [primary]
+        error = None
+        try:
+            hedge_after = self._hedge_delay()
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    self._count('hedged')
+                    tasks.append(asyncio.ensure_future(self._call_async(prompt)))
+
+            while tasks:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                done, _ = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.remove(task)
+                    try:
+                        text, seconds = task.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    self._succeeded(seconds, hedge_won=task is not primary)
+                    return text
+        except asyncio.CancelledError:
+            # クライアントの切断で打ち切られた（成否は判断できないので試行枠だけ返す）
+            self.breaker.release_trial()
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise self._failed(None if tasks else error) from error
+
+    def _pump_stream(self, prompt, chunks, stop):
+        """stream() 用: 上流のストリームを別スレッドで読み、断片（最後に終端・例外）をキューに入れる"""
+        try:
+            response = self._get_model().generate_content(prompt, stream=True, **self._request_kwargs())
+            for chunk in response:
+                if stop.is_set():
+                    return
+                chunks.put(chunk)
+        except Exception as e:
+            chunks.put(e)
+            return
+        chunks.put(_STREAM_END)
+
+    def stream(self, prompt):
+        """
+        プロンプトから文章を生成し、テキストの断片を順に返すジェネレータ
+        （ヘッジはしない。最初の断片・各断片の待ち時間に timeout 秒の期限を設ける。
+        同期SDKのストリームは中断できないため、別スレッドで読んでキュー越しに待つ）
+        """
+        self._begin()
+        started = time.perf_counter()
+        finish_reason = None
+        chunks = queue.Queue()
+        stop = threading.Event()
+        threading.Thread(target=self._pump_stream, args=(prompt, chunks, stop),
+                         name='genai-stream', daemon=True).start()
+        try:
+            while True:
+                chunk = chunks.get(timeout=self.timeout)
+                if chunk is _STREAM_END:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                finish_reason = _finish_reason(chunk) or finish_reason
+                yield chunk.text
+        except GeneratorExit:
+            # クライアントが途中で切断した（成否は判断できないので試行枠だけ返す）
+            self.breaker.release_trial()
+            raise
+        except queue.Empty:
+            raise self._failed(None)
+        except Exception as e:
+            raise self._failed(e) from e
+        finally:
+            # 期限切れ・切断の後は、読み込み側のスレッドも次の断片で止める
+            stop.set()
+        self._succeeded(time.perf_counter() - started)
+        if finish_reason not in (None, 'STOP'):
+            # 上流は応答しているので失敗には数えず、呼び出し側に途中までであることだけ伝える
+            raise IncompleteGeneration(finish_reason)
+
+    async def stream_async(self, prompt):
+        """stream() の asyncio 版（非同期ジェネレータ）"""
+        self._begin()
+        started = time.perf_counter()
+        finish_reason = None
+        try:
+            response = await asyncio.wait_for(
+                self._get_model().generate_content_async(prompt, stream=True, **self._request_kwargs()),
+                timeout=self.timeout
+            )
+            chunks = response.__aiter__()
+            while True:
+                # 各断片の待ち時間にも期限を設ける
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.timeout)
+                except StopAsyncIteration:
+                    break
+                finish_reason = _finish_reason(chunk) or finish_reason
+                yield chunk.text
+        except (GeneratorExit, asyncio.CancelledError):
+            self.breaker.release_trial()
+            raise
+        except asyncio.TimeoutError:
+            raise self._failed(None)
+        except Exception as e:
+            raise self._failed(e) from e
+        self._succeeded(time.perf_counter() - started)
+        if finish_reason not in (None, 'STOP'):
+            raise IncompleteGeneration(finish_reason)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['model'] = 'fake' if self.fake_latency else self.model_name
+        stats['timeout'] = self.timeout
+        stats['max_workers'] = self.max_workers
+        stats['breaker'] = self.breaker.stats()
+        stats['latency'] = self.latency.stats()
+        return stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_generative_client():
+    """設定（GENERATIVE_CONFIG）どおりのクライアントを取得（初回に生成）"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GenerativeClient(
+                    GENERATIVE_CONFIG['model'],
+                    timeout=GENERATIVE_CONFIG['timeout'],
+                    hedge_percentile=GENERATIVE_CONFIG['hedge_percentile'],
+                    hedge_min_samples=GENERATIVE_CONFIG['hedge_min_samples'],
+                    failure_threshold=GENERATIVE_CONFIG['failure_threshold'],
+                    reset_timeout=GENERATIVE_CONFIG['reset_timeout'],
+                    max_workers=GENERATIVE_CONFIG['max_workers'],
+                    fake_latency=GENERATIVE_CONFIG['fake_latency'],
+                )
+    return _client
+
+
+def get_generative_client_stats():
+    return get_generative_client().stats()
@@ -3,15 +3,33 @@ app.py - メインFlaskアプリケーション
 Database_Final-mainのmain.pyに相当
 Foreign Key, JOIN, SubQueryを使用した高度な機能を実装
 """
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session
+from flask import (
+    Flask, render_template, request, redirect, url_for, jsonify, session, Response,
+    stream_with_context, stream_template
+)
 from .models import (
-    get_random_tanka, delete_tanka, insert_tanka, get_pool_count,
-    get_or_create_user, record_exchange, get_user_exchange_history,
-    get_tankas_by_category, get_popular_tankas, get_category_stats,
-    get_all_categories, get_all_tankas_with_categories, get_user_exchange_stats
+    get_pool_count, get_or_create_user, perform_exchange, get_user_exchange_history,
+    get_tankas_by_category, get_popular_tankas, get_category_stats, get_popularity_stats,
+    get_all_categories, get_tankas_page, get_database_identity, invalidate_database_identity,
+    ForeignKeyViolation, get_user_exchange_stats,
+    search_tanka_semantically, ping_database
+)
+from .db_pool import get_pool_stats
+from .storage import get_storage_stats
+from .vector_index import get_vector_index_stats
+from .embeddings import embed_text
+from .embedding_cache import get_embedding_cache_stats
+from .embedding_worker import enqueue_embedding, get_embedding_worker_stats
+from .response_cache import get_response_cache, get_response_cache_stats
+from .generative_client import (
+    get_generative_client, get_generative_client_stats, CircuitOpenError, IncompleteGeneration
 )
+from .config import EMBEDDING_WORKER_CONFIG, STATS_PAGE_SIZE
+from .startup import get_readiness
 import uuid
-import google.generativeai as genai
+import json
+import threading
+import time
 
 import os
 from dotenv import load_dotenv
@@ -22,16 +40,56 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-change-this-in-production')  # セッション用
 
-# Google Gemini API設定
-GENAI_API_KEY = os.getenv("GENAI_API_KEY")
-if GENAI_API_KEY:
-    genai.configure(api_key=GENAI_API_KEY)
+# Google Gemini API は初回のAI呼び出しで読み込む（app/genai_loader.py）
+
+# session_id → user_id キャッシュのヒット/ミス数
+_user_cache_stats = {'hits': 0, 'misses': 0}
+_user_cache_lock = threading.Lock()
 
 @app.before_request
 def ensure_session():
     """セッションIDを確保"""
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
+        session.pop('user_id', None)
+        session.pop('user_db', None)
+
+def get_current_user_id(refresh=False):
+    """
+    現在のセッションのuser_idを取得
+    一度解決したuser_idは（署名付きの）Flaskセッションに接続先DBの識別子と一緒に保存し、
+    2回目以降のリクエストではDBに問い合わせない。
+    識別子が違う（保存先の切り替え・DBの作り直し）場合や refresh=True の場合は解決し直す
+    """
+    identity = get_database_identity()
+    user_id = session.get('user_id')
+    if user_id is not None and not refresh and session.get('user_db') == identity:
+        with _user_cache_lock:
+            _user_cache_stats['hits'] += 1
+        return user_id
+
+    with _user_cache_lock:
+        _user_cache_stats['misses'] += 1
+    user_id = get_or_create_user(session['session_id'])
+    session['user_id'] = user_id
+    session['user_db'] = identity
+    return user_id
+
+def resolve_stale_user():
+    """
+    セッションの user_id がDBに無かった（外部キー違反）ときに解決し直す
+    識別子が同じままDBを作り直した場合（稼働中の init_db.py --reset など）に起きる
+    """
+    invalidate_database_identity()
+    return get_current_user_id(refresh=True)
+
+def get_user_cache_stats():
+    """user_idキャッシュの統計（hits = 省略できたDBクエリ数）"""
+    with _user_cache_lock:
+        stats = dict(_user_cache_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / total if total else 0.0
+    return stats
 
 @app.route('/')
 def home():
@@ -48,15 +106,16 @@ def submit():
 def exchange():
     """
     短歌交換処理
-    1. DBからランダム1件取得
-    2. 取得した短歌をDBから削除
-    3. ユーザーの短歌をDBにINSERT
-    4. 交換履歴を記録（Foreign Key使用）
-    5. 取得した短歌をレスポンスとして返す
+    1. 交換を1トランザクションで実行（models.perform_exchange）
+       - 自分以外の短歌をランダムに1件取得（SELECT FOR UPDATE SKIP LOCKED）
+       - ユーザーの短歌をDBにINSERT
+       - 交換履歴を記録（Foreign Key使用）
+       - 取得した短歌をDBから削除
+    2. ユーザーの短歌のベクトル化をバックグラウンドワーカーに依頼
+    3. 取得した短歌をレスポンスとして返す
     """
     # セッションIDからユーザーを取得/作成
-    session_id = session.get('session_id')
-    user_id = get_or_create_user(session_id)
+    user_id = get_current_user_id()
     
     # 5行の入力を結合
     lines = []
@@ -71,70 +130,102 @@ def exchange():
         return render_template('submit.html', error='短歌を入力してください')
     
     # --- RAG強化: ベクトル生成 ---
+    # ワーカー有効時は交換をコミットしてからバックグラウンドで生成する（APIの応答を待たない）
     user_embedding = None
-    try:
-        embed_res = genai.embed_content(
-            model="models/text-embedding-004",
-            content=user_tanka,
-            task_type="retrieval_document"
-        )
-        user_embedding = embed_res['embedding']
-    except Exception as e:
-        print(f"Embedding Generation Error: {e}")
-        # エラーでも続行（ベクトルなしで登録）
+    if not EMBEDDING_WORKER_CONFIG['enabled']:
+        try:
+            user_embedding = embed_text(user_tanka, task_type="retrieval_document")
+        except Exception as e:
+            print(f"Embedding Generation Error: {e}")
+            # エラーでも続行（ベクトルなしで登録）
 
-    # 交換処理
-    received = get_random_tanka(exclude_user_id=user_id)
+    # 交換処理（1トランザクション）
+    try:
+        result = perform_exchange(user_id, user_tanka, embedding=user_embedding)
+    except ForeignKeyViolation:
+        # セッションの user_id が存在しない（DBの作り直し後）→ 解決し直して1回だけ再試行
+        user_id = resolve_stale_user()
+        result = perform_exchange(user_id, user_tanka, embedding=user_embedding)
     
-    if received is None:
+    if result is None:
         return render_template('submit.html', error='交換できる短歌がありません')
     
-    received_tanka_id, received_tanka_content = received
+    received_tanka_content = result[1]
     
-    # ユーザーの短歌を登録（ベクトル付き）
-    given_tanka_id = insert_tanka(user_tanka, user_id, embedding=user_embedding)
-    
-    # 交換履歴を記録
-    record_exchange(
-        user_id=user_id,
-        given_tanka_id=given_tanka_id,
-        given_content=user_tanka,
-        received_tanka_id=received_tanka_id,
-        received_content=received_tanka_content
-    )
-    
-    # 取得した短歌を削除
-    delete_tanka(received_tanka_id)
+    # ベクトルが無い場合（ワーカー有効時、または同期生成の失敗時）はワーカーで生成
+    if user_embedding is None:
+        enqueue_embedding(result[2])
     
     return render_template('result.html', received_tanka=received_tanka_content)
 
 @app.route('/history')
 def history():
     """受信履歴画面（データベースから取得）"""
-    session_id = session.get('session_id')
-    user_id = get_or_create_user(session_id)
+    user_id = get_current_user_id()
     history = get_user_exchange_history(user_id, limit=50)
     return render_template('history.html', history=history)
 
+def lazy_rows(fetch, *args):
+    """テンプレートで参照されるまでクエリを実行しない（stream_template で見出しを先に送る）"""
+    yield from fetch(*args)
+
+class TankaPageStream:
+    """
+    短歌一覧の先頭ページ（stream_template 用）
+    テンプレートの for 文で回したときにクエリを実行し、回し終えた後は next_cursor を参照できる
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.next_cursor = None
+
+    def __iter__(self):
+        rows, self.next_cursor = get_tankas_page(limit=self.limit)
+        return iter(rows)
+
 @app.route('/stats')
 def stats():
     """
     統計画面
     JOIN, SubQueryを使用した高度な統計機能
+
+    stream_template で描画し、各表のクエリは描画がその位置に来たときに実行する
+    （見出しと先に終わった表からブラウザに届く）。全短歌一覧は先頭ページのみで、
+    続きはスクロールに合わせて /api/tankas から読み込む
     """
-    # 人気ランキング（SubQuery使用）
-    popular_tankas = get_popular_tankas(limit=10)
-    
-    # カテゴリ別統計（SubQuery使用）
-    category_stats = get_category_stats()
-    
-    # 全短歌一覧（JOIN使用）
-    all_tankas = get_all_tankas_with_categories()
-    
-    return render_template('stats.html', 
-                         popular_tankas=popular_tankas,
-                         category_stats=category_stats,
-                         all_tankas=all_tankas)
+    return stream_template(
+        'stats.html',
+        # カテゴリ別統計（SubQuery使用）
+        category_stats=lazy_rows(get_category_stats),
+        # 人気ランキング（SubQuery使用）
+        popular_tankas=lazy_rows(get_popular_tankas, 10),
+        # 全短歌一覧（JOIN使用、キーセットページネーション）
+        all_tankas=TankaPageStream(STATS_PAGE_SIZE),
+    )
+
+@app.route('/api/tankas')
+def api_tankas():
+    """
+    全短歌一覧の続き（新しい順、無限スクロール用）
+    ?cursor=前のページの next_cursor&limit=件数（最大200）
+    """
+    limit = max(1, min(request.args.get('limit', STATS_PAGE_SIZE, type=int), 200))
+    try:
+        rows, next_cursor = get_tankas_page(request.args.get('cursor'), limit)
+    except ValueError:
+        return jsonify({'error': 'cursor が不正です'}), 400
+    return jsonify({
+        'tankas': [
+            {
+                'id': tanka_id,
+                'content': content,
+                'categories': categories.split(', ') if categories else [],
+                'exchange_count': exchange_count,
+            }
+            for tanka_id, content, categories, exchange_count, _ in rows
+        ],
+        'next_cursor': next_cursor,
+    })
 
 @app.route('/category/<category_name>')
 def category(category_name):
@@ -156,8 +247,7 @@ def user_stats():
     ユーザー統計画面
     Foreign Keyを使用した履歴取得
     """
-    session_id = session.get('session_id')
-    user_id = get_or_create_user(session_id)
+    user_id = get_current_user_id()
     
     # ユーザー統計（JOIN使用）
     stats = get_user_exchange_stats(user_id)
@@ -173,6 +263,48 @@ def api_pool_count():
     count = get_pool_count()
     return jsonify({'count': count})
 
+def collect_metrics():
+    """性能カウンタを集める（ASGIモードの /api/metrics からも使う）"""
+    return {
+        'storage': get_storage_stats(),
+        'popularity': get_popularity_stats(),
+        'db_pool': get_pool_stats(),
+        'user_cache': get_user_cache_stats(),
+        'vector_index': get_vector_index_stats(),
+        'embedding_cache': get_embedding_cache_stats(),
+        'embedding_worker': get_embedding_worker_stats(),
+        'ai_consult_stream': get_consult_stream_stats(),
+        'generative_client': get_generative_client_stats(),
+        'response_cache': get_response_cache_stats(),
+    }
+
+@app.route('/api/metrics')
+def api_metrics():
+    """性能カウンタを返すAPI（デバッグ・監視用）"""
+    return jsonify(collect_metrics())
+
+@app.route('/healthz')
+def healthz():
+    """
+    起動状態の確認（readiness probe）
+    準備完了でDBに接続できれば 200、起動処理中・失敗・DB切断時は 503
+    """
+    readiness = get_readiness()
+    if readiness['state'] in ('starting', 'failed'):
+        return jsonify(readiness), 503
+    try:
+        ping_database()
+    except Exception as e:
+        readiness.update(state='failed', error=f"データベースに接続できません: {e}")
+        return jsonify(readiness), 503
+    readiness['state'] = 'ready'
+    return jsonify(readiness)
+
+@app.route('/splash')
+def splash():
+    """起動中の画面（/healthz をポーリングし、準備ができたらホームへ移動。デスクトップ版用）"""
+    return render_template('splash.html')
+
 # ==================== AI 歌人（Gemini Powered） ====================
 
 @app.route('/ai-advisor')
@@ -181,39 +313,33 @@ def ai_advisor():
     pool_count = get_pool_count()
     return render_template('ai_advisor.html', pool_count=pool_count)
 
-@app.route('/api/ai-consult', methods=['POST'])
-def ai_consult():
+# 参考短歌が見つからない場合・エラー時に使う歌
+FALLBACK_TANKA = "春過ぎて\n夏来にけらし\n白妙の\n衣ほすてふ\n天の香具山"
+FALLBACK_RESPONSE = "申し訳ありません。現在AI歌人は瞑想中（API制限またはエラー）のようです。\n\n<div class='ref-tanka'>春過ぎて<br>夏来にけらし<br>白妙の<br>衣ほすてふ<br>天の香具山</div>\n\n代わりにこちらの歌をお届けします。また後でお話ししましょう。"
+
+def find_reference_tanka(user_embedding, user_id):
     """
-    AI相談API（実稼働プロトタイプ）
-    Gemini API + DB連携
+    相談文に意味の近い「参考短歌」をベクトル探索で選ぶ
+    Returns: (短歌ID, 本文)（見つからなければ (None, FALLBACK_TANKA)）
     """
-    data = request.json
-    user_message = data.get('message', '')
-    
-    # セッションからユーザーIDを取得（除外用）
-    session_id = session.get('session_id')
-    user_id = get_or_create_user(session_id) if session_id else None
+    # DBからベクトル探索（セマンティック検索）で「参考短歌」を選定
+    ref_tanka_data = search_tanka_semantically(user_embedding, exclude_user_id=user_id)
+    if ref_tanka_data:
+        return ref_tanka_data
+    return None, FALLBACK_TANKA
 
-    try:
-        # 1. ユーザーのメッセージをベクトル化 (Embedding)
-        embed_result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=user_message,
-            task_type="retrieval_query"
-        )
-        user_embedding = embed_result['embedding']
-
-        # 2. DBからベクトル探索（セマンティック検索）で「参考短歌」を選定
-        from .models import search_tanka_semantically
-        ref_tanka_data = search_tanka_semantically(user_embedding, exclude_user_id=user_id)
-        
-        if ref_tanka_data:
-            tanka_content = ref_tanka_data[1]
-        else:
-            tanka_content = "春過ぎて\n夏来にけらし\n白妙の\n衣ほすてふ\n天の香具山" 
+def remember_response(user_embedding, tanka_id, tanka_content, ai_text):
+    """
+    生成した応答を意味的キャッシュに保存（参考短歌がプールの歌の場合のみ）
+    空の応答（何も生成されなかったストリームなど）は保存しない
+    """
+    cache = get_response_cache()
+    if cache is not None and tanka_id is not None and ai_text and ai_text.strip():
+        cache.store(user_embedding, tanka_id, tanka_content, ai_text)
 
-        # 3. Geminiへのプロンプト作成
-        prompt = f"""
+def build_consult_prompt(user_message, tanka_content):
+    """Geminiへのプロンプト作成"""
+    return f"""
         あなたは「AI歌人」です。短歌のデータベースを持つ相談役として、ユーザーの悩みに答え、参考となる短歌を紹介してください。
 
         【ユーザーの入力】: 「{user_message}」
@@ -226,162 +352,175 @@ def ai_consult():
         2. 参考短歌を紹介し（引用部分はHTMLタグ <div class='ref-tanka'> で囲み、改行は <br> にする）、それがどうユーザーの心情と関わるか解説してください。
         3. 全体で150文字程度で、優しく文学的な言葉遣いでまとめてください。
         """
+
+@app.route('/api/ai-consult', methods=['POST'])
+def ai_consult():
+    """
+    AI相談API（実稼働プロトタイプ）
+    Gemini API + DB連携
+    """
+    data = request.json
+    user_message = data.get('message', '')
+    
+    # セッションからユーザーIDを取得（除外用）
+    user_id = get_current_user_id()
+
+    client = get_generative_client()
+    if client.breaker.is_open():
+        # 生成APIが落ちている間は埋め込み・探索も省いて即座にフォールバック
+        return jsonify({'response': FALLBACK_RESPONSE})
+
+    try:
+        # 1. ユーザーのメッセージをベクトル化 (Embedding、同じ文章はキャッシュから)
+        user_embedding = embed_text(user_message, task_type="retrieval_query")
+
+        # 言い回し違いの同じ相談には、過去の応答をそのまま返す
+        cache = get_response_cache()
+        cached = cache.lookup(user_embedding, exclude_user_id=user_id) if cache is not None else None
+        if cached:
+            return jsonify({'response': cached['response'], 'cached': True})
+
+        # 2. ベクトル探索で参考短歌を選定
+        tanka_id, tanka_content = find_reference_tanka(user_embedding, user_id)
+
+        # 3. Geminiへのプロンプト作成
+        prompt = build_consult_prompt(user_message, tanka_content)
         
-        # 3. Gemini API呼び出し
-        # 無料枠で高速な Flash モデルを使用
-        model = genai.GenerativeModel('gemini-flash-latest')
-        response = model.generate_content(prompt)
-        ai_text = response.text
+        # 4. Gemini API呼び出し（期限つき、モデルはプロセスで使い回す）
+        ai_text = client.generate(prompt)
+        remember_response(user_embedding, tanka_id, tanka_content, ai_text)
         
         return jsonify({'response': ai_text})
 
+    except CircuitOpenError:
+        return jsonify({'response': FALLBACK_RESPONSE})
     except Exception as e:
         import traceback
         print(f"AI Error: {e}")
         traceback.print_exc() # 詳細なエラーログを出力
         # エラー時のフォールバック
-        return jsonify({'response': "申し訳ありません。現在AI歌人は瞑想中（API制限またはエラー）のようです。\n\n<div class='ref-tanka'>春過ぎて<br>夏来にけらし<br>白妙の<br>衣ほすてふ<br>天の香具山</div>\n\n代わりにこちらの歌をお届けします。また後でお話ししましょう。"})
+        return jsonify({'response': FALLBACK_RESPONSE})
 
-def setup_docker_environment():
-    """Dockerコンテナの起動状態を確認し、必要に応じて起動"""
-    import subprocess
-    import sys
-    import os
-    
-    print("[*] Docker環境を確認中...")
-    
-    # 1. Dockerがインストールされているか確認
-    try:
-        result = subprocess.run(['docker', '--version'], 
-                              capture_output=True, text=True, timeout=10)
-        if result.returncode != 0:
-            print("\n[!] Dockerがインストールされていません")
-            print("   Docker Desktopをインストールしてください: https://www.docker.com/products/docker-desktop")
-            sys.exit(1)
-        print(f"[v] Docker検出: {result.stdout.strip()}")
-    except subprocess.TimeoutExpired:
-        print("\n[x] Dockerコマンドがタイムアウトしました")
-        print("   Docker Desktopが起動しているか確認してください")
-        sys.exit(1)
-    except FileNotFoundError:
-        print("\n[!] Dockerがインストールされていません")
-        print("   Docker Desktopをインストールしてください: https://www.docker.com/products/docker-desktop")
-        sys.exit(1)
-    
-    # 2. Docker Desktopが起動しているか確認（docker infoで確認）
-    try:
-        print("[*] Docker Desktopの起動状態を確認中...")
-        result = subprocess.run(['docker', 'info'], 
-                              capture_output=True, text=True, timeout=15)
-        if result.returncode != 0:
-            print("\n[x] Docker Desktopが起動していません")
-            print("   Docker Desktopを起動してから、再度実行してください")
-            print(f"   エラー詳細: {result.stderr}")
-            sys.exit(1)
-        print("[v] Docker Desktopは起動しています")
-    except subprocess.TimeoutExpired:
-        print("\n[x] Docker Desktopの確認がタイムアウトしました")
-        print("   Docker Desktopを再起動してから、再度実行してください")
-        sys.exit(1)
-    
-    # 3. docker-composeコマンドの確認
-    try:
-        # docker compose (V2) または docker-compose (V1) を確認
-        result_v2 = subprocess.run(['docker', 'compose', 'version'], 
-                                  capture_output=True, text=True, timeout=10)
-        if result_v2.returncode == 0:
-            compose_cmd = ['docker', 'compose']
-            print(f"[v] Docker Compose検出: {result_v2.stdout.strip()}")
-        else:
-            result_v1 = subprocess.run(['docker-compose', '--version'], 
-                                      capture_output=True, text=True, timeout=10)
-            if result_v1.returncode == 0:
-                compose_cmd = ['docker-compose']
-                print(f"[v] Docker Compose検出: {result_v1.stdout.strip()}")
-            else:
-                print("\n[x] docker-composeコマンドが見つかりません")
-                sys.exit(1)
-    except subprocess.TimeoutExpired:
-        print("\n[x] docker-composeコマンドの確認がタイムアウトしました")
-        sys.exit(1)
-    except FileNotFoundError:
-        print("\n[x] docker-composeコマンドが見つかりません")
-        sys.exit(1)
-    
-    # 4. tanka_postgresコンテナが起動しているか確認
-    try:
-        print("[*] PostgreSQLコンテナの状態を確認中...")
-        result = subprocess.run(['docker', 'ps', '--filter', 'name=tanka_postgres', '--format', '{{.Names}}'],
-                              capture_output=True, text=True, timeout=15)
-        
-        if 'tanka_postgres' not in result.stdout:
-            print("[*] PostgreSQLコンテナを起動中...")
-            # docker-compose up -d を実行
-            result = subprocess.run(compose_cmd + ['up', '-d'],
-                                  capture_output=True, text=True, timeout=120)
-            if result.returncode == 0:
-                print("[v] PostgreSQLコンテナを起動しました")
-                if result.stdout:
-                    print(f"   {result.stdout.strip()}")
-            else:
-                print(f"\n[x] コンテナ起動エラー:")
-                print(f"   {result.stderr}")
-                sys.exit(1)
-        else:
-            print("[v] PostgreSQLコンテナは既に起動しています")
-    except subprocess.TimeoutExpired:
-        print("\n[x] Dockerコンテナの起動がタイムアウトしました")
-        print("   以下を確認してください:")
-        print("   1. Docker Desktopが正常に動作しているか")
-        print("   2. システムリソース（CPU/メモリ）に余裕があるか")
-        print("   3. docker-compose.ymlファイルが存在するか")
-        sys.exit(1)
-    except Exception as e:
-        print(f"\n[x] Docker環境のセットアップエラー: {e}")
-        sys.exit(1)
+# ストリーミング相談の計測値（TTFBと総時間を分けて集計）
+_consult_stream_stats = {
+    'requests': 0,
+    'errors': 0,
+    'ttfb_total': 0.0,         # リクエスト開始 → 最初のイベント（参考短歌）送出まで（秒）
+    'first_token_total': 0.0,  # リクエスト開始 → 最初の生成テキスト送出まで（秒）
+    'total_time_total': 0.0,   # リクエスト開始 → 生成完了まで（秒）
+}
+_consult_stream_lock = threading.Lock()
 
+def record_stream_timings(timings):
+    """ストリーミング相談1件分の計測値を集計に加える"""
+    with _consult_stream_lock:
+        _consult_stream_stats['requests'] += 1
+        _consult_stream_stats['ttfb_total'] += timings['ttfb_ms'] / 1000
+        _consult_stream_stats['first_token_total'] += timings.get('first_token_ms', timings['total_ms']) / 1000
+        _consult_stream_stats['total_time_total'] += timings['total_ms'] / 1000
 
-def wait_for_database(max_retries=30, retry_interval=1):
-    """データベース接続を確認し、接続できるまで待機"""
-    import time
-    from .config import get_db_connection
-    
-    print("[*] データベース接続を確認中...")
-    
-    for i in range(max_retries):
+def sse_event(event, data):
+    """Server-Sent Events の1イベントを組み立てる"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/ai-consult/stream', methods=['POST'])
+def ai_consult_stream():
+    """
+    AI相談API（ストリーミング版, Server-Sent Events）
+    生成完了を待たず、モデルが出力したテキストを順次送る
+
+    イベント:
+    - reference: ベクトル探索で選んだ参考短歌（探索直後に最初に送る）
+    - chunk:     生成されたテキストの断片
+    - done:      計測値（ttfb_ms / first_token_ms / total_ms, 応答キャッシュから返した場合は cached）
+    - error:     エラー時のフォールバック応答
+    """
+    started = time.perf_counter()
+    data = request.json
+    user_message = data.get('message', '')
+    user_id = get_current_user_id()
+
+    def elapsed_ms():
+        return (time.perf_counter() - started) * 1000
+
+    def generate():
+        timings = {}
+        client = get_generative_client()
+        if client.breaker.is_open():
+            yield sse_event('error', {'response': FALLBACK_RESPONSE})
+            return
         try:
-            conn = get_db_connection()
-            conn.close()
-            print("[v] データベースに接続しました")
-            return True
+            user_embedding = embed_text(user_message, task_type="retrieval_query")
+            cache = get_response_cache()
+            cached = cache.lookup(user_embedding, exclude_user_id=user_id) if cache is not None else None
+            if cached:
+                # キャッシュヒット: 参考短歌と応答全体を一度に送る
+                timings['ttfb_ms'] = timings['first_token_ms'] = elapsed_ms()
+                yield sse_event('reference', {'tanka': cached['tanka_content'], 'elapsed_ms': timings['ttfb_ms']})
+                yield sse_event('chunk', {'text': cached['response']})
+                timings['total_ms'] = elapsed_ms()
+                yield sse_event('done', dict(timings, cached=True))
+                record_stream_timings(timings)
+                return
+
+            tanka_id, tanka_content = find_reference_tanka(user_embedding, user_id)
+            timings['ttfb_ms'] = elapsed_ms()
+            yield sse_event('reference', {'tanka': tanka_content, 'elapsed_ms': timings['ttfb_ms']})
+
+            pieces = []
+            completed = True
+            try:
+                for text in client.stream(build_consult_prompt(user_message, tanka_content)):
+                    if not text:
+                        continue
+                    if 'first_token_ms' not in timings:
+                        timings['first_token_ms'] = elapsed_ms()
+                    pieces.append(text)
+                    yield sse_event('chunk', {'text': text})
+            except IncompleteGeneration as e:
+                # 出力上限・安全性フィルタで途中までになった応答は、表示はするがキャッシュしない
+                print(f"[!] 応答が途中で終わりました: {e}")
+                completed = False
+
+            timings['total_ms'] = elapsed_ms()
+            if completed:
+                remember_response(user_embedding, tanka_id, tanka_content, ''.join(pieces))
+            yield sse_event('done', timings)
+            record_stream_timings(timings)
         except Exception as e:
-            if i == 0:
-                print(f"   データベース起動待機中... (最大{max_retries}秒)")
-            time.sleep(retry_interval)
-    
-    print(f"[x] データベースに接続できませんでした（{max_retries}秒経過）")
-    print("   docker-compose logsでログを確認してください")
-    return False
+            import traceback
+            print(f"AI Error: {e}")
+            traceback.print_exc()
+            with _consult_stream_lock:
+                _consult_stream_stats['errors'] += 1
+            yield sse_event('error', {'response': FALLBACK_RESPONSE})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
+def get_consult_stream_stats():
+    """ストリーミング相談の平均TTFB・最初のトークンまで・総時間（秒）"""
+    with _consult_stream_lock:
+        stats = dict(_consult_stream_stats)
+    count = stats['requests']
+    for key in ('ttfb', 'first_token', 'total_time'):
+        stats[f'{key}_avg'] = stats[f'{key}_total'] / count if count else 0.0
+    return stats
 
 if __name__ == '__main__':
     print("=== 匿名短歌交換アプリ起動 ===\n")
     
-    # 1. Docker環境のセットアップ
-    setup_docker_environment()
-    
-    # 2. データベース接続確認
-    if not wait_for_database():
+    # 1-4. DB接続確認（必要なら Docker で起動）・スキーマ初期化
+    from .startup import prepare_environment
+    if not prepare_environment():
         import sys
         sys.exit(1)
     
-    # 3. データベース初期化（初回のみ）
-    print("[*] データベースを初期化中...")
-    from init_db import init_database
-    init_database()
-    
     print("\n[!] アプリケーションを起動します")
     print("   ブラウザで http://localhost:5000 にアクセスしてください\n")
     
-    # 4. Flaskアプリ起動
+    # 5. Flaskアプリ起動
     app.run(debug=True, host='0.0.0.0', port=5000)
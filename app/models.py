@@ -2,395 +2,363 @@
 models.py - DBモデル・操作関数
 tanka_poolテーブルの操作を担当
 Foreign Key, JOIN, SubQueryを使用した高度なSQL機能を実装
+
+SQLの実行は保存先ごとの実装（app/storage/postgres.py / sqlite.py, STORAGE_BACKEND で選択）に任せ、
+ここではプール件数のキャッシュ・ベクトル索引・応答キャッシュの更新を行う。
+呼び出し側は保存先を意識せず、同じ関数を使える
 """
-from .config import get_db_connection
-import uuid
+from .config import POOL_COUNT_CACHE_TTL, POPULARITY_REFRESH_INTERVAL
+from .storage import backend
+from .vector_index import get_vector_index, on_tanka_saved, on_tanka_deleted
+from .response_cache import on_tanka_removed
+from datetime import datetime
+import threading
+import time
+
+# 存在しない user_id での書き込みの例外（保存先ごとの型）
+ForeignKeyViolation = backend.ForeignKeyViolation
+
+def ping_database():
+    """DBに接続できるか確認（/healthz 用。失敗時は例外）"""
+    backend.ping()
+
+_database_identity = {'value': None}
+
+def get_database_identity():
+    """
+    接続先DBの識別子（保存先の種類・DB・users テーブル）。プロセスで1回だけ問い合わせる
+    セッションに user_id と一緒に保存し、保存先の切り替え・DBの作り直しを検出する
+    """
+    if _database_identity['value'] is None:
+        _database_identity['value'] = backend.database_identity()
+    return _database_identity['value']
+
+def invalidate_database_identity():
+    """DBの作り直しを検出したとき（外部キー違反）に識別子を取り直す"""
+    _database_identity['value'] = None
 
 # ==================== ユーザー管理 ====================
 
 def get_or_create_user(session_id):
     """
     セッションIDからユーザーを取得、存在しなければ作成
+
+    SQL要素: INSERT ... ON CONFLICT ... RETURNING（UPSERT）
+    同じセッションの同時リクエストでも重複して作成しない
     Returns: user_id
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        # 既存ユーザーを検索
-        cursor.execute("SELECT user_id FROM users WHERE session_id = %s", (session_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            return result[0]
-        else:
-            # 新規ユーザー作成
-            cursor.execute(
-                "INSERT INTO users(session_id) VALUES (%s) RETURNING user_id",
-                (session_id,)
-            )
-            user_id = cursor.fetchone()[0]
-            conn.commit()
-            return user_id
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.get_or_create_user(session_id)
 
 # ==================== 短歌操作（基本） ====================
 
 def get_random_tanka(exclude_user_id=None):
     """
-    tanka_poolからランダムに1件取得
+    tanka_poolからランダムに1件取得（自分の歌を除外可能）
+    ORDER BY RANDOM() ではなく、インデックス付きの乱数キー random_key の位置から取得する
     Returns: (id, content) or None
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        if exclude_user_id:
-            # 自分の歌を除外して取得
-            cursor.execute("""
-                SELECT id, content FROM tanka_pool 
-                WHERE user_id IS NULL OR user_id != %s 
-                ORDER BY RANDOM() LIMIT 1
-            """, (exclude_user_id,))
-        else:
-            cursor.execute("SELECT id, content FROM tanka_pool ORDER BY RANDOM() LIMIT 1")
-        result = cursor.fetchone()
-        return result
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.get_random_tanka(exclude_user_id)
+
+def search_similar_tankas(embedding, limit=1, exclude_user_id=None,
+                          ef_search=None, probes=None, exact=False):
+    """
+    ベクトル探索（コサイン類似度）で上位 limit 件を取得
+
+    - ef_search / probes: pgvector の近似探索の精度パラメータ（大きいほど高精度・低速）
+    - exact=True: インデックスを使わず全件を厳密に比較（精度評価用）
+
+    VECTOR_SEARCH_BACKEND=memory の場合はプロセス内NumPy索引（app/vector_index.py）で計算する
+    （exact=True の場合は保存先で厳密探索）
+
+    Returns: [(id, content, distance), ...]
+    """
+    index = None if exact else get_vector_index()
+    if index is not None:
+        return index.search(embedding, limit, exclude_user_id)
+    return backend.search_similar_tankas(embedding, limit, exclude_user_id,
+                                         ef_search=ef_search, probes=probes, exact=exact)
 
-def search_tanka_semantically(embedding, limit=1, exclude_user_id=None):
+def search_tanka_semantically(embedding, limit=1, exclude_user_id=None, ef_search=None, probes=None):
     """
-    ベクトル探索（コサイン類似度）
+    ベクトル探索（コサイン類似度）で最も近い短歌を取得
     Returns: (id, content) or None
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        if exclude_user_id:
-            # 自分の歌を除外して検索
-            cursor.execute("""
-                SELECT id, content 
-                FROM tanka_pool 
-                WHERE embedding IS NOT NULL 
-                AND (user_id IS NULL OR user_id != %s)
-                ORDER BY embedding <=> %s::vector 
-                LIMIT %s
-            """, (exclude_user_id, embedding, limit))
-        else:
-            # <=> はコサイン距離（小さいほど似ている）
-            cursor.execute("""
-                SELECT id, content 
-                FROM tanka_pool 
-                WHERE embedding IS NOT NULL
-                ORDER BY embedding <=> %s::vector 
-                LIMIT %s
-            """, (embedding, limit))
-        result = cursor.fetchone()
-        return result
-    finally:
-        cursor.close()
-        conn.close()
+    results = search_similar_tankas(embedding, limit, exclude_user_id, ef_search=ef_search, probes=probes)
+    if not results:
+        return None
+    return results[0][:2]
 
 def update_tanka_embedding(tanka_id, embedding):
     """
     短歌のベクトルデータを更新
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            UPDATE tanka_pool 
-            SET embedding = %s::vector 
-            WHERE id = %s
-        """, (embedding, tanka_id))
-        conn.commit()
-    finally:
-        cursor.close()
-        conn.close()
+    result = backend.update_tanka_embedding(tanka_id, embedding)
+    if result:
+        on_tanka_saved(tanka_id, result[0], result[1], embedding)
 
-def get_tankas_without_embeddings():
-    """ベクトルデータが未生成の短歌を取得"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT id, content FROM tanka_pool WHERE embedding IS NULL")
-        return cursor.fetchall()
-    finally:
-        cursor.close()
-        conn.close()
+def get_tankas_without_embeddings(limit=None, tanka_ids=None):
+    """
+    ベクトルデータが未生成の短歌を取得
+    tanka_ids を指定した場合はそのIDの中から（処理中に削除・生成済みになった行は除かれる）
+    """
+    return backend.get_tankas_without_embeddings(limit, tanka_ids)
+
+def get_pool_tanka(tanka_id):
+    """
+    プール内の短歌を1件取得（交換で引き取られていれば None）
+    Returns: (id, content, user_id) or None
+    """
+    return backend.get_pool_tanka(tanka_id)
 
 def delete_tanka(tanka_id):
     """
     指定IDの短歌を削除
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("DELETE FROM tanka_pool WHERE id = %s", (tanka_id,))
-        conn.commit()
-    finally:
-        cursor.close()
-        conn.close()
+    backend.delete_tanka(tanka_id)
+    invalidate_pool_count()
+    on_tanka_deleted(tanka_id)
+    on_tanka_removed(tanka_id)
 
 def insert_tanka(content, user_id=None, embedding=None):
     """
     新しい短歌を登録
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "INSERT INTO tanka_pool(content, user_id, embedding) VALUES (%s, %s, %s) RETURNING id",
-            (content, user_id, embedding)
-        )
-        tanka_id = cursor.fetchone()[0]
-        conn.commit()
-        return tanka_id
-    finally:
-        cursor.close()
-        conn.close()
+    tanka_id = backend.insert_tanka(content, user_id, embedding)
+    invalidate_pool_count()
+    on_tanka_saved(tanka_id, user_id, content, embedding)
+    return tanka_id
+
+# プール件数のプロセス内キャッシュ（交換・登録・削除で無効化、他プロセスの変更はTTLで反映）
+_pool_count_cache = {'value': None, 'expires_at': 0.0}
+_pool_count_lock = threading.Lock()
 
 def get_pool_count():
     """
     プール内の短歌数を取得
+
+    PostgreSQL では COUNT(*) が全件スキャンになるため、トリガーで維持しているカウンタ表
+    tanka_pool_counter（16スロット）の合計を読む。さらに結果をプロセス内にキャッシュする。
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT COUNT(*) FROM tanka_pool")
-        result = cursor.fetchone()
-        return result[0] if result else 0
-    finally:
-        cursor.close()
-        conn.close()
+    with _pool_count_lock:
+        if _pool_count_cache['value'] is not None and time.monotonic() < _pool_count_cache['expires_at']:
+            return _pool_count_cache['value']
+
+    count = backend.count_pool_tankas()
+
+    with _pool_count_lock:
+        _pool_count_cache['value'] = count
+        _pool_count_cache['expires_at'] = time.monotonic() + POOL_COUNT_CACHE_TTL
+    return count
+
+def invalidate_pool_count():
+    """プール件数キャッシュを無効化（コミット後に呼ぶ）"""
+    with _pool_count_lock:
+        _pool_count_cache['value'] = None
 
 # ==================== JOIN使用 ====================
 
 def get_tankas_by_category(category_name):
     """
     カテゴリ別に短歌を取得（JOIN使用）
-    
+
     SQL要素: INNER JOIN（3テーブル結合）
     tanka_pool JOIN tanka_categories JOIN categories
-    
+
     Returns: [(tanka_id, content, category_name), ...]
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT 
-                tp.id,
-                tp.content,
-                c.name as category_name
-            FROM tanka_pool tp
-            INNER JOIN tanka_categories tc ON tp.id = tc.tanka_id
-            INNER JOIN categories c ON tc.category_id = c.category_id
-            WHERE c.name = %s
-            ORDER BY tp.created_at DESC
-        """, (category_name,))
-        return cursor.fetchall()
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.get_tankas_by_category(category_name)
 
 def get_tanka_with_categories(tanka_id):
     """
     短歌とそのカテゴリを取得（JOIN使用）
-    
+
     SQL要素: LEFT JOIN, GROUP BY, STRING_AGG
-    
+
     Returns: (tanka_id, content, categories_csv)
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT 
-                tp.id,
-                tp.content,
-                STRING_AGG(c.name, ', ') as categories
-            FROM tanka_pool tp
-            LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
-            LEFT JOIN categories c ON tc.category_id = c.category_id
-            WHERE tp.id = %s
-            GROUP BY tp.id, tp.content
-        """, (tanka_id,))
-        return cursor.fetchone()
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.get_tanka_with_categories(tanka_id)
 
 def get_all_tankas_with_categories():
     """
     全短歌をカテゴリ情報付きで取得（JOIN使用）
-    
+
     SQL要素: LEFT JOIN, GROUP BY, STRING_AGG
-    
+
     Returns: [(tanka_id, content, categories_csv, exchange_count), ...]
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT 
-                tp.id,
-                tp.content,
-                STRING_AGG(c.name, ', ') as categories,
-                tp.exchange_count
-            FROM tanka_pool tp
-            LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
-            LEFT JOIN categories c ON tc.category_id = c.category_id
-            GROUP BY tp.id, tp.content, tp.exchange_count
-            ORDER BY tp.created_at DESC
-        """)
-        return cursor.fetchall()
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.get_all_tankas_with_categories()
+
+def get_tankas_page(cursor=None, limit=50):
+    """
+    短歌一覧の1ページ（新しい順。キーセットページネーション）
+
+    SQL要素: 行値比較 (created_at, id) < (...), LEFT JOIN, STRING_AGG
+    OFFSET と違い、何ページ目でも索引から limit 件を読むだけで済む
+
+    cursor: 前のページの next_cursor（None なら先頭ページ）。不正な値なら ValueError
+    Returns: ([(tanka_id, content, categories_csv, exchange_count, created_at), ...], next_cursor or None)
+    """
+    after = _decode_page_cursor(cursor) if cursor else None
+    # 1件多く読み、次のページがあるかを判定する
+    rows = backend.get_tankas_page(after, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_page_cursor(rows[-1])
+    return rows, next_cursor
+
+def _encode_page_cursor(row):
+    """ページ最後の行 → 次のページのカーソル（"created_at|id"）"""
+    return f"{row[4].isoformat(sep=' ')}|{row[0]}"
+
+def _decode_page_cursor(cursor):
+    created_at, _, tanka_id = cursor.rpartition('|')
+    return datetime.fromisoformat(created_at), int(tanka_id)
 
 # ==================== SubQuery使用 ====================
 
 def get_popular_tankas(limit=10):
     """
-    人気の短歌ランキング（SubQuery使用）
-    
-    SQL要素: SubQuery, LEFT JOIN, COALESCE, ORDER BY
-    
-    exchange_historyから交換回数をカウントし、
-    SubQueryの結果を使って人気順にソート
-    
+    人気の短歌ランキング（集計済みの tanka_popularity から読む）
+
+    SQL要素: MATERIALIZED VIEW（SQLite では集計テーブル）, ORDER BY, LIMIT
+
+    exchange_historyの交換回数・カテゴリは事前に集計してあるため、
+    ここでは (exchange_count DESC, id) のインデックスから上位 limit 件を読むだけ。
+    集計が POPULARITY_REFRESH_INTERVAL 秒より古ければバックグラウンドで再集計する
+    （この呼び出しは待たずに、前回の集計結果を返す）
+
     Returns: [(tanka_id, content, exchange_count, categories), ...]
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    _refresh_popularity_if_stale()
+    return backend.get_popular_tankas(limit)
+
+# 人気ランキングの再集計状況（プロセス内）
+_popularity_state = {'refreshed_at': None, 'refreshing': False, 'last_seconds': None, 'refreshes': 0}
+_popularity_lock = threading.Lock()
+
+def refresh_popularity():
+    """
+    人気ランキングを今すぐ再集計
+    Returns: 再集計したら True（他のプロセスが再集計中なら False）
+    """
+    started = time.monotonic()
+    refreshed = backend.refresh_popularity()
+    with _popularity_lock:
+        _popularity_state['refreshed_at'] = time.monotonic()
+        if refreshed:
+            _popularity_state['last_seconds'] = _popularity_state['refreshed_at'] - started
+            _popularity_state['refreshes'] += 1
+    return refreshed
+
+def _refresh_popularity_if_stale():
+    with _popularity_lock:
+        refreshed_at = _popularity_state['refreshed_at']
+        if _popularity_state['refreshing'] or (
+                refreshed_at is not None and time.monotonic() - refreshed_at < POPULARITY_REFRESH_INTERVAL):
+            return
+        _popularity_state['refreshing'] = True
+    threading.Thread(target=_refresh_popularity_in_background, daemon=True).start()
+
+def _refresh_popularity_in_background():
     try:
-        cursor.execute("""
-            SELECT 
-                tp.id,
-                tp.content,
-                COALESCE(
-                    (SELECT COUNT(*) 
-                     FROM exchange_history eh 
-                     WHERE eh.received_tanka_id = tp.id),
-                    0
-                ) as exchange_count,
-                STRING_AGG(c.name, ', ') as categories
-            FROM tanka_pool tp
-            LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
-            LEFT JOIN categories c ON tc.category_id = c.category_id
-            GROUP BY tp.id, tp.content
-            ORDER BY exchange_count DESC
-            LIMIT %s
-        """, (limit,))
-        return cursor.fetchall()
+        refresh_popularity()
+    except backend.DatabaseError as e:
+        print(f"[!] 人気ランキングの再集計に失敗しました: {e}")
+        with _popularity_lock:
+            # 失敗時も次の再試行は間隔を空ける
+            _popularity_state['refreshed_at'] = time.monotonic()
     finally:
-        cursor.close()
-        conn.close()
+        with _popularity_lock:
+            _popularity_state['refreshing'] = False
+
+def get_popularity_stats():
+    """人気ランキングの再集計状況（/metrics 用）"""
+    with _popularity_lock:
+        refreshed_at = _popularity_state['refreshed_at']
+        return {
+            'refresh_interval': POPULARITY_REFRESH_INTERVAL,
+            'age_seconds': None if refreshed_at is None else time.monotonic() - refreshed_at,
+            'last_refresh_seconds': _popularity_state['last_seconds'],
+            'refreshes': _popularity_state['refreshes'],
+        }
 
 def get_category_stats():
     """
-    カテゴリ別統計（SubQuery使用）
-    
-    SQL要素: SubQuery, JOIN, GROUP BY, COUNT
-    
+    カテゴリ別統計
+
+    SQL要素: TRIGGER で維持しているカウンタ列 categories.tanka_count
+    （tanka_categories の追加・削除のたびにトリガーが ±1 するため、集計は行わない。
+      scripts/check_category_counts.py で全件集計と一致するか確認できる）
+
     Returns: [(category_name, tanka_count, description), ...]
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT 
-                c.name,
-                (SELECT COUNT(*) 
-                 FROM tanka_categories tc 
-                 WHERE tc.category_id = c.category_id) as tanka_count,
-                c.description
-            FROM categories c
-            ORDER BY tanka_count DESC
-        """)
-        return cursor.fetchall()
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.get_category_stats()
+
+def get_category_count_drift():
+    """
+    カテゴリごとの短歌数カウンタを全件集計と比較
+    Returns: [(category_name, stored_count, actual_count), ...] 一致しないカテゴリのみ
+    """
+    return backend.get_category_count_drift()
+
+def recount_category_counts():
+    """カテゴリごとの短歌数カウンタを全件集計で上書き（ずれていた場合の修復用）"""
+    backend.recount_category_counts()
 
 # ==================== 交換履歴（Foreign Key活用） ====================
 
 def record_exchange(user_id, given_tanka_id, given_content, received_tanka_id, received_content):
     """
     交換履歴を記録（Foreign Key制約あり）
-    
+
     SQL要素: Foreign Key制約による参照整合性
     user_id は users テーブルに存在する必要がある
-    
+
     Returns: exchange_id
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            INSERT INTO exchange_history(
-                user_id, 
-                given_tanka_id, 
-                given_tanka_content,
-                received_tanka_id,
-                received_tanka_content
-            ) VALUES (%s, %s, %s, %s, %s)
-            RETURNING exchange_id
-        """, (user_id, given_tanka_id, given_content, received_tanka_id, received_content))
-        exchange_id = cursor.fetchone()[0]
-        
-        # exchange_countをインクリメント
-        cursor.execute("""
-            UPDATE tanka_pool 
-            SET exchange_count = exchange_count + 1 
-            WHERE id = %s
-        """, (received_tanka_id,))
-        
-        conn.commit()
-        return exchange_id
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.record_exchange(user_id, given_tanka_id, given_content, received_tanka_id, received_content)
+
+def perform_exchange(user_id, content, embedding=None):
+    """
+    短歌交換を1トランザクションで実行
+    1. 自分以外の短歌をランダムに1件選ぶ（PostgreSQL: FOR UPDATE SKIP LOCKED / SQLite: 書き込みロック）
+    2. ユーザーの短歌をINSERT
+    3. 交換履歴をINSERT
+    4. 受け取った短歌をDELETE
+
+    同時に交換した2人が同じ短歌を受け取ることはない。
+    交換できる短歌が無い場合は何も変更せず None を返す。
+
+    Returns: (received_tanka_id, received_content, given_tanka_id, exchange_id) or None
+    """
+    result = backend.perform_exchange(user_id, content, embedding)
+    if result:
+        invalidate_pool_count()
+        on_tanka_deleted(result[0])
+        on_tanka_removed(result[0])
+        on_tanka_saved(result[2], user_id, content, embedding)
+    return result
 
 def get_user_exchange_history(user_id, limit=20):
     """
     ユーザーの交換履歴を取得
-    
+
     SQL要素: Foreign Key, ORDER BY, LIMIT
-    
+
     Returns: [(exchange_id, given_content, received_content, exchanged_at), ...]
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT 
-                exchange_id,
-                given_tanka_content,
-                received_tanka_content,
-                exchanged_at
-            FROM exchange_history
-            WHERE user_id = %s
-            ORDER BY exchanged_at DESC
-            LIMIT %s
-        """, (user_id, limit))
-        return cursor.fetchall()
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.get_user_exchange_history(user_id, limit)
 
 # ==================== 複雑なJOIN ====================
 
 def get_user_exchange_stats(user_id):
     """
     ユーザーの交換統計（複数テーブルのJOIN）
-    
+
     SQL要素: JOIN, COUNT, MIN, MAX, GROUP BY
     users JOIN exchange_history で統計を取得
-    
+
     Returns: {
         'total_exchanges': int,
         'first_exchange': datetime,
@@ -398,45 +366,20 @@ def get_user_exchange_stats(user_id):
         'session_id': str
     }
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT 
-                u.session_id,
-                COUNT(eh.exchange_id) as total_exchanges,
-                MIN(eh.exchanged_at) as first_exchange,
-                MAX(eh.exchanged_at) as last_exchange
-            FROM users u
-            LEFT JOIN exchange_history eh ON u.user_id = eh.user_id
-            WHERE u.user_id = %s
-            GROUP BY u.user_id, u.session_id
-        """, (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            return {
-                'session_id': result[0],
-                'total_exchanges': result[1],
-                'first_exchange': result[2],
-                'last_exchange': result[3]
-            }
-        return None
-    finally:
-        cursor.close()
-        conn.close()
+    result = backend.get_user_exchange_stats(user_id)
+    if result:
+        return {
+            'session_id': result[0],
+            'total_exchanges': result[1],
+            'first_exchange': result[2],
+            'last_exchange': result[3]
+        }
+    return None
 
 def get_all_categories():
     """
-    全カテゴリを取得
-    
-    Returns: [(category_id, name, description), ...]
+    全カテゴリを取得（短歌数はカウンタ列から）
+
+    Returns: [(category_id, name, description, tanka_count), ...]
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT category_id, name, description FROM categories ORDER BY name")
-        return cursor.fetchall()
-    finally:
-        cursor.close()
-        conn.close()
+    return backend.get_all_categories()
@@ -0,0 +1,190 @@
+"""
+prefork.py - マルチプロセス（master / worker）サーバー
+GILがあるため1プロセスではテンプレート描画やJSON生成に1コアしか使えない。
+親プロセス（master）が待ち受けソケットを1つ開き、fork した N 個のワーカープロセスが
+同じソケットから接続を受け付ける（カーネルが各ワーカーに振り分ける）
+
+- 各ワーカーは自分のDB接続プール・キャッシュ・埋め込みワーカーを持つ（fork後に遅延生成）
+- ワーカーが異常終了したら master が起動し直す
+- SIGHUP: グレースフルリスタート（新しいワーカーを起動してから、古いワーカーに SIGTERM）
+- SIGTERM / SIGINT: 全ワーカーに SIGTERM を送り、処理中のリクエストが終わるのを待って終了
+- ワーカーは SIGTERM を受けると新規の受け付けをやめ、処理中の接続が無くなったら終了する
+  （graceful_timeout 秒を過ぎたら打ち切る）
+
+os.fork を使うため Unix 専用（Windows では server.py が単一プロセスで起動する）
+"""
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+
+def can_fork():
+    return hasattr(os, 'fork')
+
+
+def bind_socket(host, port, backlog=2048):
+    """ワーカー間で共有する待ち受けソケットを作成"""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+# ==================== ワーカー（子プロセス） ====================
+
+def _drain_waitress(server, graceful_timeout):
+    """新規の受け付けをやめ、処理中の接続が無くなったら（または期限で）プロセスを終了"""
+    server.accepting = False
+    deadline = time.monotonic() + graceful_timeout
+    while server.active_channels and time.monotonic() < deadline:
+        time.sleep(0.1)
+    os._exit(0)
+
+
+def serve_worker(sock, mode, threads, graceful_timeout):
+    """ワーカープロセスの本体: 共有ソケットでリクエストを処理する"""
+    # Ctrl+C はプロセスグループ全体に届くため、ワーカーは無視して master の SIGTERM で止まる
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # 埋め込み生成ワーカーは fork 後に各プロセスで起動する（スレッドは fork で引き継がれない）
+    from .embedding_worker import start_embedding_worker
+    start_embedding_worker()
+
+    if mode == 'asgi':
+        import uvicorn
+        from .asgi import asgi_app
+        # uvicorn は SIGTERM で受け付けを止め、処理中のリクエストを待ってから終了する
+        config = uvicorn.Config(asgi_app, access_log=False, log_level='warning',
+                                timeout_graceful_shutdown=int(graceful_timeout))
+        uvicorn.Server(config).run(sockets=[sock])
+        return
+
+    from waitress.server import create_server
+    from .main import app
+    server = create_server(app, sockets=[sock], threads=threads)
+
+    def on_terminate(signum, frame):
+        threading.Thread(target=_drain_waitress, args=(server, graceful_timeout), daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_terminate)
+    server.run()
+
+
+# ==================== master（親プロセス） ====================
+
+class PreforkServer:
+    """ワーカープロセスの起動・監視・再起動を行う master"""
+
+    def __init__(self, sock, workers, mode='waitress', threads=4, graceful_timeout=30.0, on_reload=None):
+        self.sock = sock
+        self.num_workers = max(workers, 1)
+        self.mode = mode
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        # SIGHUP でワーカーを入れ替える前に master で実行する処理（索引の再読み込みなど）
+        self.on_reload = on_reload
+        self.generation = 0
+        self.workers = {}  # pid -> (世代, 起動時刻)
+        self._restart_requested = False
+        self._stop_requested = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                serve_worker(self.sock, self.mode, self.threads, self.graceful_timeout)
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        self.workers[pid] = (self.generation, time.monotonic())
+        return pid
+
+    def _reap(self):
+        """終了したワーカーを回収し、現役の世代が異常終了していたら起動し直す"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation, started = self.workers.pop(pid, (None, 0.0))
+            if generation != self.generation or self._stop_requested:
+                continue
+            print(f"[!] ワーカー(pid {pid})が終了しました（status {status}）。起動し直します")
+            if time.monotonic() - started < 1.0:
+                # 起動直後に落ち続ける場合に fork を連打しない
+                time.sleep(1.0)
+            self.spawn()
+
+    def _restart(self):
+        """新しい世代のワーカーを起動してから、古い世代を順に止める"""
+        self._restart_requested = False
+        print("[*] グレースフルリスタートを開始します")
+        if self.on_reload:
+            try:
+                self.on_reload()
+            except Exception as e:
+                print(f"[!] 再読み込みに失敗しました（既存の状態のまま再起動します）: {e}")
+        old_pids = list(self.workers)
+        self.generation += 1
+        for _ in range(self.num_workers):
+            self.spawn()
+        for pid in old_pids:
+            self._kill(pid, signal.SIGTERM)
+        print(f"[v] ワーカーを入れ替えました（{len(old_pids)} → {self.num_workers} プロセス）")
+
+    @staticmethod
+    def _kill(pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _shutdown(self):
+        print("\n[*] ワーカーを停止しています...")
+        for pid in list(self.workers):
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self._kill(pid, signal.SIGKILL)
+        self.sock.close()
+
+    def run(self):
+        """ワーカーを起動し、停止シグナルを受けるまで監視する（ブロック）"""
+        def request_restart(signum, frame):
+            self._restart_requested = True
+
+        def request_stop(signum, frame):
+            self._stop_requested = True
+
+        signal.signal(signal.SIGHUP, request_restart)
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        for _ in range(self.num_workers):
+            self.spawn()
+        print(f"[v] {self.num_workers} 個のワーカープロセスを起動しました（master pid {os.getpid()}）")
+        print(f"  (グレースフルリスタート: kill -HUP {os.getpid()})")
+
+        while not self._stop_requested:
+            self._reap()
+            if self._restart_requested:
+                self._restart()
+            time.sleep(0.5)
+        self._shutdown()
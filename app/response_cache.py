@@ -0,0 +1,228 @@
+"""
+response_cache.py - AI歌人の応答の意味的キャッシュ
+「失恋した」「振られて悲しい」のような言い回し違いの相談に、過去の応答を使い回す
+
+- キー: 相談文の埋め込みベクトル（コサイン類似度が threshold 以上なら同じ相談とみなす）
+- 値: 生成済みの応答 + 参考にした短歌（id, 本文）
+- TTL（秒）と件数上限（LRU）で追い出す
+- 正規化済みの埋め込みは件数上限ぶん確保した float32 行列に持ち、参照は行列積1回（追加・削除は行単位）
+- 参考短歌が交換で引き取られたら、その短歌を参照する応答を無効化する
+  （他プロセスでの交換はヒット時にプールへの存在確認で検出する）
+"""
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # numpy が無い場合は純Pythonで類似度を計算する
+    np = None
+
+from .config import RESPONSE_CACHE_CONFIG
+
+
+def _normalize(vector):
+    if np is not None:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+    norm = sum(x * x for x in vector) ** 0.5 or 1.0
+    return [x / norm for x in vector]
+
+
+class SemanticResponseCache:
+    """埋め込みの近さで引く応答キャッシュ（LRU + TTL）"""
+
+    def __init__(self, threshold=0.92, ttl=3600.0, max_size=512):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # entry_id -> エントリ
+        self._by_tanka = {}            # tanka_id -> {entry_id, ...}
+        # numpy がある場合、正規化済み埋め込みは行列に持つ（vector_index と同じく、削除は末尾の行を移動）
+        self._matrix = None            # (max_size, 次元) float32。最初の store で確保
+        self._row_ids = [None] * max_size  # 行番号 -> entry_id
+        self._positions = {}           # entry_id -> 行番号
+        self._size = 0
+        self._next_id = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'invalidated': 0,   # 参考短歌の交換で無効化した件数
+            'evicted': 0,       # 件数上限で追い出した件数
+        }
+
+    def _drop(self, entry_id):
+        """エントリを削除（ロック内で呼ぶ）"""
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        entry_ids = self._by_tanka.get(entry['tanka_id'])
+        if entry_ids is not None:
+            entry_ids.discard(entry_id)
+            if not entry_ids:
+                del self._by_tanka[entry['tanka_id']]
+        row = self._positions.pop(entry_id, None)
+        if row is not None:
+            last = self._size - 1
+            if row != last:
+                self._matrix[row] = self._matrix[last]
+                self._row_ids[row] = self._row_ids[last]
+                self._positions[self._row_ids[row]] = row
+            self._row_ids[last] = None
+            self._size = last
+
+    def _add_row(self, entry_id, vector):
+        """正規化済み埋め込みを行列の末尾に書き込む（ロック内で呼ぶ。空きは store が作っておく）"""
+        if self._matrix is None or self._matrix.shape[1] != len(vector):
+            # 初回、または埋め込みの次元が変わった（モデル変更）場合は確保し直す
+            for old_id in list(self._positions):
+                self._drop(old_id)
+            self._matrix = np.zeros((self.max_size, len(vector)), dtype=np.float32)
+        row = self._size
+        self._matrix[row] = vector
+        self._row_ids[row] = entry_id
+        self._positions[entry_id] = row
+        self._size += 1
+
+    def _best_match(self, query):
+        """最も近いエントリの (entry_id, 類似度)（ロック内で呼ぶ）"""
+        if not self._entries:
+            return None, 0.0
+        if np is not None:
+            if len(query) != self._matrix.shape[1]:
+                return None, 0.0
+            scores = self._matrix[:self._size] @ query
+            best = int(np.argmax(scores))
+            return self._row_ids[best], float(scores[best])
+        best_id, best_score = None, -1.0
+        for entry_id, entry in self._entries.items():
+            score = sum(a * b for a, b in zip(entry['embedding'], query))
+            if score > best_score:
+                best_id, best_score = entry_id, score
+        return best_id, best_score
+
+    def match(self, embedding):
+        """
+        相談文の埋め込みに最も近いエントリを探す（メモリ内のみ。DBには触れない）
+        Returns: (entry_id, エントリのコピー, 類似度) or None（ミスとして数える）
+        """
+        query = _normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            # 期限切れを先に追い出す（古い順に並んでいるとは限らないので全件確認）
+            for entry_id in [i for i, e in self._entries.items() if e['expires_at'] <= now]:
+                self._drop(entry_id)
+                self._stats['expired'] += 1
+            entry_id, similarity = self._best_match(query)
+            entry = self._entries.get(entry_id) if similarity >= self.threshold else None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            return entry_id, dict(entry), similarity
+
+    def confirm(self, candidate, tanka, exclude_user_id=None):
+        """
+        match() の候補を、参考短歌の現在の行（get_pool_tanka の結果）で確かめる
+        参考短歌がまだプールにあり、相談者自身の歌でなければヒット
+        Returns: {'response', 'tanka_id', 'tanka_content', 'similarity'} or None
+        """
+        entry_id, entry, similarity = candidate
+        if tanka is None or (exclude_user_id is not None and tanka[2] == exclude_user_id):
+            with self._lock:
+                if tanka is None:
+                    self._drop(entry_id)
+                    self._stats['invalidated'] += 1
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            if entry_id in self._entries:
+                self._entries.move_to_end(entry_id)
+            self._stats['hits'] += 1
+        return {
+            'response': entry['response'],
+            'tanka_id': entry['tanka_id'],
+            'tanka_content': entry['tanka_content'],
+            'similarity': similarity,
+        }
+
+    def lookup(self, embedding, exclude_user_id=None):
+        """
+        相談文の埋め込みに近い応答を探す（match → プールへの存在確認 → confirm）
+        Returns: {'response', 'tanka_id', 'tanka_content', 'similarity'} or None
+        """
+        from .models import get_pool_tanka
+
+        candidate = self.match(embedding)
+        if candidate is None:
+            return None
+        return self.confirm(candidate, get_pool_tanka(candidate[1]['tanka_id']), exclude_user_id)
+
+    def store(self, embedding, tanka_id, tanka_content, response):
+        """生成した応答を保存"""
+        vector = _normalize(embedding)
+        with self._lock:
+            # 先に追い出して、行列に空きを作ってから書き込む
+            while len(self._entries) >= self.max_size:
+                self._drop(next(iter(self._entries)))
+                self._stats['evicted'] += 1
+            entry_id = self._next_id
+            self._next_id += 1
+            entry = {
+                'tanka_id': tanka_id,
+                'tanka_content': tanka_content,
+                'response': response,
+                'expires_at': time.monotonic() + self.ttl,
+            }
+            if np is not None:
+                self._add_row(entry_id, vector)
+            else:
+                entry['embedding'] = vector
+            self._entries[entry_id] = entry
+            self._by_tanka.setdefault(tanka_id, set()).add(entry_id)
+
+    def invalidate_tanka(self, tanka_id):
+        """短歌がプールから無くなったとき、それを参照する応答を削除"""
+        with self._lock:
+            for entry_id in list(self._by_tanka.get(tanka_id, ())):
+                self._drop(entry_id)
+                self._stats['invalidated'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        stats['max_size'] = self.max_size
+        stats['threshold'] = self.threshold
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        # ヒットした分だけ文章生成（とベクトル探索）の呼び出しを省いた
+        stats['generations_saved'] = stats['hits']
+        return stats
+
+
+_cache = SemanticResponseCache(
+    threshold=RESPONSE_CACHE_CONFIG['threshold'],
+    ttl=RESPONSE_CACHE_CONFIG['ttl'],
+    max_size=RESPONSE_CACHE_CONFIG['max_size'],
+)
+
+
+def get_response_cache():
+    """応答キャッシュを取得（無効化されていれば None）"""
+    return _cache if RESPONSE_CACHE_CONFIG['enabled'] else None
+
+
+def on_tanka_removed(tanka_id):
+    """短歌が交換・削除でプールから無くなったことを応答キャッシュに反映"""
+    _cache.invalidate_tanka(tanka_id)
+
+
+def get_response_cache_stats():
+    """応答キャッシュの統計。無効なら None"""
+    if not RESPONSE_CACHE_CONFIG['enabled']:
+        return None
+    return _cache.stats()
@@ -0,0 +1,168 @@
+"""
+startup.py - 起動処理（server.py / desktop_app.py / python -m app.main で共通）
+1. DB接続確認（1回だけ、短いタイムアウト）
+2. 接続できない場合のみ Docker でDBを起動（DOCKER_AUTOSTART=1 のときだけ）→ 起動待ち
+3. スキーマ初期化・未適用のマイグレーションの適用（schema_version が最新なら1クエリで省略）
+4. メモリ内ベクトル索引の読み込み（VECTOR_SEARCH_BACKEND=memory の場合のみ）
+5. 埋め込み生成ワーカーの起動（未生成の行の定期的な掃除を始める。start_worker=False で省略）
+（STORAGE_BACKEND=sqlite の場合は 1〜2 を行わず、DBファイルのスキーマ確認と索引の読み込みのみ）
+
+各段階の所要時間を表示し、再起動・デプロイのどこに時間がかかっているかを確認できるようにする。
+進行状況は get_readiness() で参照でき、/healthz（readiness probe）とデスクトップ版の
+スプラッシュ画面が使う
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+from .config import DB_CONFIG, DOCKER_AUTOSTART, STORAGE_BACKEND
+
+# 起動処理の進行状況
+#   pending: prepare_environment() を実行していない（/healthz はDBに直接確認する）
+#   starting: 実行中 / ready: 完了 / failed: 失敗
+_readiness = {'state': 'pending', 'phase': None, 'error': None}
+_readiness_lock = threading.Lock()
+
+
+def _set_readiness(**changes):
+    with _readiness_lock:
+        _readiness.update(changes)
+
+
+def mark_starting():
+    """
+    起動処理中にする（prepare_environment() を別スレッドで実行する場合、サーバーより先に呼ぶ。
+    pending のままだと /healthz がDBに直接確認して、起動処理の前に ready を返してしまう）
+    """
+    _set_readiness(state='starting', phase=None, error=None)
+
+
+def get_readiness():
+    """起動処理の進行状況（state, phase, error）"""
+    with _readiness_lock:
+        return dict(_readiness)
+
+
+class StartupTimer:
+    """起動処理の段階ごとの所要時間を記録"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []  # [(段階名, 秒), ...]
+
+    @contextmanager
+    def phase(self, name):
+        _set_readiness(phase=name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self):
+        total = time.perf_counter() - self.started
+        print(f"[*] 起動処理の所要時間: {total * 1000:.0f}ms")
+        for name, seconds in self.phases:
+            print(f"   - {name}: {seconds * 1000:.0f}ms")
+
+
+def database_is_reachable(timeout=2):
+    """DBに1回だけ接続を試す"""
+    try:
+        psycopg2.connect(connect_timeout=timeout, **DB_CONFIG).close()
+        return True
+    except psycopg2.OperationalError:
+        return False
+
+
+def load_vector_index_if_enabled(reload=False):
+    """メモリ内ベクトル索引の読み込み（VECTOR_SEARCH_BACKEND=memory の場合のみ。reload=True で読み直す）"""
+    from .vector_index import get_vector_index, load_vector_index, get_vector_index_stats
+    if get_vector_index() is None:
+        return
+    if reload:
+        load_vector_index()
+    index_stats = get_vector_index_stats()
+    print(f"[v] ベクトル索引をメモリに読み込みました（{index_stats['size']}件, "
+          f"{index_stats['memory_bytes'] / 1024 / 1024:.1f}MB）")
+
+
+def prepare_environment(timer=None, start_worker=True):
+    """
+    アプリケーションを起動できる状態にする
+    start_worker: 埋め込み生成ワーカーをこのプロセスで起動するか
+                  （fork するマルチプロセス時は False にし、各ワーカープロセスで起動する）
+    Returns: 準備できたら True、DBに接続できなければ False
+    """
+    mark_starting()
+    try:
+        ready = _prepare_environment(timer or StartupTimer())
+    except BaseException as e:
+        # Docker未導入時の sys.exit なども失敗として記録してから伝える
+        if isinstance(e, Exception):
+            error = f"{type(e).__name__}: {e}"
+        else:
+            error = "起動処理が中断されました（詳細はコンソールを確認してください）"
+        _set_readiness(state='failed', error=error)
+        raise
+    if ready:
+        if start_worker:
+            from .embedding_worker import start_embedding_worker
+            start_embedding_worker()
+        _set_readiness(state='ready', phase=None)
+    else:
+        _set_readiness(state='failed', error='データベースに接続できませんでした')
+    return ready
+
+
+def _prepare_environment(timer):
+    if STORAGE_BACKEND == 'sqlite':
+        return _prepare_sqlite(timer)
+
+    from .docker_env import setup_docker_environment, wait_for_database
+
+    # 1. DB接続確認（起動済みなら Docker の確認はすべて省略）
+    with timer.phase("DB接続確認"):
+        reachable = database_is_reachable()
+
+    if reachable:
+        print("[v] データベースに接続しました")
+    else:
+        # 2. Docker環境のセットアップ（DOCKER_AUTOSTART=1 の場合のみ）
+        if DOCKER_AUTOSTART:
+            with timer.phase("Docker環境のセットアップ"):
+                setup_docker_environment()
+        else:
+            print("[!] データベースに接続できません（DOCKER_AUTOSTART=1 で Docker から自動起動できます）")
+
+        with timer.phase("DB起動待ち"):
+            if not wait_for_database():
+                return False
+
+    # 3. データベース初期化（スキーマが最新なら省略）
+    with timer.phase("スキーマ確認・初期化"):
+        from scripts.init_db import init_database
+        init_database()
+
+    # 4. メモリ内ベクトル索引の読み込み
+    with timer.phase("ベクトル索引の読み込み"):
+        load_vector_index_if_enabled()
+
+    timer.report()
+    return True
+
+
+def _prepare_sqlite(timer):
+    """組み込みSQLiteの準備（Docker・DBサーバーは不要）"""
+    from .storage.sqlite import init_schema
+
+    with timer.phase("SQLiteのスキーマ確認・初期化"):
+        init_schema()
+
+    with timer.phase("ベクトル索引の読み込み"):
+        load_vector_index_if_enabled()
+
+    timer.report()
+    return True
@@ -0,0 +1,23 @@
+"""
+storage - 永続化層（models.py から使う）
+STORAGE_BACKEND で実装を選ぶ:
+- postgres: PostgreSQL + pgvector（storage/postgres.py, サーバー用）
+- sqlite: 組み込み SQLite + NumPy（storage/sqlite.py, デスクトップ用。Docker不要）
+
+どちらも同じ名前・同じ戻り値の関数を持ち、SQLの実行だけを担当する
+（キャッシュの無効化・ベクトル索引の差分更新などは models.py が行う）
+"""
+from ..config import STORAGE_BACKEND
+
+if STORAGE_BACKEND == 'sqlite':
+    from . import sqlite as backend
+else:
+    from . import postgres as backend
+
+
+def get_storage_stats():
+    """保存先の種類（SQLite の場合はファイルサイズなども）"""
+    stats = {'backend': STORAGE_BACKEND}
+    if STORAGE_BACKEND == 'sqlite':
+        stats.update(backend.get_sqlite_stats())
+    return stats
@@ -0,0 +1,598 @@
+"""
+storage/postgres.py - PostgreSQL + pgvector の永続化層（サーバー用）
+Foreign Key, JOIN, SubQuery, CTE, pgvector を使用したSQLを実行する
+（キャッシュの無効化・ベクトル索引の差分更新は models.py が行う）
+"""
+import json
+import random
+import time
+
+import psycopg2
+import psycopg2.errors
+
+from ..db_pool import db_cursor, db_connection
+from ..config import DB_CONFIG, VECTOR_SEARCH_CONFIG
+
+# DB操作の失敗として扱う例外（埋め込みキャッシュなどで使用）
+DatabaseError = psycopg2.Error
+# 存在しない user_id での書き込み（DBを作り直した後に古いセッションが残っていた場合など）
+ForeignKeyViolation = psycopg2.errors.ForeignKeyViolation
+
+# 交換がデッドロックで中断されたときの再試行回数
+# （件数カウンタは1トランザクション1スロットだが、カテゴリのカウンタなど他のトリガーの行ロックでも起こりうる）
+EXCHANGE_DEADLOCK_RETRIES = 3
+
+# 人気ランキングの再集計を1プロセスだけが行うためのアドバイザリロックのキー
+POPULARITY_REFRESH_LOCK = 7210023
+
+
+def ping():
+    """DBに接続できるか確認（失敗時は例外）"""
+    with db_cursor() as cursor:
+        cursor.execute("SELECT 1")
+
+def format_database_identity(database, users_oid):
+    return f"postgres:{DB_CONFIG['host']}:{DB_CONFIG['port']}/{database}:{users_oid}"
+
+def database_identity():
+    """
+    接続先DBの識別子（セッションに保存した user_id がどのDBのものかの確認用）
+    users テーブルのOIDを含めるため、init_db.py --reset で作り直すと変わる
+    """
+    with db_cursor() as cursor:
+        cursor.execute("SELECT current_database(), 'users'::regclass::oid")
+        return format_database_identity(*cursor.fetchone())
+
+# ==================== ユーザー管理 ====================
+
+def get_or_create_user(session_id):
+    """
+    SQL要素: INSERT ... ON CONFLICT ... RETURNING（UPSERT）
+    SELECT → INSERT の2段階だと同じセッションの同時リクエストで競合するため、
+    1ステートメントで「取得または作成」を行う
+    """
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("""
+            INSERT INTO users(session_id) VALUES (%s)
+            ON CONFLICT (session_id) DO UPDATE SET session_id = EXCLUDED.session_id
+            RETURNING user_id
+        """, (session_id,))
+        return cursor.fetchone()[0]
+
+# ==================== 短歌操作（基本） ====================
+
+# 主要クエリのSQL（scripts/check_query_plans.py も同じ文字列を EXPLAIN する）
+RANDOM_TANKA_QUERY = """
+    SELECT id, content FROM tanka_pool
+    WHERE random_key >= %(start_key)s
+    AND (%(exclude_user_id)s IS NULL OR user_id IS NULL OR user_id != %(exclude_user_id)s)
+    ORDER BY random_key
+    LIMIT 1
+"""
+
+def select_random_tanka(cursor, exclude_user_id=None):
+    """
+    ランダムに1件選ぶ（カーソルを受け取る内部処理。ベンチマークからも使用）
+
+    ORDER BY RANDOM() は全件をソートするため、プールの件数に比例して遅くなる。
+    代わりに各行へ乱数キー random_key（インデックス付き）を持たせ、
+    乱数の位置からインデックスを昇順に辿って最初の1件を取る（O(log N)）。
+    乱数より後ろに行が無ければ先頭から探し直す（ラップアラウンド）。
+    """
+    for start_key in (random.random(), 0.0):
+        cursor.execute(RANDOM_TANKA_QUERY, {'start_key': start_key, 'exclude_user_id': exclude_user_id or None})
+        result = cursor.fetchone()
+        if result:
+            return result
+    return None
+
+def get_random_tanka(exclude_user_id=None):
+    with db_cursor() as cursor:
+        return select_random_tanka(cursor, exclude_user_id)
+
+def similarity_candidates(limit, exclude_user_id=None):
+    """近似探索で内側のクエリが取る候補数（自分の歌を除外する場合は多めに取る）"""
+    return max(limit * 4, limit + 20) if exclude_user_id else limit
+
+def similarity_search_params(candidates, ef_search=None, probes=None):
+    """近似探索の精度パラメータ（set_config に渡す文字列）。HNSWは ef_search 件までしか返さないため候補数以上にする"""
+    ef_search = max(ef_search or VECTOR_SEARCH_CONFIG['ef_search'], candidates)
+    probes = probes or VECTOR_SEARCH_CONFIG['probes']
+    return str(ef_search), str(probes)
+
+def needs_exact_fallback(results, limit, exclude_user_id, exact):
+    """近傍候補が自分の歌で埋まって件数が足りない場合のみ厳密探索に切り替える"""
+    return len(results) < limit and bool(exclude_user_id) and not exact
+
+def pyformat_placeholder(name, cast=None):
+    """psycopg2 のパラメータ（%(name)s）"""
+    return f"%({name})s::{cast}" if cast else f"%({name})s"
+
+def build_similarity_query(placeholder, exact=False):
+    """
+    ベクトル探索のSQL（同期版・asyncpg版で共通。placeholder(name, cast) がパラメータの書き方を決める）
+    パラメータ: embedding, exclude_user_id, limit（近似探索のみ candidates）
+
+    - 近似探索: 除外条件をインデックス探索と同じWHEREに書くと、近似探索が返した候補を
+      後から絞り込むことになり件数が不足するため、内側で条件なしに candidates 件を取り、外側で除外する
+    - 厳密探索: 全件を比較するので、除外条件を同じWHEREに書き、候補の多め取りもしない
+    """
+    embedding = placeholder('embedding', 'vector')
+    exclude_user_id = placeholder('exclude_user_id', 'integer')
+    exclude = f"({exclude_user_id} IS NULL OR user_id IS NULL OR user_id != {exclude_user_id})"
+    if exact:
+        return f"""
+            SELECT id, content, embedding <=> {embedding} AS distance
+            FROM tanka_pool
+            WHERE embedding IS NOT NULL
+            AND {exclude}
+            ORDER BY distance
+            LIMIT {placeholder('limit')}
+        """
+    return f"""
+        SELECT id, content, distance
+        FROM (
+            SELECT id, content, user_id, embedding <=> {embedding} AS distance
+            FROM tanka_pool
+            WHERE embedding IS NOT NULL
+            ORDER BY embedding <=> {embedding}
+            LIMIT {placeholder('candidates')}
+        ) AS nearest
+        WHERE {exclude}
+        ORDER BY distance
+        LIMIT {placeholder('limit')}
+    """
+
+def search_similar_tankas(embedding, limit=1, exclude_user_id=None,
+                          ef_search=None, probes=None, exact=False):
+    """
+    SQL要素: pgvector の <=> 演算子（コサイン距離、小さいほど似ている）, HNSW/IVFFlat インデックス
+    - ef_search / probes: 近似探索の精度パラメータ（大きいほど高精度・低速）。クエリ単位で SET LOCAL
+    - exact=True: インデックスを使わず全件を厳密に比較（精度評価の正解データにも使う）
+
+    近似探索では多めの候補から自分の歌を除外し（build_similarity_query）、
+    候補がすべて自分の歌だった場合のみ厳密探索にフォールバックする。
+    """
+    candidates = similarity_candidates(limit, exclude_user_id)
+    with db_cursor() as cursor:
+        if exact:
+            cursor.execute("SELECT set_config('enable_indexscan', 'off', true)")
+        else:
+            cursor.execute(
+                "SELECT set_config('hnsw.ef_search', %s, true), set_config('ivfflat.probes', %s, true)",
+                similarity_search_params(candidates, ef_search, probes)
+            )
+        cursor.execute(build_similarity_query(pyformat_placeholder, exact), {
+            'embedding': embedding,
+            'candidates': candidates,
+            'exclude_user_id': exclude_user_id or None,
+            'limit': limit,
+        })
+        results = cursor.fetchall()
+
+    if needs_exact_fallback(results, limit, exclude_user_id, exact):
+        exact_results = search_similar_tankas(embedding, limit, exclude_user_id, exact=True)
+        if len(exact_results) > len(results):
+            return exact_results
+    return results
+
+def update_tanka_embedding(tanka_id, embedding):
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("""
+            UPDATE tanka_pool
+            SET embedding = %s::vector
+            WHERE id = %s
+            RETURNING user_id, content
+        """, (embedding, tanka_id))
+        return cursor.fetchone()
+
+def get_tankas_without_embeddings(limit=None, tanka_ids=None):
+    with db_cursor() as cursor:
+        if tanka_ids is not None:
+            cursor.execute("""
+                SELECT id, content FROM tanka_pool
+                WHERE embedding IS NULL AND id = ANY(%s)
+                ORDER BY id LIMIT %s
+            """, (list(tanka_ids), limit))
+        else:
+            cursor.execute(
+                "SELECT id, content FROM tanka_pool WHERE embedding IS NULL ORDER BY id LIMIT %s",
+                (limit,)
+            )
+        return cursor.fetchall()
+
+def iter_tanka_embeddings():
+    """
+    埋め込みのある短歌をすべて返す（メモリ内ベクトル索引の構築用）
+    件数が多くても全件をクライアントに溜めないよう、名前付き（サーバーサイド）カーソルで読む
+    Yields: (id, user_id, content, embedding)
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor(name='vector_index_load')
+        try:
+            cursor.itersize = 2000
+            cursor.execute("""
+                SELECT id, user_id, content, embedding::text
+                FROM tanka_pool
+                WHERE embedding IS NOT NULL
+            """)
+            for tanka_id, user_id, content, embedding in cursor:
+                yield tanka_id, user_id, content, json.loads(embedding)
+        finally:
+            cursor.close()
+
+def get_pool_tanka(tanka_id):
+    with db_cursor() as cursor:
+        cursor.execute("SELECT id, content, user_id FROM tanka_pool WHERE id = %s", (tanka_id,))
+        return cursor.fetchone()
+
+def delete_tanka(tanka_id):
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("DELETE FROM tanka_pool WHERE id = %s", (tanka_id,))
+
+def insert_tanka(content, user_id=None, embedding=None):
+    with db_cursor(commit=True) as cursor:
+        cursor.execute(
+            "INSERT INTO tanka_pool(content, user_id, embedding) VALUES (%s, %s, %s) RETURNING id",
+            (content, user_id, embedding)
+        )
+        return cursor.fetchone()[0]
+
+def count_pool_tankas():
+    """
+    COUNT(*) は全件スキャンになるため、トリガーで維持しているカウンタ表
+    tanka_pool_counter（16スロット）の合計を読む
+    """
+    with db_cursor() as cursor:
+        cursor.execute("SELECT COALESCE(SUM(tanka_count), 0) FROM tanka_pool_counter")
+        result = cursor.fetchone()
+        return int(result[0]) if result else 0
+
+# ==================== JOIN使用 ====================
+
+TANKAS_BY_CATEGORY_QUERY = """
+    SELECT
+        tp.id,
+        tp.content,
+        c.name as category_name
+    FROM tanka_pool tp
+    INNER JOIN tanka_categories tc ON tp.id = tc.tanka_id
+    INNER JOIN categories c ON tc.category_id = c.category_id
+    WHERE c.name = %(category_name)s
+    ORDER BY tp.created_at DESC
+"""
+
+def get_tankas_by_category(category_name):
+    """
+    SQL要素: INNER JOIN（3テーブル結合）
+    tanka_pool JOIN tanka_categories JOIN categories
+    """
+    with db_cursor() as cursor:
+        cursor.execute(TANKAS_BY_CATEGORY_QUERY, {'category_name': category_name})
+        return cursor.fetchall()
+
+def get_tanka_with_categories(tanka_id):
+    """SQL要素: LEFT JOIN, GROUP BY, STRING_AGG"""
+    with db_cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                tp.id,
+                tp.content,
+                STRING_AGG(c.name, ', ') as categories
+            FROM tanka_pool tp
+            LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
+            LEFT JOIN categories c ON tc.category_id = c.category_id
+            WHERE tp.id = %s
+            GROUP BY tp.id, tp.content
+        """, (tanka_id,))
+        return cursor.fetchone()
+
+def get_all_tankas_with_categories():
+    """SQL要素: LEFT JOIN, GROUP BY, STRING_AGG"""
+    with db_cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                tp.id,
+                tp.content,
+                STRING_AGG(c.name, ', ') as categories,
+                tp.exchange_count
+            FROM tanka_pool tp
+            LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
+            LEFT JOIN categories c ON tc.category_id = c.category_id
+            GROUP BY tp.id, tp.content, tp.exchange_count
+            ORDER BY tp.created_at DESC
+        """)
+        return cursor.fetchall()
+
+def build_tankas_page_query(has_after):
+    """get_tankas_page のSQL（has_after: 2ページ目以降。パラメータ: created_at, id, limit）"""
+    where = "WHERE (created_at, id) < (%(created_at)s, %(id)s)" if has_after else ""
+    return f"""
+        SELECT
+            tp.id,
+            tp.content,
+            STRING_AGG(c.name, ', ') as categories,
+            tp.exchange_count,
+            tp.created_at
+        FROM (
+            SELECT id, content, exchange_count, created_at
+            FROM tanka_pool
+            {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT %(limit)s
+        ) tp
+        LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
+        LEFT JOIN categories c ON tc.category_id = c.category_id
+        GROUP BY tp.id, tp.content, tp.exchange_count, tp.created_at
+        ORDER BY tp.created_at DESC, tp.id DESC
+    """
+
+def get_tankas_page(after=None, limit=50):
+    """
+    SQL要素: キーセットページネーション（行値比較 (created_at, id) < (...)）, LEFT JOIN, STRING_AGG
+
+    OFFSET は読み飛ばす行も毎回読むため、後ろのページほど遅くなる。前のページの最後の行の
+    (created_at, id) より後ろを idx_tanka_pool_created_id から limit 件だけ読み、
+    その行にだけカテゴリを結合する（件数が増えても1ページのコストは一定）
+    after: (created_at, id) or None（先頭ページ）
+    """
+    with db_cursor() as cursor:
+        cursor.execute(build_tankas_page_query(after is not None), {
+            'created_at': after[0] if after else None,
+            'id': after[1] if after else None,
+            'limit': limit,
+        })
+        return cursor.fetchall()
+
+# ==================== SubQuery使用 ====================
+
+POPULAR_TANKAS_QUERY = """
+    SELECT pop.id, pop.content, pop.exchange_count, pop.categories
+    FROM tanka_popularity pop
+    WHERE EXISTS (SELECT 1 FROM tanka_pool tp WHERE tp.id = pop.id)
+    ORDER BY pop.exchange_count DESC, pop.id
+    LIMIT %(limit)s
+"""
+
+def get_popular_tankas(limit=10):
+    """
+    SQL要素: MATERIALIZED VIEW, EXISTS, ORDER BY, LIMIT
+
+    交換回数・カテゴリは tanka_popularity（scripts/init_db.py で作成）に集計済み。
+    (exchange_count DESC, id) のインデックスを先頭から読み、
+    集計後に交換で引き取られた短歌は EXISTS で除く
+    """
+    with db_cursor() as cursor:
+        cursor.execute(POPULAR_TANKAS_QUERY, {'limit': limit})
+        return cursor.fetchall()
+
+def refresh_popularity():
+    """
+    人気ランキングを再集計
+
+    SQL要素: REFRESH MATERIALIZED VIEW CONCURRENTLY, pg_try_advisory_xact_lock
+    CONCURRENTLY のため再集計中も読み込みは止まらない。
+    他のプロセスが再集計中ならロックを取れずに何もしない
+    Returns: 再集計したら True
+    """
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (POPULARITY_REFRESH_LOCK,))
+        if not cursor.fetchone()[0]:
+            return False
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY tanka_popularity")
+    return True
+
+def get_category_stats():
+    """
+    SQL要素: トリガーで維持しているカウンタ列（categories.tanka_count）
+
+    カテゴリごとの短歌数は tanka_categories の変更時にトリガーが更新しているため、集計は行わない
+    """
+    with db_cursor() as cursor:
+        cursor.execute("""
+            SELECT name, tanka_count, description
+            FROM categories
+            ORDER BY tanka_count DESC
+        """)
+        return cursor.fetchall()
+
+def get_category_count_drift():
+    """
+    categories.tanka_count と全件集計を比較（1ステートメント＝同じスナップショットで比較する）
+    Returns: [(name, stored_count, actual_count), ...] 一致しないカテゴリのみ
+    """
+    with db_cursor() as cursor:
+        cursor.execute("""
+            SELECT name, stored_count, actual_count
+            FROM (
+                SELECT
+                    c.name,
+                    c.tanka_count AS stored_count,
+                    (SELECT COUNT(*) FROM tanka_categories tc
+                     WHERE tc.category_id = c.category_id) AS actual_count
+                FROM categories c
+            ) counts
+            WHERE stored_count <> actual_count
+            ORDER BY name
+        """)
+        return cursor.fetchall()
+
+def recount_category_counts():
+    """
+    categories.tanka_count を全件集計で上書き
+    集計中に関連付けが変わらないよう tanka_categories をロックする（交換はこの間待たされる）
+    """
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("LOCK TABLE tanka_categories IN SHARE ROW EXCLUSIVE MODE")
+        cursor.execute("""
+            UPDATE categories c
+            SET tanka_count = (SELECT COUNT(*) FROM tanka_categories tc WHERE tc.category_id = c.category_id)
+        """)
+
+# ==================== 交換履歴（Foreign Key活用） ====================
+
+def record_exchange(user_id, given_tanka_id, given_content, received_tanka_id, received_content):
+    """
+    SQL要素: Foreign Key制約による参照整合性
+    user_id は users テーブルに存在する必要がある
+    """
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("""
+            INSERT INTO exchange_history(
+                user_id,
+                given_tanka_id,
+                given_tanka_content,
+                received_tanka_id,
+                received_tanka_content
+            ) VALUES (%s, %s, %s, %s, %s)
+            RETURNING exchange_id
+        """, (user_id, given_tanka_id, given_content, received_tanka_id, received_content))
+        # 受け取った短歌は直後に削除されるため、exchange_countの更新は行わない
+        exchange_id = cursor.fetchone()[0]
+        return exchange_id
+
+def build_exchange_query(placeholder):
+    """
+    交換（perform_exchange）のSQL（同期版・asyncpg版で共通。placeholder は build_similarity_query と同じ）
+    パラメータ: start_key, user_id, content, embedding
+    """
+    start_key = placeholder('start_key')
+    user_id = placeholder('user_id')
+    content = placeholder('content')
+    embedding = placeholder('embedding', 'vector')
+    return f"""
+        WITH received AS (
+            SELECT id, content
+            FROM tanka_pool
+            WHERE random_key >= {start_key}
+            AND (user_id IS NULL OR user_id != {user_id})
+            ORDER BY random_key
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        ),
+        given AS (
+            INSERT INTO tanka_pool(content, user_id, embedding)
+            SELECT {content}, {user_id}, {embedding}
+            FROM received
+            RETURNING id
+        ),
+        removed AS (
+            DELETE FROM tanka_pool
+            WHERE id IN (SELECT id FROM received)
+        ),
+        history AS (
+            INSERT INTO exchange_history(
+                user_id,
+                given_tanka_id,
+                given_tanka_content,
+                received_tanka_id,
+                received_tanka_content
+            )
+            SELECT {user_id}, given.id, {content}, received.id, received.content
+            FROM received, given
+            RETURNING exchange_id
+        )
+        SELECT received.id, received.content, given.id, history.exchange_id
+        FROM received, given, history
+    """
+
+EXCHANGE_QUERY = build_exchange_query(pyformat_placeholder)
+
+def perform_exchange(user_id, content, embedding=None):
+    """
+    SQL要素: CTE（データ変更を含むWITH句）, SELECT FOR UPDATE SKIP LOCKED
+    1. 自分以外の短歌をランダムに1件選んで行ロック（ロック中の行はスキップ）
+       ※ random_keyインデックスで選ぶため、末尾まで空振りした場合のみ2ステートメント目で先頭から探す
+    2. ユーザーの短歌をINSERT
+    3. 交換履歴をINSERT
+    4. 受け取った短歌をDELETE
+
+    SKIP LOCKEDにより、同時に交換した2人が同じ短歌を受け取ることはない。
+    デッドロックで中断された場合は（ロールバック済みなので）少し待って最初からやり直す
+    """
+    for attempt in range(EXCHANGE_DEADLOCK_RETRIES + 1):
+        try:
+            with db_cursor(commit=True) as cursor:
+                # 乱数キーの位置から探索し、見つからなければ先頭から（select_random_tankaと同じ方式）
+                for start_key in (random.random(), 0.0):
+                    result = _exchange_from(cursor, start_key, user_id, content, embedding)
+                    if result:
+                        return result
+            return None
+        except psycopg2.errors.DeadlockDetected:
+            if attempt == EXCHANGE_DEADLOCK_RETRIES:
+                raise
+            time.sleep(random.uniform(0.005, 0.02) * (attempt + 1))
+
+def _exchange_from(cursor, start_key, user_id, content, embedding):
+    """perform_exchange の本体（random_key >= start_key の範囲から1件受け取る）"""
+    cursor.execute(EXCHANGE_QUERY, {
+        'start_key': start_key, 'user_id': user_id, 'content': content, 'embedding': embedding,
+    })
+    return cursor.fetchone()
+
+USER_EXCHANGE_HISTORY_QUERY = """
+    SELECT
+        exchange_id,
+        given_tanka_content,
+        received_tanka_content,
+        exchanged_at
+    FROM exchange_history
+    WHERE user_id = %(user_id)s
+    ORDER BY exchanged_at DESC
+    LIMIT %(limit)s
+"""
+
+def get_user_exchange_history(user_id, limit=20):
+    """SQL要素: Foreign Key, ORDER BY, LIMIT"""
+    with db_cursor() as cursor:
+        cursor.execute(USER_EXCHANGE_HISTORY_QUERY, {'user_id': user_id, 'limit': limit})
+        return cursor.fetchall()
+
+# ==================== 複雑なJOIN ====================
+
+USER_EXCHANGE_STATS_QUERY = """
+    SELECT
+        u.session_id,
+        COUNT(eh.exchange_id) as total_exchanges,
+        MIN(eh.exchanged_at) as first_exchange,
+        MAX(eh.exchanged_at) as last_exchange
+    FROM users u
+    LEFT JOIN exchange_history eh ON u.user_id = eh.user_id
+    WHERE u.user_id = %(user_id)s
+    GROUP BY u.user_id, u.session_id
+"""
+
+def get_user_exchange_stats(user_id):
+    """
+    SQL要素: JOIN, COUNT, MIN, MAX, GROUP BY
+    users JOIN exchange_history で統計を取得
+    """
+    with db_cursor() as cursor:
+        cursor.execute(USER_EXCHANGE_STATS_QUERY, {'user_id': user_id})
+        return cursor.fetchone()
+
+def get_all_categories():
+    with db_cursor() as cursor:
+        cursor.execute("SELECT category_id, name, description, tanka_count FROM categories ORDER BY name")
+        return cursor.fetchall()
+
+# ==================== 埋め込みキャッシュ ====================
+
+def load_cached_embedding(key):
+    """embedding_cache テーブルから取得（無ければ None）"""
+    with db_cursor() as cursor:
+        cursor.execute(
+            "SELECT embedding::text FROM embedding_cache WHERE content_hash = %s",
+            (key,)
+        )
+        row = cursor.fetchone()
+    return json.loads(row[0]) if row else None
+
+def store_cached_embedding(key, model, task_type, embedding):
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("""
+            INSERT INTO embedding_cache(content_hash, model, task_type, embedding)
+            VALUES (%s, %s, %s, %s::vector)
+            ON CONFLICT (content_hash) DO NOTHING
+        """, (key, model, task_type, embedding))
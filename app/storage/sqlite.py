@@ -0,0 +1,627 @@
+"""
+storage/sqlite.py - 組み込み SQLite の永続化層（デスクトップ用。Docker・PostgreSQL不要）
+storage/postgres.py と同じ名前・同じ戻り値の関数を持つ
+
+- 1ファイルのDB（SQLITE_PATH）を WAL モードで開く（読み込みは書き込みを待たない）
+- 接続はスレッドごと（sqlite3 の接続はスレッド間で共有できないため）
+- 埋め込みは float32 の BLOB（768次元 = 3KB）で保存し、ベクトル探索はメモリ内の
+  NumPy 行列（app/vector_index.py）で行う
+- 交換は BEGIN IMMEDIATE で書き込みロックを先に取り、選択〜削除を1トランザクションで行う
+  （SQLite は書き込みが1つずつのため、同じ短歌を2人が受け取ることはない）
+"""
+import array
+import os
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from ..config import SQLITE_CONFIG
+
+# DB操作の失敗として扱う例外（埋め込みキャッシュなどで使用）
+DatabaseError = sqlite3.Error
+
+
+class ForeignKeyViolation(sqlite3.IntegrityError):
+    """
+    存在しない user_id での書き込み（DBファイルを作り直した後に古いセッションが残っていた場合など）
+    sqlite3 は制約の種類ごとの例外を持たないため、sqlite_cursor が外部キー違反の場合だけこれに変換する
+    （UNIQUE・NOT NULL・CHECK の違反は sqlite3.IntegrityError のまま）
+    """
+
+# PRAGMA user_version に記録するスキーマのバージョン（一致すれば起動時の初期化を省略）
+SCHEMA_VERSION = 5
+
+# TIMESTAMP 列（と "列名 [timestamp]" の別名）を datetime で返す
+sqlite3.register_converter('timestamp', lambda value: datetime.fromisoformat(value.decode()))
+
+_local = threading.local()
+_stats = {'connections_opened': 0}
+_stats_lock = threading.Lock()
+
+
+def _connect():
+    path = SQLITE_CONFIG['path']
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # isolation_level=None: 暗黙のトランザクションを使わず、書き込み時だけ BEGIN IMMEDIATE する
+    conn = sqlite3.connect(
+        path,
+        timeout=SQLITE_CONFIG['busy_timeout'],
+        isolation_level=None,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL では NORMAL でもコミット済みのデータは壊れない（電源断で直前のコミットが失われる可能性のみ）
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    with _stats_lock:
+        _stats['connections_opened'] += 1
+    return conn
+
+
+def get_connection():
+    """このスレッドの接続を取得（初回に接続。fork 後の子プロセスでは張り直す）"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def _is_foreign_key_error(error):
+    return (isinstance(error, sqlite3.IntegrityError) and not isinstance(error, ForeignKeyViolation)
+            and str(error).startswith('FOREIGN KEY constraint failed'))
+
+
+@contextmanager
+def sqlite_cursor(commit=False):
+    """
+    カーソルを取得するコンテキストマネージャ（db_pool.db_cursor の SQLite 版）
+    commit=True の場合は BEGIN IMMEDIATE で書き込みロックを取り、正常終了時にコミットする
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        if commit:
+            cursor.execute("BEGIN IMMEDIATE")
+        yield cursor
+        if commit:
+            cursor.execute("COMMIT")
+    except BaseException as e:
+        if conn.in_transaction:
+            conn.rollback()
+        if _is_foreign_key_error(e):
+            raise ForeignKeyViolation(str(e)) from e
+        raise
+    finally:
+        cursor.close()
+
+
+def get_sqlite_stats():
+    """接続数・DBファイルのサイズ"""
+    path = SQLITE_CONFIG['path']
+    stats = dict(_stats)
+    stats['path'] = path
+    stats['file_bytes'] = os.path.getsize(path) if os.path.exists(path) else 0
+    wal = path + '-wal'
+    stats['wal_bytes'] = os.path.getsize(wal) if os.path.exists(wal) else 0
+    return stats
+
+
+def to_blob(embedding):
+    """埋め込み → float32 の BLOB（None はそのまま）"""
+    if embedding is None:
+        return None
+    return array.array('f', embedding).tobytes()
+
+
+def from_blob(blob):
+    values = array.array('f')
+    values.frombytes(blob)
+    return values.tolist()
+
+
+def ping():
+    with sqlite_cursor() as cursor:
+        cursor.execute("SELECT 1")
+
+def database_identity():
+    """接続先DBの識別子（DBファイルのパス）"""
+    return f"sqlite:{SQLITE_CONFIG['path']}"
+
+# ==================== スキーマ ====================
+
+# random_key: 0〜1 の乱数（random() は64bit整数を返すため正規化する）
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT UNIQUE NOT NULL,
+        username TEXT,
+        created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS categories (
+        category_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL,
+        description TEXT,
+        tanka_count INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tanka_pool (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        content TEXT NOT NULL,
+        user_id INTEGER REFERENCES users(user_id) ON DELETE SET NULL,
+        embedding BLOB,
+        exchange_count INTEGER DEFAULT 0,
+        random_key REAL NOT NULL DEFAULT (abs(random()) / 9223372036854775807.0),
+        created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_tanka_pool_random_key ON tanka_pool(random_key)",
+    "CREATE INDEX IF NOT EXISTS idx_tanka_pool_created_id ON tanka_pool(created_at DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_tanka_pool_user ON tanka_pool(user_id)",
+    """
+    CREATE TABLE IF NOT EXISTS exchange_history (
+        exchange_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
+        given_tanka_id INTEGER,
+        given_tanka_content TEXT NOT NULL,
+        received_tanka_id INTEGER,
+        received_tanka_content TEXT NOT NULL,
+        exchanged_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_exchange_history_user ON exchange_history(user_id, exchanged_at)",
+    "CREATE INDEX IF NOT EXISTS idx_exchange_history_received ON exchange_history(received_tanka_id)",
+    """
+    CREATE TABLE IF NOT EXISTS tanka_categories (
+        tanka_id INTEGER REFERENCES tanka_pool(id) ON DELETE CASCADE,
+        category_id INTEGER REFERENCES categories(category_id) ON DELETE CASCADE,
+        PRIMARY KEY (tanka_id, category_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS embedding_cache (
+        content_hash TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        task_type TEXT NOT NULL,
+        embedding BLOB NOT NULL,
+        created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+    )
+    """,
+    # 人気ランキングの集計結果（PostgreSQL のマテリアライズドビュー tanka_popularity に相当）
+    """
+    CREATE TABLE IF NOT EXISTS tanka_popularity (
+        id INTEGER PRIMARY KEY,
+        content TEXT NOT NULL,
+        exchange_count INTEGER NOT NULL,
+        categories TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_tanka_popularity_rank ON tanka_popularity(exchange_count DESC, id)",
+]
+
+
+# categories.tanka_count（カテゴリごとの短歌数）を tanka_categories の変更に合わせて ±1 する
+# （交換で短歌が削除されると ON DELETE CASCADE で関連行も消え、減算される）
+CATEGORY_COUNT_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_category_count_insert
+    AFTER INSERT ON tanka_categories
+    BEGIN
+        UPDATE categories SET tanka_count = tanka_count + 1 WHERE category_id = NEW.category_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_category_count_delete
+    AFTER DELETE ON tanka_categories
+    BEGIN
+        UPDATE categories SET tanka_count = tanka_count - 1 WHERE category_id = OLD.category_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_category_count_update
+    AFTER UPDATE OF category_id ON tanka_categories
+    BEGIN
+        UPDATE categories SET tanka_count = tanka_count - 1 WHERE category_id = OLD.category_id;
+        UPDATE categories SET tanka_count = tanka_count + 1 WHERE category_id = NEW.category_id;
+    END
+    """,
+]
+
+
+def init_schema():
+    """
+    テーブル作成・初期データ投入（PRAGMA user_version が最新なら何もしない）
+    Returns: 初期化を実行したら True
+    """
+    with sqlite_cursor() as cursor:
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] == SCHEMA_VERSION:
+            print(f"[v] SQLiteのスキーマは最新です（version {SCHEMA_VERSION}）- 初期化をスキップ")
+            return False
+
+    from scripts.init_db import CATEGORIES, DUMMY_TANKAS
+
+    with sqlite_cursor(commit=True) as cursor:
+        for statement in SCHEMA:
+            cursor.execute(statement)
+
+        # version 3 以前のファイル向け: カウンタ列を追加
+        cursor.execute("PRAGMA table_info(categories)")
+        if 'tanka_count' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE categories ADD COLUMN tanka_count INTEGER NOT NULL DEFAULT 0")
+        for statement in CATEGORY_COUNT_TRIGGERS:
+            cursor.execute(statement)
+
+        cursor.execute("SELECT COUNT(*) FROM categories")
+        if cursor.fetchone()[0] == 0:
+            cursor.executemany("INSERT INTO categories(name, description) VALUES (?, ?)", CATEGORIES)
+
+        cursor.execute("SELECT COUNT(*) FROM tanka_pool")
+        if cursor.fetchone()[0] == 0:
+            for tanka_content, category_names in DUMMY_TANKAS:
+                cursor.execute("INSERT INTO tanka_pool(content) VALUES (?)", (tanka_content,))
+                tanka_id = cursor.lastrowid
+                cursor.execute(f"""
+                    INSERT INTO tanka_categories(tanka_id, category_id)
+                    SELECT ?, category_id FROM categories
+                    WHERE name IN ({', '.join('?' * len(category_names))})
+                """, (tanka_id, *category_names))
+            print(f"[v] ダミー短歌を{len(DUMMY_TANKAS)}件投入しました")
+
+        _recount_categories(cursor)
+        _rebuild_popularity(cursor)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    print(f"[v] SQLiteデータベースを初期化しました（{SQLITE_CONFIG['path']}）")
+    return True
+
+
+# ==================== ユーザー管理 ====================
+
+def get_or_create_user(session_id):
+    with sqlite_cursor(commit=True) as cursor:
+        cursor.execute("INSERT OR IGNORE INTO users(session_id) VALUES (?)", (session_id,))
+        cursor.execute("SELECT user_id FROM users WHERE session_id = ?", (session_id,))
+        return cursor.fetchone()[0]
+
+# ==================== 短歌操作（基本） ====================
+
+def _select_random(cursor, exclude_user_id):
+    """random_key の乱数位置から1件（見つからなければ先頭から）"""
+    for start_key in (random.random(), 0.0):
+        cursor.execute("""
+            SELECT id, content FROM tanka_pool
+            WHERE random_key >= ?
+            AND (? IS NULL OR user_id IS NULL OR user_id != ?)
+            ORDER BY random_key
+            LIMIT 1
+        """, (start_key, exclude_user_id or None, exclude_user_id or None))
+        result = cursor.fetchone()
+        if result:
+            return result
+    return None
+
+def get_random_tanka(exclude_user_id=None):
+    with sqlite_cursor() as cursor:
+        return _select_random(cursor, exclude_user_id)
+
+def search_similar_tankas(embedding, limit=1, exclude_user_id=None,
+                          ef_search=None, probes=None, exact=False):
+    """メモリ内の NumPy 行列で探索（全件の行列積なので常に厳密。ef_search / probes は無視）"""
+    from ..vector_index import get_vector_index
+    index = get_vector_index()
+    if index is None:
+        raise RuntimeError("SQLiteモードのベクトル探索には numpy が必要です")
+    return index.search(embedding, limit, exclude_user_id)
+
+def update_tanka_embedding(tanka_id, embedding):
+    with sqlite_cursor(commit=True) as cursor:
+        cursor.execute("UPDATE tanka_pool SET embedding = ? WHERE id = ?", (to_blob(embedding), tanka_id))
+        cursor.execute("SELECT user_id, content FROM tanka_pool WHERE id = ?", (tanka_id,))
+        return cursor.fetchone()
+
+def get_tankas_without_embeddings(limit=None, tanka_ids=None):
+    # SQLite の LIMIT -1 は「上限なし」
+    limit = -1 if limit is None else limit
+    with sqlite_cursor() as cursor:
+        if tanka_ids is not None:
+            tanka_ids = list(tanka_ids)
+            if not tanka_ids:
+                return []
+            cursor.execute(f"""
+                SELECT id, content FROM tanka_pool
+                WHERE embedding IS NULL AND id IN ({', '.join('?' * len(tanka_ids))})
+                ORDER BY id LIMIT ?
+            """, (*tanka_ids, limit))
+        else:
+            cursor.execute(
+                "SELECT id, content FROM tanka_pool WHERE embedding IS NULL ORDER BY id LIMIT ?",
+                (limit,)
+            )
+        return cursor.fetchall()
+
+def iter_tanka_embeddings():
+    """Yields: (id, user_id, content, embedding)"""
+    with sqlite_cursor() as cursor:
+        cursor.execute("SELECT id, user_id, content, embedding FROM tanka_pool WHERE embedding IS NOT NULL")
+        for tanka_id, user_id, content, blob in cursor:
+            yield tanka_id, user_id, content, from_blob(blob)
+
+def get_pool_tanka(tanka_id):
+    with sqlite_cursor() as cursor:
+        cursor.execute("SELECT id, content, user_id FROM tanka_pool WHERE id = ?", (tanka_id,))
+        return cursor.fetchone()
+
+def delete_tanka(tanka_id):
+    with sqlite_cursor(commit=True) as cursor:
+        cursor.execute("DELETE FROM tanka_pool WHERE id = ?", (tanka_id,))
+
+def insert_tanka(content, user_id=None, embedding=None):
+    with sqlite_cursor(commit=True) as cursor:
+        cursor.execute(
+            "INSERT INTO tanka_pool(content, user_id, embedding) VALUES (?, ?, ?)",
+            (content, user_id, to_blob(embedding))
+        )
+        return cursor.lastrowid
+
+def count_pool_tankas():
+    # デスクトップ用の規模では COUNT(*) で十分（結果は models.py でキャッシュされる）
+    with sqlite_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM tanka_pool")
+        return cursor.fetchone()[0]
+
+# ==================== JOIN使用 ====================
+
+def get_tankas_by_category(category_name):
+    with sqlite_cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                tp.id,
+                tp.content,
+                c.name as category_name
+            FROM tanka_pool tp
+            INNER JOIN tanka_categories tc ON tp.id = tc.tanka_id
+            INNER JOIN categories c ON tc.category_id = c.category_id
+            WHERE c.name = ?
+            ORDER BY tp.created_at DESC, tp.id DESC
+        """, (category_name,))
+        return cursor.fetchall()
+
+def get_tanka_with_categories(tanka_id):
+    with sqlite_cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                tp.id,
+                tp.content,
+                GROUP_CONCAT(c.name, ', ') as categories
+            FROM tanka_pool tp
+            LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
+            LEFT JOIN categories c ON tc.category_id = c.category_id
+            WHERE tp.id = ?
+            GROUP BY tp.id, tp.content
+        """, (tanka_id,))
+        return cursor.fetchone()
+
+def get_all_tankas_with_categories():
+    with sqlite_cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                tp.id,
+                tp.content,
+                GROUP_CONCAT(c.name, ', ') as categories,
+                tp.exchange_count
+            FROM tanka_pool tp
+            LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
+            LEFT JOIN categories c ON tc.category_id = c.category_id
+            GROUP BY tp.id, tp.content, tp.exchange_count
+            ORDER BY tp.created_at DESC, tp.id DESC
+        """)
+        return cursor.fetchall()
+
+def get_tankas_page(after=None, limit=50):
+    """キーセットページネーション（storage/postgres.py と同じ。行値比較は SQLite 3.15 以降）"""
+    where = "WHERE (created_at, id) < (?, ?)" if after else ""
+    # created_at は 'YYYY-MM-DD HH:MM:SS' の文字列で保存しているため、同じ形式で比較する
+    params = (after[0].isoformat(sep=' '), after[1], limit) if after else (limit,)
+    with sqlite_cursor() as cursor:
+        cursor.execute(f"""
+            SELECT
+                tp.id,
+                tp.content,
+                GROUP_CONCAT(c.name, ', ') as categories,
+                tp.exchange_count,
+                tp.created_at
+            FROM (
+                SELECT id, content, exchange_count, created_at
+                FROM tanka_pool
+                {where}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ) tp
+            LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
+            LEFT JOIN categories c ON tc.category_id = c.category_id
+            GROUP BY tp.id, tp.content, tp.exchange_count, tp.created_at
+            ORDER BY tp.created_at DESC, tp.id DESC
+        """, params)
+        return cursor.fetchall()
+
+# ==================== SubQuery使用 ====================
+
+def get_popular_tankas(limit=10):
+    """集計済みの tanka_popularity から上位を読む（交換済みの短歌は除く）"""
+    with sqlite_cursor() as cursor:
+        cursor.execute("""
+            SELECT pop.id, pop.content, pop.exchange_count, pop.categories
+            FROM tanka_popularity pop
+            WHERE EXISTS (SELECT 1 FROM tanka_pool tp WHERE tp.id = pop.id)
+            ORDER BY pop.exchange_count DESC, pop.id
+            LIMIT ?
+        """, (limit,))
+        return cursor.fetchall()
+
+def _rebuild_popularity(cursor):
+    cursor.execute("DELETE FROM tanka_popularity")
+    cursor.execute("""
+        INSERT INTO tanka_popularity(id, content, exchange_count, categories)
+        SELECT
+            tp.id,
+            tp.content,
+            COALESCE(eh.exchange_count, 0),
+            GROUP_CONCAT(c.name, ', ')
+        FROM tanka_pool tp
+        LEFT JOIN (
+            SELECT received_tanka_id, COUNT(*) AS exchange_count
+            FROM exchange_history
+            GROUP BY received_tanka_id
+        ) eh ON eh.received_tanka_id = tp.id
+        LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
+        LEFT JOIN categories c ON tc.category_id = c.category_id
+        GROUP BY tp.id, tp.content, eh.exchange_count
+    """)
+
+def refresh_popularity():
+    """人気ランキングを再集計（1トランザクションで入れ替えるため、読み込み側は古い結果か新しい結果のどちらかを見る）"""
+    with sqlite_cursor(commit=True) as cursor:
+        _rebuild_popularity(cursor)
+    return True
+
+def get_category_stats():
+    """categories.tanka_count はトリガー（CATEGORY_COUNT_TRIGGERS）で維持しているため集計しない"""
+    with sqlite_cursor() as cursor:
+        cursor.execute("""
+            SELECT name, tanka_count, description
+            FROM categories
+            ORDER BY tanka_count DESC
+        """)
+        return cursor.fetchall()
+
+def get_category_count_drift():
+    with sqlite_cursor() as cursor:
+        cursor.execute("""
+            SELECT name, stored_count, actual_count
+            FROM (
+                SELECT
+                    c.name,
+                    c.tanka_count AS stored_count,
+                    (SELECT COUNT(*) FROM tanka_categories tc
+                     WHERE tc.category_id = c.category_id) AS actual_count
+                FROM categories c
+            )
+            WHERE stored_count <> actual_count
+            ORDER BY name
+        """)
+        return cursor.fetchall()
+
+def _recount_categories(cursor):
+    cursor.execute("""
+        UPDATE categories
+        SET tanka_count = (SELECT COUNT(*) FROM tanka_categories tc
+                           WHERE tc.category_id = categories.category_id)
+    """)
+
+def recount_category_counts():
+    with sqlite_cursor(commit=True) as cursor:
+        _recount_categories(cursor)
+
+# ==================== 交換履歴 ====================
+
+def record_exchange(user_id, given_tanka_id, given_content, received_tanka_id, received_content):
+    with sqlite_cursor(commit=True) as cursor:
+        cursor.execute("""
+            INSERT INTO exchange_history(
+                user_id,
+                given_tanka_id,
+                given_tanka_content,
+                received_tanka_id,
+                received_tanka_content
+            ) VALUES (?, ?, ?, ?, ?)
+        """, (user_id, given_tanka_id, given_content, received_tanka_id, received_content))
+        return cursor.lastrowid
+
+def perform_exchange(user_id, content, embedding=None):
+    """
+    BEGIN IMMEDIATE（書き込みロック）の中で
+    1. 自分以外の短歌をランダムに1件選ぶ 2. ユーザーの短歌をINSERT
+    3. 交換履歴をINSERT 4. 受け取った短歌をDELETE
+    """
+    with sqlite_cursor(commit=True) as cursor:
+        received = _select_random(cursor, user_id)
+        if received is None:
+            return None
+        cursor.execute(
+            "INSERT INTO tanka_pool(content, user_id, embedding) VALUES (?, ?, ?)",
+            (content, user_id, to_blob(embedding))
+        )
+        given_id = cursor.lastrowid
+        cursor.execute("""
+            INSERT INTO exchange_history(
+                user_id,
+                given_tanka_id,
+                given_tanka_content,
+                received_tanka_id,
+                received_tanka_content
+            ) VALUES (?, ?, ?, ?, ?)
+        """, (user_id, given_id, content, received[0], received[1]))
+        exchange_id = cursor.lastrowid
+        cursor.execute("DELETE FROM tanka_pool WHERE id = ?", (received[0],))
+    return received[0], received[1], given_id, exchange_id
+
+def get_user_exchange_history(user_id, limit=20):
+    with sqlite_cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                exchange_id,
+                given_tanka_content,
+                received_tanka_content,
+                exchanged_at
+            FROM exchange_history
+            WHERE user_id = ?
+            ORDER BY exchanged_at DESC, exchange_id DESC
+            LIMIT ?
+        """, (user_id, limit))
+        return cursor.fetchall()
+
+def get_user_exchange_stats(user_id):
+    # MIN / MAX の結果には列の型が付かないため、別名で timestamp を指定する
+    with sqlite_cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                u.session_id,
+                COUNT(eh.exchange_id) as total_exchanges,
+                MIN(eh.exchanged_at) as "first_exchange [timestamp]",
+                MAX(eh.exchanged_at) as "last_exchange [timestamp]"
+            FROM users u
+            LEFT JOIN exchange_history eh ON u.user_id = eh.user_id
+            WHERE u.user_id = ?
+            GROUP BY u.user_id, u.session_id
+        """, (user_id,))
+        return cursor.fetchone()
+
+def get_all_categories():
+    with sqlite_cursor() as cursor:
+        cursor.execute("SELECT category_id, name, description, tanka_count FROM categories ORDER BY name")
+        return cursor.fetchall()
+
+# ==================== 埋め込みキャッシュ ====================
+
+def load_cached_embedding(key):
+    with sqlite_cursor() as cursor:
+        cursor.execute("SELECT embedding FROM embedding_cache WHERE content_hash = ?", (key,))
+        row = cursor.fetchone()
+    return from_blob(row[0]) if row else None
+
+def store_cached_embedding(key, model, task_type, embedding):
+    with sqlite_cursor(commit=True) as cursor:
+        cursor.execute("""
+            INSERT OR IGNORE INTO embedding_cache(content_hash, model, task_type, embedding)
+            VALUES (?, ?, ?, ?)
+        """, (key, model, task_type, to_blob(embedding)))
@@ -0,0 +1,215 @@
+"""
+vector_index.py - プロセス内ベクトル索引（NumPy）
+tanka_pool の埋め込みを正規化済み float32 行列としてメモリに保持し、
+コサイン類似度の上位k件を1回の行列積で求める
+
+小〜中規模のプールでは pgvector への往復より行列積の方が速いため、
+VECTOR_SEARCH_BACKEND=memory（STORAGE_BACKEND=sqlite では常に）のとき
+search_similar_tankas() から透過的に使われる。
+insert_tanka / delete_tanka / perform_exchange / update_tanka_embedding の実行時に
+差分更新される（他プロセスでの変更は load_vector_index() の再読み込みまで反映されない）。
+"""
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:  # numpy が無い環境では pgvector のみを使う
+    np = None
+
+from .config import VECTOR_SEARCH_BACKEND
+
+DIMENSIONS = 768
+# user_id が NULL の行を表す値
+NO_USER = -1
+
+
+class VectorIndex:
+    """正規化済み埋め込み行列 + id / user_id / 本文の配列"""
+
+    def __init__(self, dimensions=DIMENSIONS, capacity=1024):
+        if np is None:
+            raise RuntimeError("numpy がインストールされていないため、メモリ内ベクトル索引は使用できません")
+        self.dimensions = dimensions
+        self._lock = threading.RLock()
+        self._matrix = np.zeros((capacity, dimensions), dtype=np.float32)
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._user_ids = np.zeros(capacity, dtype=np.int64)
+        self._contents = [None] * capacity
+        self._positions = {}  # tanka_id -> 行番号
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _grow(self):
+        capacity = max(len(self._ids) * 2, 1)
+        matrix = np.zeros((capacity, self.dimensions), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+        self._ids = np.resize(self._ids, capacity)
+        self._user_ids = np.resize(self._user_ids, capacity)
+        self._contents.extend([None] * (capacity - len(self._contents)))
+
+    def add(self, tanka_id, user_id, content, embedding):
+        """短歌を追加（既にあれば置き換え）"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            row = self._positions.get(tanka_id)
+            if row is None:
+                if self._size == len(self._ids):
+                    self._grow()
+                row = self._size
+                self._size += 1
+                self._positions[tanka_id] = row
+            self._matrix[row] = vector
+            self._ids[row] = tanka_id
+            self._user_ids[row] = NO_USER if user_id is None else user_id
+            self._contents[row] = content
+
+    def remove(self, tanka_id):
+        """短歌を削除（末尾の行を空いた位置に移動するので O(1)）"""
+        with self._lock:
+            row = self._positions.pop(tanka_id, None)
+            if row is None:
+                return
+            last = self._size - 1
+            if row != last:
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = self._ids[last]
+                self._user_ids[row] = self._user_ids[last]
+                self._contents[row] = self._contents[last]
+                self._positions[int(self._ids[row])] = row
+            self._contents[last] = None
+            self._size = last
+
+    def search(self, embedding, limit=1, exclude_user_id=None):
+        """
+        コサイン類似度の上位 limit 件
+        Returns: [(id, content, distance), ...]（distance は pgvector の <=> と同じ 1 - cos）
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            if self._size == 0:
+                return []
+            scores = self._matrix[:self._size] @ query
+            if exclude_user_id:
+                scores[self._user_ids[:self._size] == exclude_user_id] = -np.inf
+            k = min(limit, self._size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                (int(self._ids[i]), self._contents[i], float(1.0 - scores[i]))
+                for i in top if scores[i] != -np.inf
+            ]
+
+    def stats(self):
+        with self._lock:
+            capacity = len(self._ids)
+            content_bytes = sum(len(c.encode('utf-8')) for c in self._contents[:self._size])
+            return {
+                'size': self._size,
+                'capacity': capacity,
+                'dimensions': self.dimensions,
+                'matrix_bytes': int(self._matrix.nbytes),
+                'memory_bytes': int(self._matrix.nbytes + self._ids.nbytes + self._user_ids.nbytes + content_bytes),
+            }
+
+
+_index = None
+_load_lock = threading.Lock()     # 読み込みを1つずつ行う
+_events_lock = threading.Lock()   # 索引の入れ替えとフックの排他
+_pending_events = None            # 読み込み中に届いた追加・削除（読み込み中以外は None）
+_index_info = {'loaded_at': None, 'load_seconds': None}
+
+
+def _load_locked():
+    """load_vector_index の本体（_load_lock 内で呼ぶ）"""
+    global _index, _pending_events
+    from .storage import backend
+
+    started = time.perf_counter()
+    # 読み込み中（全件読み込みのスナップショットに含まれない可能性がある間）の変更を記録する
+    with _events_lock:
+        _pending_events = []
+    try:
+        index = VectorIndex()
+        for tanka_id, user_id, content, embedding in backend.iter_tanka_embeddings():
+            index.add(tanka_id, user_id, content, embedding)
+    except BaseException:
+        with _events_lock:
+            _pending_events = None
+        raise
+
+    with _events_lock:
+        # 記録した変更を順に反映してから入れ替える（以降のフックは新しい索引に直接反映される）
+        for event in _pending_events:
+            if event[0] == 'add':
+                index.add(*event[1:])
+            else:
+                index.remove(event[1])
+        _pending_events = None
+        _index = index
+    _index_info['loaded_at'] = time.time()
+    _index_info['load_seconds'] = time.perf_counter() - started
+    return index
+
+
+def load_vector_index():
+    """
+    tanka_pool の埋め込みをすべて読み込んで索引を（再）構築
+    読み込み中に届いた追加・削除は記録しておき、入れ替えの直前に新しい索引へ反映する
+    """
+    with _load_lock:
+        return _load_locked()
+
+
+def get_vector_index():
+    """
+    メモリ内索引を取得（VECTOR_SEARCH_BACKEND=memory のときのみ。初回呼び出しで読み込み）
+    無効な場合は None
+    """
+    if VECTOR_SEARCH_BACKEND != 'memory' or np is None:
+        return None
+    if _index is None:
+        with _load_lock:
+            if _index is None:
+                _load_locked()
+    return _index
+
+
+def on_tanka_saved(tanka_id, user_id, content, embedding):
+    """短歌の追加・埋め込み更新を索引に反映（読み込み中は記録して入れ替え後に反映）"""
+    if embedding is None:
+        return
+    with _events_lock:
+        if _pending_events is not None:
+            _pending_events.append(('add', tanka_id, user_id, content, embedding))
+        index = _index
+    if index is not None:
+        index.add(tanka_id, user_id, content, embedding)
+
+
+def on_tanka_deleted(tanka_id):
+    """短歌の削除を索引に反映（読み込み中は記録して入れ替え後に反映）"""
+    with _events_lock:
+        if _pending_events is not None:
+            _pending_events.append(('remove', tanka_id))
+        index = _index
+    if index is not None:
+        index.remove(tanka_id)
+
+
+def get_vector_index_stats():
+    """索引の統計（メモリ使用量など）。無効なら None"""
+    if _index is None:
+        return None
+    stats = _index.stats()
+    stats.update(_index_info)
+    return stats
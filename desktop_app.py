@@ -1,60 +1,150 @@
 """
 desktop_app.py - デスクトップアプリケーション起動スクリプト
 PyWebViewを使用してFlaskアプリをデスクトップアプリとして起動
+
+サーバーはDBの準備を待たずに起動し、/healthz が応答した時点（接続を受け付けた時点）で
+ウィンドウを開く。DB接続確認・スキーマ確認・索引の読み込みは別スレッドで並行して行い、
+その間ウィンドウには起動中の画面（/splash）を表示する。準備ができたらホームへ移動する
+
+保存先（STORAGE_BACKEND）が未指定の場合、PostgreSQL の設定（.env の DB_*）も
+既定の PostgreSQL（localhost:5432）への接続も無ければ組み込みSQLite（Docker・PostgreSQL は不要）、
+どちらかがあれば従来どおり PostgreSQL を使う（既存の PostgreSQL のデータを見失わないため）
 """
+import os
+import socket
 import webview
 import threading
 import time
 import sys
-from app import app, setup_docker_environment, wait_for_database
+import urllib.error
+import urllib.request
+from dotenv import load_dotenv
+
+# PostgreSQL の接続設定とみなす環境変数（.env.example と同じ）
+POSTGRES_ENV_KEYS = ('DB_HOST', 'DB_PORT', 'DB_NAME', 'DB_USER', 'DB_PASSWORD')
+
+
+def postgres_reachable(host='localhost', port=5432, timeout=0.3):
+    """既定の PostgreSQL が接続を受け付けるか（TCP接続のみ確認）"""
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+def choose_storage_backend():
+    """
+    STORAGE_BACKEND が未指定のときの保存先を決めて環境変数に設定（app の設定を読み込む前に呼ぶ）
+    Returns: 'postgres' or 'sqlite'
+    """
+    if os.getenv('STORAGE_BACKEND'):
+        return os.environ['STORAGE_BACKEND'].lower()
+
+    configured = [key for key in POSTGRES_ENV_KEYS if os.getenv(key)]
+    if configured:
+        backend = 'postgres'
+        print(f"[*] 保存先: PostgreSQL（.env に {', '.join(configured)} があるため。"
+              f"組み込みDBを使う場合は STORAGE_BACKEND=sqlite）")
+    elif postgres_reachable():
+        backend = 'postgres'
+        print("[*] 保存先: PostgreSQL（localhost:5432 が応答したため。"
+              "組み込みDBを使う場合は STORAGE_BACKEND=sqlite）")
+    else:
+        backend = 'sqlite'
+        print("[*] 保存先: 組み込みSQLite（PostgreSQL の設定・接続が無いため。"
+              "PostgreSQL のデータを使う場合は STORAGE_BACKEND=postgres）")
+    os.environ['STORAGE_BACKEND'] = backend
+    return backend
+
+
+# app の設定を読み込む前に、デスクトップ版の保存先を決める
+load_dotenv()
+choose_storage_backend()
+
+from app import app
+from app.startup import prepare_environment, mark_starting
+from app.config import WAITRESS_THREADS, SERVER_MODE
+
+HOST = '127.0.0.1'
+PORT = 5000
+BASE_URL = f'http://{HOST}:{PORT}'
 
 def start_flask():
-    """Flaskアプリをバックグラウンドで起動 (Waitress使用)"""
+    """Flaskアプリをバックグラウンドで起動 (Waitress使用、SERVER_MODE=asgi なら uvicorn)"""
+    if SERVER_MODE == 'asgi':
+        from app.asgi import serve_asgi
+        serve_asgi(host=HOST, port=PORT)
+        return
     from waitress import serve
     # 開発用サーバー(app.run)ではなく、本番用WSGIサーバー(Waitress)を使用
-    serve(app, host='127.0.0.1', port=5000)
+    serve(app, host=HOST, port=PORT, threads=WAITRESS_THREADS)
+
+def warm_up():
+    """DB接続確認・スキーマ初期化・ベクトル索引の読み込み（ウィンドウ表示と並行して実行）"""
+    try:
+        if not prepare_environment():
+            print("\n[x] データベースに接続できませんでした")
+    except BaseException as e:
+        # 失敗内容は /healthz 経由で起動中の画面に表示される
+        print(f"\n[x] 起動処理に失敗しました: {e}")
+
+def wait_until_serving(server_thread, timeout=30.0, interval=0.05):
+    """
+    サーバーが接続を受け付けるまで /healthz をポーリング
+    起動処理中の 503 も「サーバーは応答している」とみなす
+    Returns: 応答があれば True、サーバーが停止した・期限切れなら False
+    """
+    # 環境変数のプロキシ設定を使わず、ローカルのサーバーに直接接続する
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and server_thread.is_alive():
+        try:
+            opener.open(f'{BASE_URL}/healthz', timeout=1).close()
+            return True
+        except urllib.error.HTTPError:
+            return True
+        except OSError:
+            time.sleep(interval)
+    return False
 
 def main():
     """メイン処理"""
     print("=== 匿名短歌交換 デスクトップアプリ起動 ===\n")
-    
-    # 1. Docker環境のセットアップ
-    setup_docker_environment()
-    
-    # 2. データベース接続確認
-    if not wait_for_database():
-        print("\n[x] データベースに接続できませんでした")
+
+    # 起動処理のスレッドが始まる前に /healthz が ready を返さないよう、先に起動処理中にしておく
+    mark_starting()
+
+    # 1. Flaskを別スレッドで起動（DBの準備を待たない）
+    flask_thread = threading.Thread(target=start_flask, daemon=True)
+    flask_thread.start()
+
+    # 2-5. DB接続確認（必要なら Docker で起動）・スキーマ初期化・ベクトル索引の読み込みを並行して実行
+    threading.Thread(target=warm_up, daemon=True).start()
+
+    # 6. サーバーが接続を受け付けるまで待機
+    started = time.perf_counter()
+    if not wait_until_serving(flask_thread):
+        print(f"\n[x] サーバーを起動できませんでした（ポート {PORT} が使用中の可能性があります）")
         print("  アプリケーションを終了します")
         sys.exit(1)
-    
-    # 3. データベース初期化（初回のみ）
-    print("[*] データベースを初期化中...")
-    from scripts.init_db import init_database
-    init_database()
-    
+    print(f"[v] サーバーが応答しました（{(time.perf_counter() - started) * 1000:.0f}ms）")
     print("\n[*] デスクトップアプリケーションを起動します\n")
-    
-    # 4. Flaskを別スレッドで起動
-    flask_thread = threading.Thread(target=start_flask, daemon=True)
-    flask_thread.start()
-    
-    # Flaskが起動するまで少し待機
-    time.sleep(2)
-    
-    # 5. デスクトップウィンドウを作成
+
+    # 7. デスクトップウィンドウを作成（準備ができるまで起動中の画面を表示）
     webview.create_window(
         title='匿名短歌交換',
-        url='http://127.0.0.1:5000',
+        url=f'{BASE_URL}/splash',
         width=900,
         height=700,
         resizable=True,
         fullscreen=False,
         min_size=(600, 500)
     )
-    
-    # 6. ウィンドウを表示
+
+    # 8. ウィンドウを表示
     webview.start()
-    
+
     print("\n[*] アプリケーションを終了しました")
 
 if __name__ == '__main__':
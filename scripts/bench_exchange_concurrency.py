@@ -0,0 +1,120 @@
+"""
+bench_exchange_concurrency.py - 短歌交換の同時実行ベンチマーク
+数百スレッドから同時に perform_exchange() を実行し、以下を確認する
+- DB接続数がプール上限（DB_POOL_MAX）を超えず一定であること
+- 同じ短歌を2人が受け取る二重交換が起きないこと
+- 交換前後でプール内の短歌数が変わらないこと（INSERT 1 + DELETE 1）
+
+[!] 実際に tanka_pool の短歌を入れ替えるため、検証用DBで実行すること
+    （終了後は python scripts/init_db.py --reset で元に戻せる）
+
+使い方:
+    python scripts/bench_exchange_concurrency.py --exchanges 500 --threads 200
+"""
+import sys
+import os
+import argparse
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import get_db_connection, DB_CONFIG
+from app.db_pool import get_pool, get_pool_stats
+from app.models import get_or_create_user, perform_exchange, get_pool_count
+
+
+def count_backends(cursor):
+    """このDBに接続しているバックエンド数（監視用接続自身を除く）"""
+    cursor.execute("""
+        SELECT COUNT(*) FROM pg_stat_activity
+        WHERE datname = %s AND pid != pg_backend_pid()
+    """, (DB_CONFIG['database'],))
+    return cursor.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="短歌交換の同時実行ベンチマーク")
+    parser.add_argument('--exchanges', type=int, default=500, help="交換の総数")
+    parser.add_argument('--threads', type=int, default=200, help="同時実行スレッド数")
+    parser.add_argument('--users', type=int, default=50, help="ベンチマーク用ユーザー数")
+    args = parser.parse_args()
+
+    pool = get_pool()
+    print(f"[*] プール上限: {pool.max_size} 接続 / スレッド数: {args.threads} / 交換数: {args.exchanges}")
+
+    user_ids = [get_or_create_user(f"bench-{uuid.uuid4()}") for _ in range(args.users)]
+    count_before = get_pool_count()
+
+    # 監視用の別接続で pg_stat_activity をサンプリング
+    monitor_conn = get_db_connection()
+    monitor_conn.autocommit = True
+    monitor_cursor = monitor_conn.cursor()
+    baseline_backends = count_backends(monitor_cursor)
+    samples = []
+    stop = threading.Event()
+
+    def monitor():
+        while not stop.is_set():
+            samples.append(count_backends(monitor_cursor))
+            time.sleep(0.05)
+
+    monitor_thread = threading.Thread(target=monitor, daemon=True)
+    monitor_thread.start()
+
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(i):
+        user_id = user_ids[i % len(user_ids)]
+        started = time.perf_counter()
+        result = perform_exchange(user_id, f"ベンチマーク短歌 {i}\n二\n三\n四\n五")
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+        return result
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results = list(executor.map(worker, range(args.exchanges)))
+    total = time.perf_counter() - started
+
+    stop.set()
+    monitor_thread.join()
+    monitor_cursor.close()
+    monitor_conn.close()
+
+    count_after = get_pool_count()
+    succeeded = [r for r in results if r is not None]
+    received_ids = [r[0] for r in succeeded]
+    stats = get_pool_stats()
+    latencies.sort()
+
+    print("\n" + "=" * 50)
+    print("RESULT")
+    print("=" * 50)
+    print(f"  成功: {len(succeeded)} / {args.exchanges} （空振り: {args.exchanges - len(succeeded)}）")
+    print(f"  スループット: {len(succeeded) / total:.1f} exchanges/sec （{total:.2f}秒）")
+    print(f"  レイテンシ p50: {latencies[len(latencies) // 2] * 1000:.1f}ms / "
+          f"p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms")
+    print(f"  二重受け取り: {len(received_ids) - len(set(received_ids))} 件")
+    print(f"  プール内短歌数: {count_before} -> {count_after}")
+    print(f"  DB接続数（監視接続を除く）: 開始前 {baseline_backends} / 実行中最大 {max(samples, default=0)}")
+    print(f"  プール: 生成接続 {stats['connections_opened']} / 最大同時使用 {stats['peak_in_use']} "
+          f"/ 上限 {stats['max_size']}")
+    print(f"  プール待ち: {stats['waits']} 回 / 平均 {stats['wait_time_avg'] * 1000:.1f}ms "
+          f"/ 最大 {stats['wait_time_max'] * 1000:.1f}ms / 飽和率 {stats['saturation_ratio']:.0%}")
+
+    ok = (
+        len(received_ids) == len(set(received_ids))
+        and count_before == count_after
+        and stats['size'] <= stats['max_size']
+    )
+    print("\n[v] 接続数一定・二重交換なし" if ok else "\n[x] 不整合を検出しました")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
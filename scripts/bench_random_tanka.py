@@ -0,0 +1,105 @@
+"""
+bench_random_tanka.py - ランダム抽出のベンチマーク
+ORDER BY RANDOM()（従来方式）と random_key インデックス方式（models.select_random_tanka）を
+10k / 100k / 1M 件のプールで比較する
+
+実データには触れず、同名の一時テーブル（TEMP TABLE tanka_pool）を作って計測する。
+一時テーブルは search_path 上で public.tanka_pool より優先されるため、
+models.py と同じSQLがそのまま一時テーブルに対して実行される。
+
+使い方:
+    python scripts/bench_random_tanka.py
+    python scripts/bench_random_tanka.py --sizes 10000 100000 --queries 200
+"""
+import sys
+import os
+import argparse
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import get_db_connection
+from app.storage.postgres import select_random_tanka
+
+# 除外対象として扱うユーザーID（全体の1%の短歌をこのユーザーの投稿にする）
+EXCLUDE_USER_ID = 1
+
+
+def legacy_random_tanka(cursor, exclude_user_id):
+    """従来方式: ORDER BY RANDOM() LIMIT 1"""
+    cursor.execute("""
+        SELECT id, content FROM tanka_pool
+        WHERE user_id IS NULL OR user_id != %s
+        ORDER BY RANDOM() LIMIT 1
+    """, (exclude_user_id,))
+    return cursor.fetchone()
+
+
+def measure(func, cursor, queries):
+    """func を queries 回実行し、レイテンシ（ミリ秒）の一覧を返す"""
+    latencies = []
+    for _ in range(queries):
+        started = time.perf_counter()
+        row = func(cursor, EXCLUDE_USER_ID)
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert row is not None
+    latencies.sort()
+    return latencies
+
+
+def percentile(sorted_values, p):
+    index = min(int(len(sorted_values) * p), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ランダム抽出のベンチマーク")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--queries', type=int, default=100, help="サイズごとの計測回数")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            CREATE TEMP TABLE tanka_pool (
+                id SERIAL PRIMARY KEY,
+                content TEXT NOT NULL,
+                user_id INTEGER,
+                random_key DOUBLE PRECISION NOT NULL DEFAULT random()
+            )
+        """)
+        cursor.execute("CREATE INDEX ON tanka_pool(random_key)")
+        conn.commit()
+
+        print(f"{'rows':>10} | {'ORDER BY RANDOM() p50/p95':>26} | {'random_key p50/p95':>20} | {'speedup':>8}")
+        print("-" * 75)
+
+        current = 0
+        for size in sorted(args.sizes):
+            # 前回サイズからの差分だけ追加
+            cursor.execute("""
+                INSERT INTO tanka_pool(content, user_id)
+                SELECT 'ベンチマーク短歌 ' || g,
+                       CASE WHEN g %% 100 = 0 THEN %s END
+                FROM generate_series(%s, %s) AS g
+            """, (EXCLUDE_USER_ID, current + 1, size))
+            conn.commit()
+            cursor.execute("ANALYZE tanka_pool")
+            current = size
+
+            legacy = measure(legacy_random_tanka, cursor, args.queries)
+            indexed = measure(select_random_tanka, cursor, args.queries)
+            conn.rollback()
+
+            speedup = percentile(legacy, 0.5) / max(percentile(indexed, 0.5), 1e-6)
+            print(f"{size:>10} | {percentile(legacy, 0.5):>11.2f}ms / {percentile(legacy, 0.95):>8.2f}ms "
+                  f"| {percentile(indexed, 0.5):>7.3f}ms / {percentile(indexed, 0.95):>7.3f}ms "
+                  f"| {speedup:>7.0f}x")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+bench_serving_modes.py - サーバー方式（Waitress / ASGI）の同時実行限界の比較
+AI相談（/api/ai-consult）を N 件同時に投げ、その間に / の応答時間を計測する
+
+- 生成APIは GENAI_FAKE_LATENCY（--llm-latency 秒待って定型文を返す）に置き換えるため、APIキー不要
+- 埋め込みは local プロバイダ、応答キャッシュは無効（毎回「生成」を待たせる）
+- 各方式のサーバーをこのスクリプト自身のサブプロセス（--serve）として起動する
+- 指標:
+    consult_wall_seconds   : N件すべての相談が返るまでの時間（理想は --llm-latency 程度）
+    effective_concurrency  : 完了件数 × llm_latency / 経過時間（同時に待てた相談の数）
+    probe_latency_ms       : 相談が処理中の間の / の応答時間（スレッド枯渇の影響）
+
+[!] ベクトル探索・ユーザー作成でDBにアクセスするため、DBを起動した状態で実行すること
+
+使い方:
+    python scripts/bench_serving_modes.py --concurrency 10 100 1000 --llm-latency 2 --output bench_serving.json
+"""
+import sys
+import os
+import argparse
+import asyncio
+import json
+import subprocess
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST = '127.0.0.1'
+
+
+# ==================== サーバー（サブプロセス側） ====================
+
+def serve(mode, port, threads, connection_limit):
+    if mode == 'asgi':
+        import uvicorn
+        from app.asgi import asgi_app
+        uvicorn.run(asgi_app, host=HOST, port=port, access_log=False, log_level='warning',
+                    backlog=connection_limit)
+    else:
+        from waitress import serve as waitress_serve
+        from app import app
+        # 接続数の上限ではなくスレッド数が律速になるよう、受け付ける接続数は十分に取る
+        waitress_serve(app, host=HOST, port=port, threads=threads,
+                       connection_limit=connection_limit, backlog=connection_limit)
+
+
+# ==================== HTTPクライアント（依存ライブラリなし） ====================
+
+async def http_request(port, method, path, body=None, cookie=None, timeout=60.0):
+    """
+    HTTP/1.1 のリクエストを1件送る（Connection: close）
+    Returns: (status, headers dict, body bytes)
+    """
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(HOST, port), timeout)
+    try:
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        headers = [f"{method} {path} HTTP/1.1", f"Host: {HOST}:{port}", "Connection: close",
+                   f"Content-Length: {len(payload)}"]
+        if body is not None:
+            headers.append("Content-Type: application/json")
+        if cookie:
+            headers.append(f"Cookie: {cookie}")
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('ascii') + payload)
+        await writer.drain()
+        raw = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+
+    head, _, content = raw.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    response_headers = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(':')
+        response_headers[key.strip().lower()] = value.strip()
+    return status, response_headers, content
+
+
+async def wait_ready(port, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, _, _ = await http_request(port, 'GET', '/api/pool_count', timeout=5)
+            if status == 200:
+                return True
+        except OSError:
+            pass
+        await asyncio.sleep(0.5)
+    return False
+
+
+# ==================== 計測 ====================
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(int(len(sorted_values) * p), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def measure(port, cookie, concurrency, llm_latency, timeout):
+    """相談 concurrency 件を同時に投げ、完了までの間 / を計測し続ける"""
+    consult_latencies, errors = [], 0
+
+    async def consult(i):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            status, _, _ = await http_request(
+                port, 'POST', '/api/ai-consult', {'message': f"ベンチマークの相談 {i}"},
+                cookie=cookie, timeout=timeout
+            )
+            if status != 200:
+                errors += 1
+                return
+            consult_latencies.append(time.perf_counter() - started)
+        except (OSError, asyncio.TimeoutError):
+            errors += 1
+
+    started = time.perf_counter()
+    consults = [asyncio.ensure_future(consult(i)) for i in range(concurrency)]
+
+    probe_latencies, probe_errors = [], 0
+    while not all(task.done() for task in consults):
+        probe_started = time.perf_counter()
+        try:
+            status, _, _ = await http_request(port, 'GET', '/', cookie=cookie, timeout=timeout)
+            if status == 200:
+                probe_latencies.append((time.perf_counter() - probe_started) * 1000)
+            else:
+                probe_errors += 1
+        except (OSError, asyncio.TimeoutError):
+            probe_errors += 1
+        await asyncio.sleep(0.05)
+
+    await asyncio.gather(*consults)
+    wall = time.perf_counter() - started
+    consult_latencies.sort()
+    probe_latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'completed': len(consult_latencies),
+        'errors': errors,
+        'consult_wall_seconds': wall,
+        'consult_latency_p50': percentile(consult_latencies, 0.50),
+        'consult_latency_p99': percentile(consult_latencies, 0.99),
+        'effective_concurrency': len(consult_latencies) * llm_latency / wall if wall else 0.0,
+        'probe_requests': len(probe_latencies),
+        'probe_errors': probe_errors,
+        'probe_latency_ms': {
+            'p50': percentile(probe_latencies, 0.50),
+            'p99': percentile(probe_latencies, 0.99),
+            'max': probe_latencies[-1] if probe_latencies else None,
+        },
+    }
+
+
+async def bench_mode(mode, args):
+    env = dict(os.environ)
+    env.update({
+        'SERVER_MODE': mode,
+        'GENAI_FAKE_LATENCY': str(args.llm_latency),
+        'EMBEDDING_PROVIDER': 'local',
+        'EMBEDDING_CACHE_DB': '0',
+        'RESPONSE_CACHE': '0',
+        'WAITRESS_THREADS': str(args.threads),
+    })
+    connection_limit = max(args.concurrency) + 100
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(args.port),
+         '--threads', str(args.threads), '--connection-limit', str(connection_limit)],
+        env=env
+    )
+    try:
+        if not await wait_ready(args.port):
+            print(f"[x] {mode} サーバーが起動しませんでした", file=sys.stderr)
+            return []
+        # セッションCookieを1つ取得して全リクエストで共有（ユーザー行を増やさない）
+        _, headers, _ = await http_request(args.port, 'GET', '/')
+        cookie = headers.get('set-cookie', '').split(';')[0] or None
+
+        results = []
+        for concurrency in args.concurrency:
+            result = await measure(args.port, cookie, concurrency, args.llm_latency, args.timeout)
+            result['mode'] = mode
+            results.append(result)
+            print(f"  {mode} x{concurrency}: {result['completed']}件完了 / エラー {result['errors']} / "
+                  f"{result['consult_wall_seconds']:.1f}秒 / 実効同時数 {result['effective_concurrency']:.1f} / "
+                  f"/ の p99 {result['probe_latency_ms']['p99'] or 0:.0f}ms", file=sys.stderr)
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def raise_fd_limit():
+    """同時接続数ぶんのファイルディスクリプタを確保（Unixのみ）"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="サーバー方式（Waitress / ASGI）の同時実行限界の比較")
+    parser.add_argument('--modes', nargs='+', default=['waitress', 'asgi'], choices=['waitress', 'asgi'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 1000],
+                        help="同時に投げるAI相談の件数")
+    parser.add_argument('--llm-latency', type=float, default=2.0, help="生成APIの模擬レイテンシ（秒）")
+    parser.add_argument('--threads', type=int, default=4, help="Waitressのスレッド数")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--timeout', type=float, default=300.0, help="1リクエストの最大待ち時間（秒）")
+    parser.add_argument('--output', help="JSONの出力先（省略時は標準出力）")
+    parser.add_argument('--serve', choices=['waitress', 'asgi'], help=argparse.SUPPRESS)
+    parser.add_argument('--connection-limit', type=int, default=1000, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.threads, args.connection_limit)
+        return
+
+    raise_fd_limit()
+    report = {
+        'config': {
+            'concurrency': args.concurrency, 'llm_latency': args.llm_latency,
+            'waitress_threads': args.threads,
+        },
+        'results': [],
+    }
+    for mode in args.modes:
+        print(f"[*] {mode} モードを計測中...", file=sys.stderr)
+        report['results'].extend(asyncio.run(bench_mode(mode, args)))
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"[v] 結果を {args.output} に保存しました", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
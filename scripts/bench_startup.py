@@ -0,0 +1,186 @@
+"""
+bench_startup.py - アプリの起動時間・メモリ使用量の計測
+新しいPythonプロセスで `import app`（Flaskアプリ・全ルートの読み込み）だけを行い、
+- 所要時間（wall clock, --repeat 回の中央値）
+- python -X importtime による累積 import 時間の上位モジュール
+- import 後の最大RSS
+- 重いモジュール（google.generativeai, grpc, numpy など）が読み込まれたか
+を計測する。DBには接続しない（import のみ）
+
+--cold-start を付けると、保存先（STORAGE_BACKEND）ごとに
+「起動 → prepare_environment() → / を1回表示」までの時間と最大RSSを比較する
+（postgres の場合は DB コンテナ tanka_postgres のメモリ使用量も docker stats で取得。
+  --docker-restart でコンテナを止めてから計測し、Docker の起動待ちも含める）
+
+使い方:
+    python scripts/bench_startup.py --repeat 5 --top 15 --output bench_startup.json
+    python scripts/bench_startup.py --cold-start --backends postgres,sqlite --repeat 3
+"""
+import sys
+import os
+import argparse
+import json
+import statistics
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 読み込まれたかを確認するモジュール
+WATCHED_MODULES = ['google.generativeai', 'grpc', 'google.protobuf', 'numpy', 'psycopg2', 'flask', 'subprocess']
+
+DOCKER_CONTAINER = 'tanka_postgres'
+
+RSS_SNIPPET = """
+import resource
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss_kb //= 1024  # macOS は bytes 単位
+"""
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+%s
+print(json.dumps({
+    'import_seconds': elapsed,
+    'max_rss_mb': rss_kb / 1024,
+    'loaded': {name: name in sys.modules for name in %r},
+}))
+""" % (RSS_SNIPPET, WATCHED_MODULES)
+
+READY_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+from app.startup import prepare_environment
+ready = prepare_environment()
+status = app.app.test_client().get('/').status_code if ready else None
+elapsed = time.perf_counter() - started
+%s
+print(json.dumps({'ready': ready, 'status': status, 'ready_seconds': elapsed, 'max_rss_mb': rss_kb / 1024}))
+""" % (RSS_SNIPPET,)
+
+
+def run_probe(code, extra_args=(), env=None):
+    """新しいプロセスで code を実行し、最後の行のJSONと stderr を返す"""
+    result = subprocess.run(
+        [sys.executable, *extra_args, '-c', code],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+        env=dict(os.environ, **(env or {}))
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def parse_importtime(stderr, top):
+    """-X importtime の出力から累積時間の上位モジュールを抜き出す"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # "import time:   self [us] | cumulative | imported package"
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        entries.append({
+            'module': name.strip(),
+            'self_ms': int(self_us) / 1000,
+            'cumulative_ms': int(cumulative_us) / 1000,
+        })
+    entries.sort(key=lambda entry: entry['cumulative_ms'], reverse=True)
+    return entries[:top]
+
+
+def docker_memory():
+    """DBコンテナのメモリ使用量（docker stats の表示のまま。取得できなければ None）"""
+    try:
+        result = subprocess.run(
+            ['docker', 'stats', '--no-stream', '--format', '{{.MemUsage}}', DOCKER_CONTAINER],
+            capture_output=True, text=True, timeout=30
+        )
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def measure_import(args):
+    print(f"[*] import app を {args.repeat} 回計測中...", file=sys.stderr)
+    runs = [run_probe(IMPORT_PROBE)[0] for _ in range(args.repeat)]
+    _, importtime_stderr = run_probe(IMPORT_PROBE, ['-X', 'importtime'])
+
+    report = {
+        'python': sys.version.split()[0],
+        'repeat': args.repeat,
+        'import_seconds_median': statistics.median(run['import_seconds'] for run in runs),
+        'max_rss_mb_median': statistics.median(run['max_rss_mb'] for run in runs),
+        'loaded_modules': runs[-1]['loaded'],
+        'slowest_imports': parse_importtime(importtime_stderr, args.top),
+    }
+
+    print(f"  import app: {report['import_seconds_median'] * 1000:.0f}ms / "
+          f"RSS {report['max_rss_mb_median']:.1f}MB", file=sys.stderr)
+    for name, loaded in report['loaded_modules'].items():
+        print(f"  {name}: {'読み込み済み' if loaded else '未読み込み'}", file=sys.stderr)
+    return report
+
+
+def measure_cold_start(args):
+    report = {'python': sys.version.split()[0], 'repeat': args.repeat, 'backends': {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in args.backends.split(','):
+            env = {'STORAGE_BACKEND': backend}
+            if backend == 'sqlite':
+                # 1回目はスキーマ作成・初期データ投入を含む（2回目以降はファイルを再利用）
+                env['SQLITE_PATH'] = os.path.join(tmpdir, 'bench.db')
+            elif args.docker_restart:
+                env['DOCKER_AUTOSTART'] = '1'
+
+            print(f"[*] {backend}: 起動〜最初の表示までを {args.repeat} 回計測中...", file=sys.stderr)
+            runs = []
+            for _ in range(args.repeat):
+                if backend == 'postgres' and args.docker_restart:
+                    subprocess.run(['docker', 'stop', DOCKER_CONTAINER], capture_output=True)
+                runs.append(run_probe(READY_PROBE, env=env)[0])
+
+            result = {
+                'runs': runs,
+                'ready_seconds_median': statistics.median(run['ready_seconds'] for run in runs),
+                'max_rss_mb_median': statistics.median(run['max_rss_mb'] for run in runs),
+            }
+            if backend == 'postgres':
+                result['db_container_memory'] = docker_memory()
+            report['backends'][backend] = result
+
+            line = (f"  {backend}: {result['ready_seconds_median'] * 1000:.0f}ms / "
+                    f"RSS {result['max_rss_mb_median']:.1f}MB")
+            if result.get('db_container_memory'):
+                line += f" + DBコンテナ {result['db_container_memory']}"
+            print(line, file=sys.stderr)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="アプリの起動時間・メモリ使用量の計測")
+    parser.add_argument('--repeat', type=int, default=5, help="計測回数（中央値を採用）")
+    parser.add_argument('--top', type=int, default=15, help="表示する import 時間上位のモジュール数")
+    parser.add_argument('--cold-start', action='store_true',
+                        help="保存先ごとに起動〜最初の表示までの時間・メモリを比較")
+    parser.add_argument('--backends', default='postgres,sqlite', help="--cold-start で比較する保存先")
+    parser.add_argument('--docker-restart', action='store_true',
+                        help="postgres の計測前に DB コンテナを止める（Docker の起動待ちを含める）")
+    parser.add_argument('--output', help="JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    report = measure_cold_start(args) if args.cold_start else measure_import(args)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"[v] 結果を {args.output} に保存しました", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
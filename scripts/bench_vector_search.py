@@ -0,0 +1,272 @@
+"""
+bench_vector_search.py - ベクトル探索の精度（recall@k）・レイテンシ計測
+合成した 768 次元の埋め込みを tanka_pool に投入し、search_similar_tankas() を
+厳密探索（exact=True）と近似探索（HNSW / IVFFlat）で実行して比較する
+
+- 指標: recall@k（厳密探索の上位k件のうち近似探索で得られた割合）, p50/p95/p99 レイテンシ
+- スイープ: コーパスサイズ × インデックス構築パラメータ × 検索パラメータ（ef_search / probes）
+- --memory: プロセス内NumPy索引（app/vector_index.py）のレイテンシ・メモリ使用量も並べて計測
+- 結果は JSON で出力し、回帰の追跡に使う
+
+[!] ベンチマーク中は tanka_pool のベクトル索引を作り直すため、検証用DBで実行すること
+    （終了時にベンチマーク用の行を削除し、.env の設定どおりの索引に戻す）
+
+使い方:
+    python scripts/bench_vector_search.py --sizes 1000 10000 \\
+        --index hnsw:m=16,ef_construction=64 ivfflat:lists=100 \\
+        --ef-search 10 40 100 --probes 1 10 --output bench_vector.json
+"""
+import sys
+import os
+import argparse
+import json
+import math
+import random
+import time
+import uuid
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg2.extras import execute_values
+
+from app.config import get_db_connection
+from app.models import search_similar_tankas, get_or_create_user
+from app import vector_index
+from app.vector_index import load_vector_index
+from scripts.init_db import create_vector_index, VECTOR_INDEX_NAMES
+
+DIMENSIONS = 768
+BENCH_INDEX_NAME = 'idx_tanka_pool_embedding_bench'
+
+
+# ==================== 合成データ ====================
+
+def normalize(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def make_corpus(rng, size, centers):
+    """クラスタ構造を持つ埋め込み（実際の文章埋め込みに近い分布）を生成"""
+    corpus = []
+    for _ in range(size):
+        center = rng.choice(centers)
+        corpus.append(normalize([c + rng.gauss(0, 0.5) for c in center]))
+    return corpus
+
+
+def make_queries(rng, corpus, count):
+    """コーパス内の点の近くにクエリを生成"""
+    return [normalize([x + rng.gauss(0, 0.05) for x in rng.choice(corpus)]) for _ in range(count)]
+
+
+def to_vector_literal(vector):
+    return '[' + ','.join(f'{x:.6f}' for x in vector) + ']'
+
+
+# ==================== DB操作 ====================
+
+def load_corpus(cursor, vectors, start, user_ids):
+    """ベンチマーク用の行を投入（所有ユーザーを user_ids からランダムに割り当て）"""
+    rows = [
+        (f"__bench__ {start + i}", user_ids[(start + i) % len(user_ids)], to_vector_literal(v))
+        for i, v in enumerate(vectors)
+    ]
+    execute_values(
+        cursor,
+        "INSERT INTO tanka_pool(content, user_id, embedding) VALUES %s",
+        rows,
+        template="(%s, %s, %s::vector)",
+        page_size=500
+    )
+
+
+def parse_index_spec(spec):
+    """'hnsw:m=16,ef_construction=64' -> ('hnsw', {'m': 16, 'ef_construction': 64})"""
+    index_type, _, params = spec.partition(':')
+    options = {}
+    for pair in filter(None, params.split(',')):
+        key, _, value = pair.partition('=')
+        options[key.strip()] = int(value)
+    return index_type.lower(), options
+
+
+def build_index(cursor, index_type, options):
+    """既存のベクトル索引を外し、指定パラメータで作り直す"""
+    for name in list(VECTOR_INDEX_NAMES.values()) + [BENCH_INDEX_NAME]:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+    with_clause = ', '.join(f"{key} = {int(value)}" for key, value in options.items())
+    cursor.execute(f"""
+        CREATE INDEX {BENCH_INDEX_NAME} ON tanka_pool
+        USING {index_type} (embedding vector_cosine_ops)
+        {f'WITH ({with_clause})' if with_clause else ''}
+    """)
+    cursor.execute("ANALYZE tanka_pool")
+
+
+# ==================== 計測 ====================
+
+def percentile(sorted_values, p):
+    index = min(int(len(sorted_values) * p), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_queries(queries, k, exclude_user_id, **search_options):
+    """全クエリを実行し、(結果IDリストの一覧, レイテンシ[ms]の一覧) を返す"""
+    results, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        rows = search_similar_tankas(query, limit=k, exclude_user_id=exclude_user_id, **search_options)
+        latencies.append((time.perf_counter() - started) * 1000)
+        results.append([row[0] for row in rows])
+    return results, latencies
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def recall_at_k(approx, exact, k):
+    total = 0.0
+    for got, expected in zip(approx, exact):
+        if expected:
+            total += len(set(got) & set(expected)) / min(k, len(expected))
+    return total / len(exact)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベクトル探索の recall / レイテンシ計測")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help="コーパスサイズ")
+    parser.add_argument('--queries', type=int, default=100, help="クエリ数")
+    parser.add_argument('-k', type=int, default=10, help="recall@k の k")
+    parser.add_argument('--index', nargs='+', default=['hnsw:m=16,ef_construction=64'],
+                        help="索引構築パラメータ（例: hnsw:m=16,ef_construction=64 ivfflat:lists=100）")
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[10, 40, 100], help="HNSWの検索パラメータ")
+    parser.add_argument('--probes', type=int, nargs='+', default=[1, 10], help="IVFFlatの検索パラメータ")
+    parser.add_argument('--clusters', type=int, default=50, help="合成データのクラスタ数")
+    parser.add_argument('--exclude', action='store_true', help="自分の歌を除外する条件付きで検索")
+    parser.add_argument('--memory', action='store_true', help="プロセス内NumPy索引も計測")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    # search_similar_tankas() は常に pgvector 経路で計測する（--memory は索引を直接呼ぶ）
+    vector_index.VECTOR_SEARCH_BACKEND = 'pgvector'
+
+    rng = random.Random(args.seed)
+    centers = [[rng.gauss(0, 1) for _ in range(DIMENSIONS)] for _ in range(args.clusters)]
+
+    # ベンチマーク用ユーザー（4人で行を分け合い、--exclude では1人目を除外）
+    user_ids = [get_or_create_user(f"bench-vector-{uuid.uuid4()}") for _ in range(4)]
+    exclude_user_id = user_ids[0] if args.exclude else None
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    report = {
+        'config': {
+            'sizes': args.sizes, 'queries': args.queries, 'k': args.k, 'index': args.index,
+            'ef_search': args.ef_search, 'probes': args.probes, 'exclude': args.exclude,
+            'seed': args.seed, 'dimensions': DIMENSIONS,
+        },
+        'results': [],
+    }
+
+    try:
+        corpus = []
+        for size in sorted(args.sizes):
+            print(f"[*] コーパスを {size} 件まで投入中...", file=sys.stderr)
+            # 索引を外してから投入（HNSWへの逐次挿入は遅いため）
+            for name in list(VECTOR_INDEX_NAMES.values()) + [BENCH_INDEX_NAME]:
+                cursor.execute(f"DROP INDEX IF EXISTS {name}")
+            new_vectors = make_corpus(rng, size - len(corpus), centers)
+            load_corpus(cursor, new_vectors, len(corpus), user_ids)
+            conn.commit()
+            corpus.extend(new_vectors)
+            queries = make_queries(rng, corpus, args.queries)
+
+            # 正解データ（厳密探索）
+            exact_ids, exact_latencies = run_queries(queries, args.k, exclude_user_id, exact=True)
+            report['results'].append({
+                'corpus_size': size, 'index': 'exact', 'build_params': {}, 'search_params': {},
+                'recall_at_k': 1.0, 'latency_ms': summarize(exact_latencies),
+            })
+            print(f"  exact: p50 {summarize(exact_latencies)['p50']:.2f}ms", file=sys.stderr)
+
+            if args.memory:
+                started = time.perf_counter()
+                index = load_vector_index()
+                load_seconds = time.perf_counter() - started
+                memory_ids, latencies = [], []
+                for query in queries:
+                    query_started = time.perf_counter()
+                    rows = index.search(query, args.k, exclude_user_id)
+                    latencies.append((time.perf_counter() - query_started) * 1000)
+                    memory_ids.append([row[0] for row in rows])
+                result = {
+                    'corpus_size': size, 'index': 'memory', 'build_params': {},
+                    'build_seconds': load_seconds, 'search_params': {},
+                    'recall_at_k': recall_at_k(memory_ids, exact_ids, args.k),
+                    'latency_ms': summarize(latencies),
+                    'memory_bytes': index.stats()['memory_bytes'],
+                }
+                report['results'].append(result)
+                print(f"  memory: recall@{args.k} {result['recall_at_k']:.3f} / "
+                      f"p50 {result['latency_ms']['p50']:.3f}ms / "
+                      f"{result['memory_bytes'] / 1024 / 1024:.1f}MB", file=sys.stderr)
+
+            for spec in args.index:
+                index_type, build_params = parse_index_spec(spec)
+                started = time.perf_counter()
+                build_index(cursor, index_type, build_params)
+                conn.commit()
+                build_seconds = time.perf_counter() - started
+
+                if index_type == 'hnsw':
+                    sweeps = [{'ef_search': value} for value in args.ef_search]
+                else:
+                    sweeps = [{'probes': value} for value in args.probes]
+
+                for search_params in sweeps:
+                    approx_ids, latencies = run_queries(queries, args.k, exclude_user_id, **search_params)
+                    result = {
+                        'corpus_size': size,
+                        'index': index_type,
+                        'build_params': build_params,
+                        'build_seconds': build_seconds,
+                        'search_params': search_params,
+                        'recall_at_k': recall_at_k(approx_ids, exact_ids, args.k),
+                        'latency_ms': summarize(latencies),
+                    }
+                    report['results'].append(result)
+                    print(f"  {index_type} {build_params} {search_params}: "
+                          f"recall@{args.k} {result['recall_at_k']:.3f} / "
+                          f"p50 {result['latency_ms']['p50']:.2f}ms / "
+                          f"p99 {result['latency_ms']['p99']:.2f}ms", file=sys.stderr)
+    finally:
+        # 後片付け: ベンチマーク用の行・ユーザーを削除し、.env の設定どおりの索引に戻す
+        conn.rollback()
+        cursor.execute("DELETE FROM tanka_pool WHERE user_id = ANY(%s)", (user_ids,))
+        cursor.execute("DELETE FROM users WHERE user_id = ANY(%s)", (user_ids,))
+        cursor.execute(f"DROP INDEX IF EXISTS {BENCH_INDEX_NAME}")
+        create_vector_index(cursor)
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"[v] 結果を {args.output} に保存しました", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+check_category_counts.py - カテゴリごとの短歌数カウンタの整合性チェック
+
+categories.tanka_count（トリガーで維持）を tanka_categories の全件集計と比較し、
+ずれているカテゴリを表示する。--fix を付けると全件集計の値で上書きする
+保存先は STORAGE_BACKEND（.env）に従う
+
+使い方:
+    python scripts/check_category_counts.py
+    python scripts/check_category_counts.py --fix
+
+終了コード: 一致していれば 0、ずれがあれば 1（--fix で修復した場合は 0）
+"""
+import sys
+import os
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import STORAGE_BACKEND
+from app.models import get_category_count_drift, recount_category_counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="カテゴリごとの短歌数カウンタの整合性チェック")
+    parser.add_argument('--fix', action='store_true', help="ずれていたら全件集計の値で上書きする")
+    args = parser.parse_args()
+
+    print(f"[*] categories.tanka_count を全件集計と比較中...（保存先: {STORAGE_BACKEND}）")
+    drift = get_category_count_drift()
+    if not drift:
+        print("[v] すべてのカテゴリでカウンタと全件集計が一致しました")
+        return 0
+
+    for name, stored_count, actual_count in drift:
+        print(f"[!] {name}: カウンタ {stored_count}件 / 全件集計 {actual_count}件")
+
+    if not args.fix:
+        print(f"[x] {len(drift)}件のカテゴリでずれがあります（--fix で修復できます）")
+        return 1
+
+    recount_category_counts()
+    remaining = get_category_count_drift()
+    if remaining:
+        print(f"[x] 修復後も{len(remaining)}件のカテゴリでずれがあります（トリガーを確認してください）")
+        return 1
+    print(f"[v] {len(drift)}件のカテゴリのカウンタを修復しました")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+check_query_plans.py - 主要クエリが想定のインデックスを使うかの確認（EXPLAIN）
+
+主要クエリ（app/storage/postgres.py の該当関数が実行するSQLそのもの）を EXPLAIN (FORMAT JSON) し、
+実行計画に想定のインデックスが現れるかを確認する。
+開発用DBは行数が少なく、インデックスがあってもプランナーが全件スキャンを選ぶため、
+既定では enable_seqscan = off で「インデックスを使える形のクエリか」を確認する
+（--allow-seqscan で実データに対するプランナーの実際の選択を確認）
+
+使い方:
+    python scripts/check_query_plans.py
+    python scripts/check_query_plans.py --allow-seqscan --verbose
+
+終了コード: すべて想定どおりなら 0、そうでなければ 1
+"""
+import sys
+import os
+import argparse
+import json
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import get_db_connection, VECTOR_INDEX_CONFIG
+from app.storage import postgres
+from app.vector_index import DIMENSIONS
+from scripts.init_db import VECTOR_INDEX_NAMES
+
+# EXPLAIN 用の埋め込み（値は何でもよく、次元だけ合わせる）
+SAMPLE_EMBEDDING = '[' + ','.join(['0.1'] * DIMENSIONS) + ']'
+
+
+def build_hot_queries():
+    """
+    確認するクエリの一覧（SQLは app/storage/postgres.py が実行するものをそのまま使う）
+    Returns: [(関数名, 想定のインデックス, SQL, パラメータ), ...]
+    """
+    queries = [
+        ('get_user_exchange_history', 'idx_exchange_history_user_time',
+         postgres.USER_EXCHANGE_HISTORY_QUERY, {'user_id': 1, 'limit': 20}),
+        ('get_user_exchange_stats', 'idx_exchange_history_user_time',
+         postgres.USER_EXCHANGE_STATS_QUERY, {'user_id': 1}),
+        ('select_random_tanka', 'idx_tanka_pool_random_key',
+         postgres.RANDOM_TANKA_QUERY, {'start_key': 0.5, 'exclude_user_id': 1}),
+        # データ変更を含むCTEだが、EXPLAIN（ANALYZE なし）は実行しない
+        ('perform_exchange', 'idx_tanka_pool_random_key', postgres.EXCHANGE_QUERY, {
+            'start_key': 0.5, 'user_id': 1, 'content': '', 'embedding': None,
+        }),
+        ('get_tankas_page', 'idx_tanka_pool_created_id', postgres.build_tankas_page_query(True), {
+            'created_at': datetime(2100, 1, 1), 'id': 0, 'limit': 51,
+        }),
+        ('get_tankas_by_category', 'categories_name_key',
+         postgres.TANKAS_BY_CATEGORY_QUERY, {'category_name': '春'}),
+        ('get_popular_tankas', 'idx_tanka_popularity_rank',
+         postgres.POPULAR_TANKAS_QUERY, {'limit': 10}),
+    ]
+
+    vector_index = VECTOR_INDEX_NAMES.get(VECTOR_INDEX_CONFIG['type'])
+    if vector_index:
+        limit = 1
+        queries.append(('search_similar_tankas', vector_index,
+                        postgres.build_similarity_query(postgres.pyformat_placeholder), {
+                            'embedding': SAMPLE_EMBEDDING,
+                            'exclude_user_id': 1,
+                            'limit': limit,
+                            'candidates': postgres.similarity_candidates(limit, 1),
+                        }))
+
+    # storage の関数ではなく、集計・外部キーが実行するクエリ
+    queries += [
+        # 受け取られた回数の集計（scripts/init_db.py の tanka_popularity の再集計）
+        ('受け取られた回数（人気ランキングの集計）', 'idx_exchange_history_received', """
+            SELECT COUNT(*) FROM exchange_history WHERE received_tanka_id = %(tanka_id)s
+        """, {'tanka_id': 1}),
+        # users 削除時に外部キー（ON DELETE SET NULL）が実行する更新（EXPLAIN のみで実行はしない）
+        ('users 削除時の ON DELETE SET NULL', 'idx_tanka_pool_user', """
+            UPDATE ONLY tanka_pool SET user_id = NULL WHERE user_id = %(user_id)s
+        """, {'user_id': 1}),
+    ]
+    return queries
+
+
+def plan_index_names(plan):
+    """実行計画（JSON）に現れるインデックス名をすべて集める"""
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        names |= plan_index_names(child)
+    return names
+
+def check_query_plans(allow_seqscan=False, verbose=False):
+    """
+    build_hot_queries() の実行計画を確認
+    Returns: すべて想定のインデックスを使っていれば True
+    """
+    queries = build_hot_queries()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    failures = 0
+    try:
+        if not allow_seqscan:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        print("[*] 主要クエリの実行計画を確認中..." + ("" if allow_seqscan else "（enable_seqscan = off）"))
+        for name, index_name, sql, params in queries:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            used = plan_index_names(plan[0]['Plan'])
+            if index_name in used:
+                print(f"[v] {name}: {index_name}")
+            else:
+                failures += 1
+                print(f"[x] {name}: {index_name} を使っていません（使用: {', '.join(sorted(used)) or 'なし'}）")
+            if verbose:
+                print(json.dumps(plan[0]['Plan'], ensure_ascii=False, indent=2))
+    finally:
+        # SET LOCAL・EXPLAIN の UPDATE を含め、何も残さない
+        conn.rollback()
+        cursor.close()
+        conn.close()
+
+    if failures:
+        print(f"[x] {failures}件のクエリが想定のインデックスを使っていません（python scripts/migrate.py を確認してください）")
+        return False
+    print(f"[v] {len(queries)}件のクエリすべてが想定のインデックスを使っています")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="主要クエリが想定のインデックスを使うかの確認（EXPLAIN）")
+    parser.add_argument('--allow-seqscan', action='store_true',
+                        help="enable_seqscan を変えず、プランナーの実際の選択を確認")
+    parser.add_argument('--verbose', action='store_true', help="実行計画を表示")
+    args = parser.parse_args()
+    return 0 if check_query_plans(args.allow_seqscan, args.verbose) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
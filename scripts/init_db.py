@@ -2,12 +2,26 @@
 init_db.py - DB初期化スクリプト
 テーブル作成とダミーデータ投入
 Foreign Key, JOIN, SubQueryを使用する本格的なDB設計
+
+使い方:
+    python scripts/init_db.py           # 未初期化・スキーマが古い場合のみ初期化
+    python scripts/init_db.py --force   # バージョンに関係なく初期化（CREATE ... IF NOT EXISTS）
+    python scripts/init_db.py --reset   # 全テーブルを削除して作り直す
 """
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app.config import get_db_connection
+from app.config import get_db_connection, VECTOR_INDEX_CONFIG
+from scripts.migrate import (
+    get_schema_version, set_schema_version, run_migrations, LATEST_VERSION,
+    POOL_COUNTER_SLOTS, create_pool_counter_function
+)
+
+# このスクリプトが作るスキーマ（ベースライン）のバージョン
+# これ以降の変更（インデックスの追加など）は scripts/migrate.py の MIGRATIONS に番号順に追加する。
+# schema_version テーブルの値が LATEST_VERSION と一致すれば、起動時の初期化を丸ごと省略する
+SCHEMA_VERSION = 4
 
 # ダミー短歌データ（カテゴリ情報付き）
 DUMMY_TANKAS = [
@@ -45,19 +59,206 @@ CATEGORIES = [
     ("自然", "自然をテーマにした短歌")
 ]
 
-def init_database():
-    """データベースを初期化"""
-    reset = "--reset" in sys.argv
+def create_pool_counter(cursor):
+    """
+    tanka_pool の件数カウンタ表とトリガーを作成
+
+    SQL要素: TRIGGER, PL/pgSQL
+    INSERT/DELETE のたびにトランザクションごとに決まるスロットを ±1 し、TRUNCATE では0に戻す
+    （トリガー関数は scripts/migrate.py の create_pool_counter_function と共通）
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tanka_pool_counter (
+            slot SMALLINT PRIMARY KEY,
+            tanka_count BIGINT NOT NULL DEFAULT 0
+        )
+    ''')
+    create_pool_counter_function(cursor)
+
+    cursor.execute("SELECT COUNT(*) FROM tanka_pool_counter")
+    if cursor.fetchone()[0] == 0:
+        # 初回: 既存の件数で初期化（初期化中に件数が変わらないようロック）
+        cursor.execute("LOCK TABLE tanka_pool IN SHARE ROW EXCLUSIVE MODE")
+        cursor.execute('''
+            INSERT INTO tanka_pool_counter(slot, tanka_count)
+            SELECT s, CASE WHEN s = 0 THEN (SELECT COUNT(*) FROM tanka_pool) ELSE 0 END
+            FROM generate_series(0, %s - 1) AS s
+        ''', (POOL_COUNTER_SLOTS,))
+
+    cursor.execute("DROP TRIGGER IF EXISTS trg_tanka_pool_count ON tanka_pool")
+    cursor.execute('''
+        CREATE TRIGGER trg_tanka_pool_count
+        AFTER INSERT OR DELETE ON tanka_pool
+        FOR EACH ROW EXECUTE FUNCTION tanka_pool_count_trigger()
+    ''')
+    cursor.execute("DROP TRIGGER IF EXISTS trg_tanka_pool_truncate ON tanka_pool")
+    cursor.execute('''
+        CREATE TRIGGER trg_tanka_pool_truncate
+        AFTER TRUNCATE ON tanka_pool
+        FOR EACH STATEMENT EXECUTE FUNCTION tanka_pool_count_trigger()
+    ''')
+
+def create_category_counter(cursor):
+    """
+    categories.tanka_count（カテゴリごとの短歌数）とトリガーを作成
+
+    SQL要素: TRIGGER, PL/pgSQL
+    tanka_categories の INSERT/DELETE/UPDATE のたびに該当カテゴリを ±1 する。
+    交換で短歌が削除されると ON DELETE CASCADE で tanka_categories の行も消え、トリガーが減算する
+    （カウンタと関連行は同じトランザクションで変わるため、どの時点のスナップショットでも一致する）
+    """
+    cursor.execute('''
+        ALTER TABLE categories
+        ADD COLUMN IF NOT EXISTS tanka_count INTEGER NOT NULL DEFAULT 0
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION category_count_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE categories SET tanka_count = tanka_count + 1 WHERE category_id = NEW.category_id;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                UPDATE categories SET tanka_count = tanka_count - 1 WHERE category_id = OLD.category_id;
+            END IF;
+            IF TG_OP = 'TRUNCATE' THEN
+                UPDATE categories SET tanka_count = 0;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+
+    # 既存の件数で数え直す（トリガーの作成までに件数が変わらないようロック）
+    cursor.execute("LOCK TABLE tanka_categories IN SHARE ROW EXCLUSIVE MODE")
+    recount_categories(cursor)
+
+    cursor.execute("DROP TRIGGER IF EXISTS trg_category_count ON tanka_categories")
+    cursor.execute('''
+        CREATE TRIGGER trg_category_count
+        AFTER INSERT OR DELETE OR UPDATE OF category_id ON tanka_categories
+        FOR EACH ROW EXECUTE FUNCTION category_count_trigger()
+    ''')
+    cursor.execute("DROP TRIGGER IF EXISTS trg_category_truncate ON tanka_categories")
+    cursor.execute('''
+        CREATE TRIGGER trg_category_truncate
+        AFTER TRUNCATE ON tanka_categories
+        FOR EACH STATEMENT EXECUTE FUNCTION category_count_trigger()
+    ''')
+
+def recount_categories(cursor):
+    """categories.tanka_count を tanka_categories の全件集計で上書き"""
+    cursor.execute('''
+        UPDATE categories c
+        SET tanka_count = (SELECT COUNT(*) FROM tanka_categories tc WHERE tc.category_id = c.category_id)
+    ''')
+
+def create_popularity_view(cursor):
+    """
+    人気ランキングのマテリアライズドビューを作成
+
+    SQL要素: MATERIALIZED VIEW, GROUP BY, STRING_AGG, UNIQUE INDEX
+    短歌ごとの受け取られた回数・カテゴリを事前に集計しておき、/stats では
+    (exchange_count DESC, id) のインデックスから上位を読むだけにする。
+    REFRESH MATERIALIZED VIEW CONCURRENTLY（読み込みを止めない再集計）には一意インデックスが必要
+    """
+    cursor.execute('''
+        CREATE MATERIALIZED VIEW IF NOT EXISTS tanka_popularity AS
+        SELECT
+            tp.id,
+            tp.content,
+            COALESCE(eh.exchange_count, 0) AS exchange_count,
+            STRING_AGG(c.name, ', ') AS categories
+        FROM tanka_pool tp
+        LEFT JOIN (
+            SELECT received_tanka_id, COUNT(*) AS exchange_count
+            FROM exchange_history
+            GROUP BY received_tanka_id
+        ) eh ON eh.received_tanka_id = tp.id
+        LEFT JOIN tanka_categories tc ON tp.id = tc.tanka_id
+        LEFT JOIN categories c ON tc.category_id = c.category_id
+        GROUP BY tp.id, tp.content, eh.exchange_count
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_tanka_popularity_id ON tanka_popularity(id)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tanka_popularity_rank
+        ON tanka_popularity(exchange_count DESC, id)
+    ''')
+
+# ベクトル索引の種類ごとのインデックス名
+VECTOR_INDEX_NAMES = {
+    'hnsw': 'idx_tanka_pool_embedding_hnsw',
+    'ivfflat': 'idx_tanka_pool_embedding_ivfflat',
+}
+
+def create_vector_index(cursor):
+    """
+    tanka_pool.embedding の近似最近傍（ANN）インデックスを作成
+
+    SQL要素: pgvector HNSW / IVFFlat インデックス（コサイン距離 vector_cosine_ops）
+    インデックスが無いと <=> による並び替えが毎回全件スキャンになる。
+    VECTOR_INDEX_TYPE を変更した場合は、もう一方の種類のインデックスを削除する。
+
+    Returns: 作成した（または既存の）インデックス名、none の場合は None
+    """
+    index_type = VECTOR_INDEX_CONFIG['type']
+    for other_type, name in VECTOR_INDEX_NAMES.items():
+        if other_type != index_type:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+    if index_type == 'hnsw':
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS {VECTOR_INDEX_NAMES['hnsw']}
+            ON tanka_pool USING hnsw (embedding vector_cosine_ops)
+            WITH (m = %s, ef_construction = %s)
+        ''', (VECTOR_INDEX_CONFIG['hnsw_m'], VECTOR_INDEX_CONFIG['hnsw_ef_construction']))
+    elif index_type == 'ivfflat':
+        # IVFFlatはデータからクラスタを作るため、データ投入後に作成する
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS {VECTOR_INDEX_NAMES['ivfflat']}
+            ON tanka_pool USING ivfflat (embedding vector_cosine_ops)
+            WITH (lists = %s)
+        ''', (VECTOR_INDEX_CONFIG['ivfflat_lists'],))
+    else:
+        return None
+    return VECTOR_INDEX_NAMES[index_type]
+
+def init_database(reset=None, force=None, show_schema=False):
+    """
+    データベースを初期化し、未適用のマイグレーション（scripts/migrate.py）を適用
+    スキーマが最新（schema_version が LATEST_VERSION と一致し、ベクトル索引の設定も同じ）なら何もしない。
+    ベースライン（SCHEMA_VERSION）以降のDBはマイグレーションだけを適用する
+    reset: 既存テーブルを削除して作り直す / force: バージョンが一致していても初期化を実行
+    show_schema: 初期化後にテーブル・Foreign Key制約の一覧を表示
+    Returns: 初期化・マイグレーションを実行したら True、最新のため省略したら False
+    """
+    if reset is None:
+        reset = "--reset" in sys.argv
+    if force is None:
+        force = "--force" in sys.argv
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
+        if not reset and not force:
+            applied = get_schema_version(cursor)
+            if applied == (LATEST_VERSION, VECTOR_INDEX_CONFIG['type']):
+                print(f"[v] スキーマは最新です（version {LATEST_VERSION}）- 初期化をスキップ")
+                return False
+            if applied and applied[0] >= SCHEMA_VERSION and applied[1] == VECTOR_INDEX_CONFIG['type']:
+                conn.commit()  # 読み込みのトランザクションを終えてから autocommit に切り替える
+                run_migrations(conn)
+                return True
+
         print("=" * 50)
         print("データベース初期化開始" + (" (RESETモード)" if reset else ""))
         print("=" * 50)
         
         if reset:
             print("[*] 既存のテーブルを削除しています...")
+            cursor.execute("DROP TABLE IF EXISTS schema_version CASCADE")
+            cursor.execute("DROP MATERIALIZED VIEW IF EXISTS tanka_popularity")
+            cursor.execute("DROP TABLE IF EXISTS embedding_cache CASCADE")
+            cursor.execute("DROP TABLE IF EXISTS tanka_pool_counter CASCADE")
             cursor.execute("DROP TABLE IF EXISTS tanka_categories CASCADE")
             cursor.execute("DROP TABLE IF EXISTS exchange_history CASCADE")
             cursor.execute("DROP TABLE IF EXISTS tanka_pool CASCADE")
@@ -101,11 +302,20 @@ def init_database():
                 user_id INTEGER REFERENCES users(user_id) ON DELETE SET NULL,
                 embedding vector(768),
                 exchange_count INTEGER DEFAULT 0,
+                random_key DOUBLE PRECISION NOT NULL DEFAULT random(),
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        # 既存DB向け: ランダム抽出用の乱数キー列を追加
+        cursor.execute('''
+            ALTER TABLE tanka_pool
+            ADD COLUMN IF NOT EXISTS random_key DOUBLE PRECISION NOT NULL DEFAULT random()
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tanka_pool_random_key ON tanka_pool(random_key)')
+        # 一覧のキーセットページネーション用の (created_at, id) のインデックスは
+        # scripts/migrate.py（version 8, CONCURRENTLY）で作成する
         conn.commit()
-        print("[v] tanka_poolテーブルを作成しました（Foreign Key: user_id）")
+        print("[v] tanka_poolテーブルを作成しました（Foreign Key: user_id, Index: random_key）")
         
         # 4. exchange_historyテーブル作成（Foreign Key使用）
         cursor.execute('''
@@ -133,6 +343,29 @@ def init_database():
         conn.commit()
         print("[v] tanka_categoriesテーブルを作成しました（Foreign Key: tanka_id, category_id）")
         
+        # 5.4 埋め込みキャッシュ（本文ハッシュ → ベクトル）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                content_hash CHAR(64) PRIMARY KEY,
+                model VARCHAR(100) NOT NULL,
+                task_type VARCHAR(50) NOT NULL,
+                embedding vector(768) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+        print("[v] embedding_cacheテーブルを作成しました")
+        
+        # 5.5 プール件数カウンタ（COUNT(*) の代わりにトリガーで件数を維持）
+        create_pool_counter(cursor)
+        conn.commit()
+        print("[v] tanka_pool_counterテーブルとトリガーを作成しました")
+        
+        # 5.6 カテゴリごとの短歌数（COUNT(*) の代わりにトリガーで維持）
+        create_category_counter(cursor)
+        conn.commit()
+        print("[v] categories.tanka_count とトリガーを作成しました")
+        
         # 6. カテゴリデータ投入
         cursor.execute("SELECT COUNT(*) FROM categories")
         count = cursor.fetchone()[0]
@@ -177,10 +410,33 @@ def init_database():
         else:
             print(f"[v] 既存短歌あり（{count}件）- スキップ")
         
+        # 7.5 人気ランキングのマテリアライズドビュー
+        create_popularity_view(cursor)
+        conn.commit()
+        print("[v] 人気ランキング（tanka_popularity）を作成しました")
+        
+        # 8. ベクトル索引（データ投入後に作成）
+        index_name = create_vector_index(cursor)
+        conn.commit()
+        if index_name:
+            print(f"[v] ベクトル索引 {index_name} を作成しました")
+        else:
+            print("[v] ベクトル索引なし（VECTOR_INDEX_TYPE=none）- 全件スキャンで検索します")
+        
+        # 9. スキーマバージョンを記録（次回以降の起動では初期化を省略）
+        set_schema_version(cursor, SCHEMA_VERSION)
+        conn.commit()
+        
+        # 10. ベースライン以降のマイグレーション（インデックスは CREATE INDEX CONCURRENTLY で作成）
+        run_migrations(conn)
+        
         print("=" * 50)
-        print("データベース初期化完了")
+        print(f"データベース初期化完了（schema version {LATEST_VERSION}）")
         print("=" * 50)
         
+        if not show_schema:
+            return True
+        
         # テーブル情報を表示
         print("\n【作成されたテーブル】")
         cursor.execute("""
@@ -210,6 +466,7 @@ def init_database():
         """)
         for row in cursor.fetchall():
             print(f"  - {row[0]}.{row[1]} → {row[2]}.{row[3]}")
+        return True
             
     except Exception as e:
         print(f"[x] エラー: {e}")
@@ -220,4 +477,4 @@ def init_database():
         conn.close()
 
 if __name__ == "__main__":
-    init_database()
+    init_database(show_schema=True)
@@ -0,0 +1,268 @@
+"""
+migrate.py - バージョン付きスキーママイグレーション（PostgreSQL）
+
+scripts/init_db.py が作るスキーマ（ベースライン, init_db.SCHEMA_VERSION）以降の変更を、
+MIGRATIONS に番号順に並べて1つずつ適用する。
+適用済みのバージョンは schema_version テーブル（init_db と共通）に記録し、
+未適用のものだけを実行する（途中で失敗しても、次回はその番号から再開）
+
+- インデックスの追加は CREATE INDEX CONCURRENTLY で行い、稼働中のDBでも交換（書き込み）を止めない
+  （トランザクション内では実行できないため、concurrent=True のマイグレーションは autocommit で実行）
+- 複数のプロセスが同時に起動しても、アドバイザリロックで1つだけが適用する
+
+使い方:
+    python scripts/migrate.py              # 未適用のマイグレーションを適用
+    python scripts/migrate.py --status     # 適用済みバージョンと未適用の一覧
+    python scripts/migrate.py --check-plans  # 適用後、主要クエリが想定のインデックスを使うか EXPLAIN で確認
+"""
+import sys
+import os
+import argparse
+import time
+
+import psycopg2.errors
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import get_db_connection, VECTOR_INDEX_CONFIG
+
+# マイグレーションを1プロセスだけが適用するためのアドバイザリロックのキー
+MIGRATION_LOCK = 7210025
+
+
+# ==================== バージョン管理 ====================
+
+def get_schema_version(cursor):
+    """
+    適用済みのスキーマバージョンを取得（1クエリ）
+    Returns: (version, vector_index_type) or None（未初期化）
+    """
+    try:
+        cursor.execute("SELECT version, vector_index FROM schema_version WHERE id = 1")
+        return cursor.fetchone()
+    except psycopg2.errors.UndefinedTable:
+        cursor.connection.rollback()
+        return None
+
+def set_schema_version(cursor, version):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            vector_index VARCHAR(20) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO schema_version(id, version, vector_index) VALUES (1, %s, %s)
+        ON CONFLICT (id) DO UPDATE
+        SET version = EXCLUDED.version, vector_index = EXCLUDED.vector_index, applied_at = CURRENT_TIMESTAMP
+    """, (version, VECTOR_INDEX_CONFIG['type']))
+
+def _record_version(cursor, version):
+    # ベクトル索引の種類は init_db が作り直したときだけ更新する（ここでは番号のみ）
+    cursor.execute(
+        "UPDATE schema_version SET version = %s, applied_at = CURRENT_TIMESTAMP WHERE id = 1",
+        (version,)
+    )
+
+
+# ==================== マイグレーション ====================
+
+def create_index_concurrently(cursor, name, definition):
+    """
+    CREATE INDEX CONCURRENTLY（テーブルへの書き込みを止めずにインデックスを作成）
+
+    CONCURRENTLY が途中で失敗すると無効（indisvalid = false）なインデックスが残り、
+    IF NOT EXISTS では作り直されないため、削除してから作成し直す
+    definition: "ON table(columns)" の部分
+    """
+    cursor.execute("""
+        SELECT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+    """, (name,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        print(f"  [v] {name} は作成済み - スキップ")
+        return
+    if row:
+        print(f"  [!] 前回中断した無効なインデックス {name} を削除します")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cursor.execute(f"CREATE INDEX CONCURRENTLY {name} {definition}")
+    print(f"  [v] {name} を作成しました")
+
+# プール件数カウンタ（tanka_pool_counter）のスロット数
+# 交換のたびに1行を更新すると行ロックで交換同士が直列化されるため、
+# 複数スロットに分散して加算し、読み出し時に合計する
+POOL_COUNTER_SLOTS = 16
+
+def create_pool_counter_function(cursor):
+    """
+    tanka_pool_counter を更新するトリガー関数（init_db のベースラインと version 9 で共通）
+
+    スロットは行ごとではなくトランザクションID から決める。交換は INSERT と DELETE を
+    1トランザクションで行うため、行ごとに乱数で選ぶと2つのスロットを任意の順でロックし、
+    同時の交換どうしが逆順にロックしてデッドロックする。1トランザクション1スロットなら起きない
+    """
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION tanka_pool_count_trigger() RETURNS trigger AS $$
+        DECLARE
+            target SMALLINT := (hashtext(txid_current()::text) & 2147483647) %% %s;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE tanka_pool_counter SET tanka_count = tanka_count + 1 WHERE slot = target;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE tanka_pool_counter SET tanka_count = tanka_count - 1 WHERE slot = target;
+            ELSIF TG_OP = 'TRUNCATE' THEN
+                UPDATE tanka_pool_counter SET tanka_count = 0;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''', (POOL_COUNTER_SLOTS,))
+
+def add_exchange_history_user_index(cursor):
+    # get_user_exchange_history（WHERE user_id ORDER BY exchanged_at DESC LIMIT）・get_user_exchange_stats 用
+    create_index_concurrently(cursor, 'idx_exchange_history_user_time',
+                              'ON exchange_history(user_id, exchanged_at DESC)')
+
+def add_exchange_history_received_index(cursor):
+    # 受け取られた回数の集計（人気ランキング tanka_popularity の再集計）用
+    create_index_concurrently(cursor, 'idx_exchange_history_received',
+                              'ON exchange_history(received_tanka_id)')
+
+def add_tanka_pool_user_index(cursor):
+    # users の削除時の ON DELETE SET NULL（外部キーの参照元の検索）用
+    create_index_concurrently(cursor, 'idx_tanka_pool_user', 'ON tanka_pool(user_id)')
+
+def add_tanka_pool_created_index(cursor):
+    # 一覧のキーセットページネーション（get_tankas_page, 新しい順）用
+    # 以前は init_db が CONCURRENTLY なしで作成していたため、そのDBでは作成済みとしてスキップされる
+    create_index_concurrently(cursor, 'idx_tanka_pool_created_id',
+                              'ON tanka_pool(created_at DESC, id DESC)')
+
+# 番号順に適用する（適用済みの番号・内容は変更せず、追加のみ行う）
+# concurrent=True: autocommit で実行（CONCURRENTLY を使うもの）。False: 1トランザクションで実行
+MIGRATIONS = [
+    {'version': 5, 'name': 'exchange_history(user_id, exchanged_at DESC) のインデックス',
+     'concurrent': True, 'upgrade': add_exchange_history_user_index},
+    {'version': 6, 'name': 'exchange_history(received_tanka_id) のインデックス',
+     'concurrent': True, 'upgrade': add_exchange_history_received_index},
+    {'version': 7, 'name': 'tanka_pool(user_id) のインデックス',
+     'concurrent': True, 'upgrade': add_tanka_pool_user_index},
+    {'version': 8, 'name': 'tanka_pool(created_at DESC, id DESC) のインデックス',
+     'concurrent': True, 'upgrade': add_tanka_pool_created_index},
+    {'version': 9, 'name': 'プール件数カウンタのスロットを1トランザクション1つに（交換どうしのデッドロック防止）',
+     'concurrent': False, 'upgrade': create_pool_counter_function},
+]
+
+LATEST_VERSION = MIGRATIONS[-1]['version']
+
+
+def pending_migrations(applied_version):
+    return [migration for migration in MIGRATIONS if migration['version'] > applied_version]
+
+def _acquire_migration_lock(cursor, interval=1.0):
+    # pg_advisory_lock で待つと、待機中の文のスナップショットを CREATE INDEX CONCURRENTLY が
+    # 待ち続けてしまうため、try で取れるまでポーリングする
+    waiting = False
+    while True:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK,))
+        if cursor.fetchone()[0]:
+            return
+        if not waiting:
+            print("[*] 他のプロセスがマイグレーション中です - 完了を待っています...")
+            waiting = True
+        time.sleep(interval)
+
+def run_migrations(conn=None):
+    """
+    未適用のマイグレーションを番号順に適用
+    schema_version が無い（init_db でベースラインを作成していない）場合は RuntimeError
+    Returns: 適用したマイグレーションの数
+    """
+    own_connection = conn is None
+    if own_connection:
+        conn = get_db_connection()
+    previous_autocommit = conn.autocommit
+    conn.autocommit = True
+    cursor = conn.cursor()
+
+    try:
+        _acquire_migration_lock(cursor)
+        try:
+            applied = get_schema_version(cursor)
+            if applied is None:
+                raise RuntimeError("schema_version がありません（先に python scripts/init_db.py を実行してください）")
+
+            pending = pending_migrations(applied[0])
+            if not pending:
+                print(f"[v] マイグレーションは最新です（version {applied[0]}）")
+                return 0
+
+            for migration in pending:
+                print(f"[*] マイグレーション {migration['version']}: {migration['name']}")
+                started = time.perf_counter()
+                if migration['concurrent']:
+                    migration['upgrade'](cursor)
+                    _record_version(cursor, migration['version'])
+                else:
+                    cursor.execute("BEGIN")
+                    try:
+                        migration['upgrade'](cursor)
+                        _record_version(cursor, migration['version'])
+                    except Exception:
+                        cursor.execute("ROLLBACK")
+                        raise
+                    cursor.execute("COMMIT")
+                print(f"[v] version {migration['version']} を適用しました"
+                      f"（{(time.perf_counter() - started) * 1000:.0f}ms）")
+            return len(pending)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK,))
+    finally:
+        cursor.close()
+        if own_connection:
+            conn.close()
+        else:
+            conn.autocommit = previous_autocommit
+
+def show_status():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        applied = get_schema_version(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+
+    if applied is None:
+        print("[!] schema_version がありません（python scripts/init_db.py で初期化してください）")
+        return
+    print(f"適用済み: version {applied[0]}（最新: {LATEST_VERSION}）")
+    for migration in pending_migrations(applied[0]):
+        print(f"  未適用 {migration['version']}: {migration['name']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="バージョン付きスキーママイグレーション")
+    parser.add_argument('--status', action='store_true', help="適用状況を表示するだけで適用しない")
+    parser.add_argument('--check-plans', action='store_true',
+                        help="適用後、主要クエリの実行計画（EXPLAIN）で想定のインデックスを使うか確認")
+    args = parser.parse_args()
+
+    if args.status:
+        show_status()
+        return 0
+
+    run_migrations()
+    if args.check_plans:
+        from scripts.check_query_plans import check_query_plans
+        return 0 if check_query_plans() else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
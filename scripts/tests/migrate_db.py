@@ -1,6 +1,7 @@
 """
-migrate_db.py - データベースマイグレーションスクリプト
+migrate_db.py - データベースマイグレーションスクリプト（旧形式）
 既存のtanka_poolテーブルにexchange_countカラムを追加
+（ベースライン以前の古いDB向け。以降のスキーマ変更は scripts/migrate.py の MIGRATIONS に追加する）
 """
 import sys
 import os
@@ -1,49 +1,343 @@
 """
-update_embeddings.py - 既存短歌のベクトル埋め込みを生成・更新するスクリプト
+update_embeddings.py - 既存短歌のベクトル埋め込みを生成・更新するスクリプト（バックフィル）
+
+大量の行でも数時間かからず、途中で失敗しても続きから再開できるように
+- サーバーサイドカーソルで未生成の行をID順にストリーミング（fetchall しない）
+- 複数件をまとめたバッチを、上限つきのスレッドプールから並列にAPIへ送信
+- レート制限（リクエスト数/分）を守り、429 を受けたら全体を減速して再試行
+- 結果は UPDATE ... FROM (VALUES ...) で1バッチ1ステートメントで書き込み
+- 書き込み済みの最大IDをチェックポイントファイルに保存し、再実行時はそこから再開
+  （DBの識別子も保存し、別のDB・作り直したテーブルのチェックポイントは使わない。
+  最後まで失敗なく終わったら削除する）
+- --fake（= --provider local）でAPIを使わないローカル埋め込みを使い、オフラインで性能測定ができる
+
+使い方:
+    python scripts/update_embeddings.py
+    python scripts/update_embeddings.py --batch-size 100 --workers 8 --rpm 1500
+    python scripts/update_embeddings.py --fake --fake-latency 200   # オフライン計測
 """
 import sys
 import os
-import google.generativeai as genai
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import psycopg2
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app.config import get_db_connection
-from app.models import update_tanka_embedding, get_tankas_without_embeddings
+from app.config import get_db_connection, DB_CONFIG, EMBEDDING_PROVIDER
+from app.embeddings import PROVIDERS
+
+DEFAULT_CHECKPOINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.update_embeddings.checkpoint.json')
+
+
+# ==================== 埋め込み生成 ====================
+
+def make_embedder(provider, latency=0.0):
+    """プロバイダでバッチ埋め込みを行う関数を返す（latency 秒の待ちを足してAPI遅延を模擬できる）"""
+    def embed(texts):
+        if latency:
+            time.sleep(latency)
+        return provider.embed(texts, task_type="retrieval_document")
+    return embed
+
+
+class RateLimiter:
+    """トークンバケット方式のレート制限（リクエスト数/分）"""
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_until = max(self._next_time, now)
+            self._next_time = wait_until + self.interval
+        time.sleep(max(0.0, wait_until - now))
+
+    def penalize(self, seconds):
+        """429 を受けたとき、全スレッドの次回送信を seconds 秒遅らせる"""
+        with self._lock:
+            self._next_time = max(self._next_time, time.monotonic() + seconds)
+
+
+def is_rate_limited(error):
+    return type(error).__name__ in ('ResourceExhausted', 'TooManyRequests') or '429' in str(error)
+
+
+def embed_with_retry(embed, texts, limiter, max_retries):
+    """レート制限を守りつつ埋め込み、失敗時は指数バックオフで再試行"""
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            return embed(texts)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = min(2 ** attempt, 60) * random.uniform(0.5, 1.0)
+            if is_rate_limited(e):
+                limiter.penalize(delay)
+            print(f"  [!] 埋め込みエラー（{attempt + 1}回目, {delay:.1f}秒後に再試行）: {e}")
+            time.sleep(delay)
+
+
+# ==================== DB読み書き ====================
+
+def stream_pending(conn, after_id, batch_size, limit=None):
+    """embedding が未生成の行をID順にバッチ単位でストリーミング（サーバーサイドカーソル）"""
+    cursor = conn.cursor(name='pending_embeddings')
+    cursor.itersize = batch_size * 10
+    try:
+        cursor.execute("""
+            SELECT id, content FROM tanka_pool
+            WHERE embedding IS NULL AND id > %s
+            ORDER BY id
+            LIMIT %s
+        """, (after_id, limit))
+        batch = []
+        for row in cursor:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        cursor.close()
+
+
+def write_batch(conn, rows, embeddings):
+    """1バッチ分の埋め込みを1ステートメントでまとめて更新"""
+    values = [
+        (tanka_id, '[' + ','.join(repr(float(x)) for x in embedding) + ']')
+        for (tanka_id, _), embedding in zip(rows, embeddings)
+    ]
+    cursor = conn.cursor()
+    try:
+        execute_values(cursor, """
+            UPDATE tanka_pool AS tp
+            SET embedding = v.embedding::vector
+            FROM (VALUES %s) AS v(id, embedding)
+            WHERE tp.id = v.id
+        """, values, page_size=len(values))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def has_pending(conn):
+    """embedding が未生成の行が1件でもあるか"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM tanka_pool WHERE embedding IS NULL)")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def database_identity(conn):
+    """
+    チェックポイントを取ったDB・テーブルの識別子
+    クラスタの system_identifier（権限が無ければ接続先）+ DB名 + tanka_pool の relfilenode
+    （init_db.py --reset や TRUNCATE でテーブルを作り直すと relfilenode が変わる）
+    """
+    cursor = conn.cursor()
+    try:
+        try:
+            cursor.execute("SELECT system_identifier FROM pg_control_system()")
+            cluster = str(cursor.fetchone()[0])
+        except psycopg2.Error:
+            conn.rollback()
+            cluster = f"{DB_CONFIG['host']}:{DB_CONFIG['port']}"
+        cursor.execute("SELECT current_database(), pg_relation_filenode('tanka_pool')")
+        database, filenode = cursor.fetchone()
+        conn.commit()
+        return f"{cluster}/{database}/{filenode}"
+    finally:
+        cursor.close()
+
+
+def load_checkpoint(path, identity):
+    """チェックポイントの last_id（無い・別のDBのものなら 0）"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if checkpoint.get('database') != identity:
+        print("[!] チェックポイントは別のDB（または作り直す前のテーブル）のものです - 最初から処理します")
+        return 0
+    return checkpoint.get('last_id', 0)
+
+
+def save_checkpoint(path, last_id, identity):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'last_id': last_id,
+            'database': identity,
+            'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }, f)
+    os.replace(tmp_path, path)
+
+
+def remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# ==================== バックフィル本体 ====================
+
+def run_backfill(embed, batch_size=64, workers=4, rpm=0, max_retries=5,
+                 checkpoint_path=DEFAULT_CHECKPOINT, restart=False, limit=None):
+    """
+    未生成の埋め込みを一括生成する
+    Returns: {'rows': 更新件数, 'failed': 失敗件数, 'seconds': 所要時間, 'rows_per_sec': スループット,
+              'resumed_from': 再開したID（最初からなら 0）, 'remaining': 終了時に未生成の行が残っているか}
+    """
+    limiter = RateLimiter(rpm)
+    read_conn = get_db_connection()
+    write_conn = get_db_connection()
+    identity = database_identity(read_conn)
+    after_id = 0 if restart else load_checkpoint(checkpoint_path, identity)
+    if after_id:
+        print(f"[*] チェックポイントから再開します（id > {after_id}）")
+    done_rows = failed_rows = streamed_rows = 0
+    started = last_report = time.perf_counter()
+
+    # 送信順のバッチ（先頭から順に完了したものだけチェックポイントを進める）
+    in_order = deque()
+    checkpoint_blocked = False
+
+    def advance_checkpoint():
+        nonlocal checkpoint_blocked
+        last_id = None
+        while in_order and in_order[0]['done']:
+            batch = in_order.popleft()
+            if batch['failed']:
+                # 失敗したバッチより先へは進めない（再実行時に取り直す）
+                checkpoint_blocked = True
+            if not checkpoint_blocked:
+                last_id = batch['last_id']
+        if last_id is not None:
+            save_checkpoint(checkpoint_path, last_id, identity)
+
+    def collect(futures, return_when):
+        nonlocal done_rows, failed_rows, last_report
+        finished, pending = wait(futures, return_when=return_when)
+        for future in finished:
+            batch = futures.pop(future)
+            try:
+                write_batch(write_conn, batch['rows'], future.result())
+                done_rows += len(batch['rows'])
+            except Exception as e:
+                write_conn.rollback()
+                print(f"  [!] ID {batch['rows'][0][0]}〜{batch['last_id']} の更新に失敗: {e}")
+                failed_rows += len(batch['rows'])
+                batch['failed'] = True
+            batch['done'] = True
+        advance_checkpoint()
+        now = time.perf_counter()
+        if now - last_report >= 5:
+            last_report = now
+            print(f"  - {done_rows} 件完了（{done_rows / (now - started):.1f} rows/sec）")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for rows in stream_pending(read_conn, after_id, batch_size, limit):
+                streamed_rows += len(rows)
+                # 実行中のバッチ数を workers * 2 までに抑える（メモリを一定に保つ）
+                while len(futures) >= workers * 2:
+                    collect(futures, FIRST_COMPLETED)
+                batch = {'rows': rows, 'last_id': rows[-1][0], 'done': False, 'failed': False}
+                in_order.append(batch)
+                texts = [content for _, content in rows]
+                futures[executor.submit(embed_with_retry, embed, texts, limiter, max_retries)] = batch
+            while futures:
+                collect(futures, FIRST_COMPLETED)
+        seconds = time.perf_counter() - started
+
+        # --limit で打ち切らずに最後まで処理し、失敗も無ければチェックポイントは不要
+        if failed_rows == 0 and (limit is None or streamed_rows < limit):
+            remove_checkpoint(checkpoint_path)
+        # チェックポイントより前（id <= after_id）で未生成に戻った行も含めて確認する
+        remaining = has_pending(read_conn)
+    finally:
+        read_conn.close()
+        write_conn.close()
+
+    return {
+        'rows': done_rows,
+        'failed': failed_rows,
+        'seconds': seconds,
+        'rows_per_sec': done_rows / seconds if seconds else 0.0,
+        'resumed_from': after_id,
+        'remaining': remaining,
+    }
+
 
 def main():
     load_dotenv()
-    api_key = os.getenv("GENAI_API_KEY")
-    if not api_key:
-        print("[x] GOOGLE_API_KEY が設定されていません")
-        return
-
-    genai.configure(api_key=api_key)
-    
-    print("[*] ベクトル未生成の短歌を取得中...")
-    tankas = get_tankas_without_embeddings()
-    
-    if not tankas:
+    parser = argparse.ArgumentParser(description="既存短歌の埋め込みを一括生成")
+    parser.add_argument('--batch-size', type=int, default=64, help="1回のAPI呼び出しでまとめる件数")
+    parser.add_argument('--workers', type=int, default=4, help="並列に送信するスレッド数")
+    parser.add_argument('--rpm', type=int, default=1000, help="APIリクエスト数の上限（/分, 0で無制限）")
+    parser.add_argument('--max-retries', type=int, default=5)
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help="チェックポイントファイル")
+    parser.add_argument('--restart', action='store_true', help="チェックポイントを無視して最初から")
+    parser.add_argument('--limit', type=int, help="処理する最大件数")
+    parser.add_argument('--provider', choices=sorted(PROVIDERS), default=EMBEDDING_PROVIDER,
+                        help="埋め込みプロバイダ（既定は .env の EMBEDDING_PROVIDER）")
+    parser.add_argument('--fake', action='store_true', help="--provider local と同じ（APIを使わずオフラインで計測）")
+    parser.add_argument('--fake-latency', type=float, default=0.0, help="1回の呼び出しごとに足す待ち時間（ms）")
+    args = parser.parse_args()
+
+    provider_name = 'local' if args.fake else args.provider
+    if provider_name == 'gemini' and not os.getenv("GENAI_API_KEY"):
+        print("[x] GENAI_API_KEY が設定されていません（オフラインで実行する場合は --fake）")
+        sys.exit(1)
+    provider = PROVIDERS[provider_name]()
+    embed = make_embedder(provider, args.fake_latency / 1000)
+
+    print("[*] ベクトル未生成の短歌の埋め込みを生成します")
+    result = run_backfill(
+        embed,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        rpm=0 if provider_name == 'local' else args.rpm,
+        max_retries=args.max_retries,
+        checkpoint_path=args.checkpoint,
+        restart=args.restart,
+        limit=args.limit,
+    )
+
+    if result['rows'] or result['failed']:
+        print(f"\n[v] {result['rows']} 件を更新しました（失敗 {result['failed']} 件, "
+              f"{result['seconds']:.1f}秒, {result['rows_per_sec']:.1f} rows/sec）")
+    if result['failed']:
+        print("   失敗した行は再実行すると再度処理されます")
+    elif not result['remaining']:
         print("[v] すべての短歌にベクトルが付与されています")
-        return
-    
-    print(f"[*] {len(tankas)} 件の短歌のベクトルを生成します")
-    
-    for tanka_id, content in tankas:
-        try:
-            print(f"  - ID {tanka_id} のベクトルを生成中...")
-            # text-embedding-004 を使用 (768次元)
-            result = genai.embed_content(
-                model="models/text-embedding-004",
-                content=content,
-                task_type="retrieval_document"
-            )
-            embedding = result['embedding']
-            update_tanka_embedding(tanka_id, embedding)
-        except Exception as e:
-            print(f"  [!] ID {tanka_id} でエラー: {e}")
-            
-    print("\n[v] すべての更新が完了しました")
+    elif result['resumed_from']:
+        print(f"[!] チェックポイント（id <= {result['resumed_from']}）より前にベクトル未生成の行が残っています"
+              "（チェックポイントは削除したので、再実行すると最初から処理します）")
+    else:
+        print("[!] ベクトル未生成の行が残っています（--limit で打ち切ったか、処理中に追加された行です）")
+
 
 if __name__ == "__main__":
     main()
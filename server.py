@@ -1,34 +1,84 @@
 """
 server.py - プロダクション用サーバー起動スクリプト
 Waitressを使用してWebアプリケーションサーバーを起動
+（SERVER_MODE=asgi の場合は uvicorn + app/asgi.py）
+
+ワーカープロセス数を2以上にすると、master が待ち受けソケットを開いてワーカーを fork する
+（app/prefork.py。kill -HUP <master pid> でグレースフルリスタート）
+
+使い方:
+    python server.py
+    python server.py --workers 4 --threads 8 --host 0.0.0.0 --port 8000
 """
+import argparse
+import os
 import sys
 from waitress import serve
-from app import app, setup_docker_environment, wait_for_database
+from app import app
+from app.startup import prepare_environment, load_vector_index_if_enabled
+from app.config import WAITRESS_THREADS, SERVER_MODE, SERVER_CONFIG
+
+def parse_args():
+    """コマンドライン引数（省略時は .env の設定）"""
+    parser = argparse.ArgumentParser(description="匿名短歌交換 アプリケーションサーバー")
+    parser.add_argument('--host', default=SERVER_CONFIG['host'], help="待ち受けアドレス")
+    parser.add_argument('--port', type=int, default=SERVER_CONFIG['port'])
+    parser.add_argument('--workers', type=int, default=SERVER_CONFIG['workers'],
+                        help="ワーカープロセス数（0: CPUコア数）")
+    parser.add_argument('--threads', type=int, default=WAITRESS_THREADS, help="ワーカーごとのスレッド数")
+    parser.add_argument('--graceful-timeout', type=float, default=SERVER_CONFIG['graceful_timeout'],
+                        help="停止・再起動時に処理中のリクエストを待つ秒数")
+    return parser.parse_args()
 
 def main():
     """メイン処理"""
+    args = parse_args()
+    workers = args.workers or os.cpu_count() or 1
     print("=== 匿名短歌交換 アプリケーションサーバー起動 (Waitress) ===\n")
-    
-    # 1. Docker環境のセットアップ
-    setup_docker_environment()
-    
-    # 2. データベース接続確認
-    if not wait_for_database():
+
+    if workers > 1:
+        from app.prefork import can_fork
+        if not can_fork():
+            print("[!] この環境では fork できないため、単一プロセスで起動します")
+            workers = 1
+
+    # 1-5. DB接続確認（必要なら Docker で起動）・スキーマ初期化・ベクトル索引の読み込み・埋め込みワーカー起動
+    #      マルチプロセス時、ベクトル索引は fork 前に読み込んでワーカー間で共有し、
+    #      埋め込みワーカーは fork 後に各ワーカープロセスで起動する
+    if not prepare_environment(start_worker=workers == 1):
         print("\n[x] データベースに接続できませんでした")
         print("  アプリケーションを終了します")
         sys.exit(1)
-    
-    # 3. データベース初期化（初回のみ）
-    print("[*] データベースを初期化中...")
-    from scripts.init_db import init_database
-    init_database()
-    
-    print("\n[*] サーバーを http://127.0.0.1:5000 で起動します...")
+
+    print(f"\n[*] サーバーを http://{args.host}:{args.port} で起動します...")
     print("  (停止するには Ctrl+C を入力してください)\n")
-    
-    # 4. Waitressサーバーを起動
-    serve(app, host='127.0.0.1', port=5000)
+
+    # 6. サーバーを起動
+    if workers > 1:
+        from app.db_pool import close_pool
+        from app.prefork import PreforkServer, bind_socket
+
+        def reload_before_restart():
+            load_vector_index_if_enabled(reload=True)
+            close_pool()
+
+        # 親のDB接続をワーカーに引き継がない
+        close_pool()
+        sock = bind_socket(args.host, args.port, SERVER_CONFIG['backlog'])
+        PreforkServer(
+            sock, workers,
+            mode=SERVER_MODE,
+            threads=args.threads,
+            graceful_timeout=args.graceful_timeout,
+            on_reload=reload_before_restart,
+        ).run()
+    elif SERVER_MODE == 'asgi':
+        # AI相談・交換を asyncio で処理（app/asgi.py）
+        print("  (ASGIモード: uvicorn)\n")
+        from app.asgi import serve_asgi
+        serve_asgi(host=args.host, port=args.port)
+    else:
+        serve(app, host=args.host, port=args.port, threads=args.threads)
 
 if __name__ == '__main__':
     main()